@@ -0,0 +1,209 @@
+"""
+Server-side execution of the actions /ai/command proposes.
+
+Instead of the browser replaying each action as its own HTTP call, POST
+/ai/actions validates the whole list and applies it in one transaction.
+Actions are grouped by type; each group is staged and checked set-based
+(bulk.py) and applied with a single statement, so the number of statements
+depends on the action types present, not on how many actions there are.
+Every action is scoped to the calling coach's clients and sessions. Invalid
+actions are reported at their index and skipped; the rest commit together.
+"""
+import json, uuid
+import booking
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from bulk import stage_rows, flag_rows, flag_missing
+from recurrence import SERIES_COLS, is_virtual, parse_virtual_id, occurrence_dates
+
+MAX_ACTIONS = 200
+ATTENDANCE_STATUS = {"attended":"confirmed","present":"confirmed","absent":"no_show","no_show":"no_show","completed":"completed"}
+CLIENT_META = ("goal","type","weight","height","injuries","diet","notes","level","medical")
+LINKED = "NOT EXISTS (SELECT 1 FROM coach_clients cc WHERE cc.coach_id=$2::uuid AND cc.client_id=s.{col})"
+OWNED = "NOT EXISTS (SELECT 1 FROM scheduled_sessions ss WHERE ss.id=s.id AND ss.coach_id=$2::uuid)"
+REPEATED = "EXISTS (SELECT 1 FROM {table} d WHERE d.id=s.id AND d.row_no<s.row_no)"
+
+
+def result(index: int, type_: Optional[str], id_: Optional[str] = None, error: Optional[str] = None) -> dict:
+    return {"index": index, "type": type_, "success": error is None, "id": id_, "error": error}
+
+def _text(params: dict, key: str) -> Optional[str]:
+    return str(params.get(key) or "").strip() or None
+
+def _meta(params: dict) -> str:
+    return json.dumps({k: params[k] for k in CLIENT_META if params.get(k)})
+
+def _session_id(params: dict) -> str:
+    sid = str(params["session_id"])
+    if is_virtual(sid): uuid.UUID(parse_virtual_id(sid)[0])
+    else: uuid.UUID(sid)
+    return sid
+
+# Per-type params -> staged values (ValueError/KeyError/TypeError = invalid action)
+def _parse_add_client(p: dict) -> tuple:
+    if not _text(p, "name"): raise ValueError("name is required")
+    return _text(p, "name"), _text(p, "email"), _text(p, "phone"), _meta(p)
+
+def _parse_update_client(p: dict) -> tuple:
+    return uuid.UUID(str(p["client_id"])), _text(p, "name"), _text(p, "email"), _text(p, "phone"), _meta(p)
+
+def _parse_schedule_session(p: dict) -> tuple:
+    at = datetime.strptime(f"{p['date']} {(p.get('time') or '07:00')[:5]}", "%Y-%m-%d %H:%M")
+    return uuid.UUID(str(p["client_id"])), at, int(p.get("duration") or p.get("duration_minutes") or 60), _text(p, "location") or "offline"
+
+def _parse_mark_attendance(p: dict) -> tuple:
+    status = str(p.get("status") or "no_show")
+    if status not in ATTENDANCE_STATUS and status not in ATTENDANCE_STATUS.values():
+        raise ValueError(f"status must be one of {', '.join(ATTENDANCE_STATUS)}")
+    return _session_id(p), ATTENDANCE_STATUS.get(status, status)
+
+def _parse_cancel_session(p: dict) -> tuple:
+    return _session_id(p), str(p.get("reason") or "")
+
+async def _staged(conn, table: str) -> List[tuple]:
+    return [(r["row_no"], r["id"], r["error"]) for r in await conn.fetch(f"SELECT row_no,id::text,error FROM {table} ORDER BY row_no")]
+
+async def _add_clients(conn, items: list, coach_id: str, org_id: str) -> List[tuple]:
+    meta = {"coach_id": coach_id}
+    await stage_rows(conn, "ai_add_client", {"name":"TEXT","email":"TEXT","phone":"TEXT","meta":"TEXT"},
+                     [(i, uuid.uuid4(), n, e, ph, json.dumps({**meta, **json.loads(m)})) for i, (n, e, ph, m) in items])
+    await flag_rows(conn, "ai_add_client", [
+        ("s.email IS NOT NULL AND EXISTS (SELECT 1 FROM ai_add_client d WHERE d.email=s.email AND d.row_no<s.row_no)", "Duplicate email in actions"),
+        ("s.phone IS NOT NULL AND EXISTS (SELECT 1 FROM ai_add_client d WHERE d.phone=s.phone AND d.row_no<s.row_no)", "Duplicate phone in actions"),
+        ("EXISTS (SELECT 1 FROM users u WHERE u.email=s.email)", "Email already exists"),
+        ("EXISTS (SELECT 1 FROM users u WHERE u.phone=s.phone)", "Phone already exists"),
+        # the prompt may list only part of a large roster; a bare name the model could not resolve is most likely an existing client
+        ("s.email IS NULL AND s.phone IS NULL AND EXISTS (SELECT 1 FROM coach_clients cc JOIN users u ON u.id=cc.client_id "
+         "WHERE cc.coach_id=$2::uuid AND u.is_active=true AND u.deleted_at IS NULL AND lower(u.full_name)=lower(s.name))",
+         "A client with this name already exists"),
+    ], coach_id)
+    ids = await conn.fetch(
+        """WITH ins AS (INSERT INTO users (id,primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
+                        SELECT id,$1,name,email,phone,'client',true,true,meta::jsonb,NOW() FROM ai_add_client WHERE error IS NULL ORDER BY row_no
+                        ON CONFLICT DO NOTHING RETURNING id),
+                link AS (INSERT INTO coach_clients (coach_id,client_id) SELECT $2::uuid,id FROM ins)
+           SELECT id FROM ins""", org_id, coach_id)
+    await flag_missing(conn, "ai_add_client", [r["id"] for r in ids], "Email or phone already exists")
+    return await _staged(conn, "ai_add_client")
+
+async def _update_clients(conn, items: list, coach_id: str, org_id: str) -> List[tuple]:
+    await stage_rows(conn, "ai_update_client", {"name":"TEXT","email":"TEXT","phone":"TEXT","meta":"TEXT"}, [(i, *v) for i, v in items])
+    await flag_rows(conn, "ai_update_client", [
+        (LINKED.format(col="id"), "Client not found"),
+        (REPEATED.format(table="ai_update_client"), "Client already updated by an earlier action"),
+        ("s.email IS NOT NULL AND EXISTS (SELECT 1 FROM users u WHERE u.email=s.email AND u.id<>s.id)", "Email already exists"),
+        ("s.phone IS NOT NULL AND EXISTS (SELECT 1 FROM users u WHERE u.phone=s.phone AND u.id<>s.id)", "Phone already exists"),
+    ], coach_id)
+    await conn.execute(
+        """UPDATE users u SET full_name=COALESCE(s.name,u.full_name),email=COALESCE(s.email,u.email),phone=COALESCE(s.phone,u.phone),
+                  metadata=COALESCE(u.metadata,'{}'::jsonb)||s.meta::jsonb
+           FROM ai_update_client s WHERE u.id=s.id AND s.error IS NULL""")
+    return await _staged(conn, "ai_update_client")
+
+async def _schedule_sessions(conn, items: list, coach_id: str, org_id: str) -> List[tuple]:
+    await stage_rows(conn, "ai_schedule_session", {"client_id":"UUID","scheduled_at":"TIMESTAMPTZ","duration_minutes":"INT","location":"TEXT"},
+                     [(i, uuid.uuid4(), *v) for i, v in items])
+    await flag_rows(conn, "ai_schedule_session", [
+        (LINKED.format(col="client_id"), "Client not found"),
+        ("s.duration_minutes <= 0", "Duration must be positive"),
+    ], coach_id)
+    await booking.lock_coach(conn, coach_id)
+    await booking.flag_overlaps(conn, "ai_schedule_session", coach_id)
+    await conn.execute(
+        """INSERT INTO scheduled_sessions (id,org_id,coach_id,client_id,scheduled_at,duration_minutes,status,location,created_at)
+           SELECT id,$1,$2::uuid,client_id,scheduled_at,duration_minutes,'scheduled',location,NOW() FROM ai_schedule_session WHERE error IS NULL ORDER BY row_no""",
+        org_id, coach_id)
+    return await _staged(conn, "ai_schedule_session")
+
+# A staged occurrence is one of this coach's active series, within its dates, not excluded and not a skipped holiday
+NOT_OCCURRENCE = """NOT EXISTS (SELECT 1 FROM session_series ser WHERE ser.id=s.series_id AND ser.coach_id=$2::uuid AND ser.status='active'
+                      AND s.occurrence_date>=ser.start_date AND (ser.until_date IS NULL OR s.occurrence_date<=ser.until_date)
+                      AND s.occurrence_date<>ALL(ser.exdates)
+                      AND NOT (ser.skip_holidays AND EXISTS (SELECT 1 FROM coach_holidays h WHERE h.coach_id=ser.coach_id AND h.holiday_date=s.occurrence_date)))"""
+
+async def _resolve_sessions(conn, items: list, coach_id: str, table: str):
+    """Materialise series occurrences ("<series>:<date>") of this coach; (resolved items, failed results).
+
+    The (series, date) pairs are staged in `table` and checked in SQL; whether a date is on the
+    series' rule (interval, weekdays, count) is computed once per series. All valid pairs are then
+    written with one INSERT ... SELECT; occurrences already stored resolve to their existing row.
+    """
+    virtual = {}
+    for i, (sid, *_) in items:
+        if not is_virtual(sid): continue
+        series_id, d = parse_virtual_id(sid)
+        virtual[i] = (str(uuid.UUID(series_id)), d)
+    if virtual:
+        await stage_rows(conn, table, {"series_id":"UUID","occurrence_date":"DATE"},
+                         [(i, uuid.uuid4(), uuid.UUID(series_id), d) for i, (series_id, d) in virtual.items()])
+        await flag_rows(conn, table, [(NOT_OCCURRENCE, "Session not found")], coach_id)
+        series = {r["id"]: r for r in await conn.fetch(
+            f"SELECT {SERIES_COLS} FROM session_series ser WHERE ser.id IN (SELECT series_id FROM {table} WHERE error IS NULL)")}
+        dates: Dict[str, list] = {}
+        for sid, d in virtual.values(): dates.setdefault(sid, []).append(d)
+        on_rule = {k: set(occurrence_dates(ser, min(dates[k]), max(dates[k]) + timedelta(days=1))) for k, ser in series.items()}
+        off_rule = [i for i, (sid, d) in virtual.items() if sid in on_rule and d not in on_rule[sid]]
+        await conn.execute(f"UPDATE {table} SET error='Session not found' WHERE error IS NULL AND row_no=ANY($1::int[])", off_rule)
+        # an occurrence that overlaps a session booked since the series was created is kept, marked overlap_ok
+        await conn.execute(f"""
+            WITH ins AS (
+                INSERT INTO scheduled_sessions (org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,location,series_id,occurrence_date,overlap_ok,created_at)
+                SELECT DISTINCT ON (ser.id,s.occurrence_date) ser.org_id,ser.coach_id,ser.client_id,ser.session_template_id,
+                       (s.occurrence_date+ser.start_time) AT TIME ZONE 'UTC',ser.duration_minutes,'scheduled',ser.location,ser.id,s.occurrence_date,
+                       EXISTS (SELECT 1 FROM scheduled_sessions o WHERE o.coach_id=ser.coach_id AND o.status<>'cancelled' AND NOT o.overlap_ok
+                               AND o.period && session_period((s.occurrence_date+ser.start_time) AT TIME ZONE 'UTC',ser.duration_minutes)),NOW()
+                FROM {table} s JOIN session_series ser ON ser.id=s.series_id WHERE s.error IS NULL
+                ON CONFLICT (series_id,occurrence_date) WHERE series_id IS NOT NULL DO NOTHING RETURNING id,series_id,occurrence_date
+            )
+            UPDATE {table} s SET id=COALESCE(
+                (SELECT ins.id FROM ins WHERE ins.series_id=s.series_id AND ins.occurrence_date=s.occurrence_date),
+                (SELECT ss.id FROM scheduled_sessions ss WHERE ss.series_id=s.series_id AND ss.occurrence_date=s.occurrence_date))
+            WHERE s.error IS NULL""")
+        virtual = {i: (id_, error) for i, id_, error in await _staged(conn, table)}
+    resolved, failed = [], []
+    for i, (sid, *rest) in items:
+        if i not in virtual: resolved.append((i, uuid.UUID(sid), *rest))
+        elif virtual[i][1]: failed.append((i, None, virtual[i][1]))
+        else: resolved.append((i, uuid.UUID(virtual[i][0]), *rest))
+    return resolved, failed
+
+async def _mark_attendance(conn, items: list, coach_id: str, org_id: str) -> List[tuple]:
+    items, failed = await _resolve_sessions(conn, items, coach_id, "ai_mark_attendance_occurrence")
+    await stage_rows(conn, "ai_mark_attendance", {"status":"TEXT"}, items)
+    await flag_rows(conn, "ai_mark_attendance", [(OWNED, "Session not found"), (REPEATED.format(table="ai_mark_attendance"), "Session already changed by an earlier action")], coach_id)
+    await conn.execute("UPDATE scheduled_sessions ss SET status=s.status FROM ai_mark_attendance s WHERE ss.id=s.id AND s.error IS NULL")
+    return failed + await _staged(conn, "ai_mark_attendance")
+
+async def _cancel_sessions(conn, items: list, coach_id: str, org_id: str) -> List[tuple]:
+    items, failed = await _resolve_sessions(conn, items, coach_id, "ai_cancel_session_occurrence")
+    await stage_rows(conn, "ai_cancel_session", {"reason":"TEXT"}, items)
+    await flag_rows(conn, "ai_cancel_session", [(OWNED, "Session not found"), (REPEATED.format(table="ai_cancel_session"), "Session already changed by an earlier action")], coach_id)
+    await conn.execute(
+        """UPDATE scheduled_sessions ss SET status='cancelled',cancelled_reason=s.reason,cancelled_at=NOW()
+           FROM ai_cancel_session s WHERE ss.id=s.id AND s.error IS NULL""")
+    return failed + await _staged(conn, "ai_cancel_session")
+
+# Applied in this order: clients exist before sessions are scheduled for them
+ACTIONS: Dict[str, tuple] = {
+    "add_client": (_parse_add_client, _add_clients),
+    "update_client": (_parse_update_client, _update_clients),
+    "schedule_session": (_parse_schedule_session, _schedule_sessions),
+    "mark_attendance": (_parse_mark_attendance, _mark_attendance),
+    "cancel_session": (_parse_cancel_session, _cancel_sessions),
+}
+
+async def run_actions(conn, actions: list, coach_id: str, org_id: str) -> List[dict]:
+    """Validate and apply `actions` ([{type, params}]) in one transaction; one result per action, in order."""
+    results: List[Optional[dict]] = [None] * len(actions)
+    groups: Dict[str, list] = {t: [] for t in ACTIONS}
+    for i, a in enumerate(actions):
+        t = a.get("type") if isinstance(a, dict) else None
+        if t == "none": results[i] = result(i, t); continue
+        if t not in ACTIONS: results[i] = result(i, t, error="Unknown action type"); continue
+        try: groups[t].append((i, ACTIONS[t][0](a.get("params") or {})))
+        except (KeyError, TypeError, ValueError) as e: results[i] = result(i, t, error=f"Invalid params: {str(e)[:100]}")
+    async with conn.transaction():
+        for t, (_, apply) in ACTIONS.items():
+            if not groups[t]: continue
+            for i, id_, error in await apply(conn, groups[t], coach_id, org_id): results[i] = result(i, t, None if error else id_, error)
+    return results
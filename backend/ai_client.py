@@ -0,0 +1,96 @@
+"""
+Async client for the AI upstream (Anthropic Messages API).
+
+One httpx.AsyncClient per process keeps a pool of keep-alive connections, so
+/ai/command neither blocks the event loop nor pays a TLS handshake per call.
+Transport errors (connect, timeout, dropped connection), 429 and 5xx are retried up to AI_MAX_RETRIES
+times with exponential backoff and jitter (Retry-After is honoured). Point
+ANTHROPIC_BASE_URL at a local stub server to run without the real API.
+stream_message() yields the text of a streamed reply as it arrives.
+"""
+import asyncio, json, os, random
+from typing import AsyncIterator, Optional
+import httpx
+
+BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+API_VERSION = os.getenv("ANTHROPIC_VERSION", "2023-06-01")
+MODEL = os.getenv("AI_COMMAND_MODEL", "claude-sonnet-4-20250514")
+MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", 2000))
+TIMEOUT = httpx.Timeout(float(os.getenv("AI_TIMEOUT_SECONDS", 30)), connect=float(os.getenv("AI_CONNECT_TIMEOUT_SECONDS", 5)))
+LIMITS = httpx.Limits(max_connections=int(os.getenv("AI_POOL_MAX_CONNECTIONS", 20)),
+                      max_keepalive_connections=int(os.getenv("AI_POOL_MAX_KEEPALIVE", 10)), keepalive_expiry=60)
+MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", 3))
+BACKOFF_SECONDS = float(os.getenv("AI_RETRY_BACKOFF_SECONDS", 0.5))
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+class UpstreamError(Exception):
+    """The AI upstream could not be reached or kept failing."""
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(base_url=BASE_URL, timeout=TIMEOUT, limits=LIMITS)
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None: await _client.aclose()
+    _client = None
+
+def _delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after and retry_after.replace(".", "", 1).isdigit(): return min(float(retry_after), 30.0)
+    return BACKOFF_SECONDS * 2 ** attempt * (0.5 + random.random())
+
+def _headers(api_key: str) -> dict:
+    return {"x-api-key": api_key, "anthropic-version": API_VERSION}
+
+async def create_message(system: str, messages: list, api_key: str) -> dict:
+    """POST /v1/messages and return the decoded response; UpstreamError once retries are spent."""
+    body = {"model": MODEL, "max_tokens": MAX_TOKENS, "system": system, "messages": messages}
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            response = await get_client().post("/v1/messages", json=body, headers=_headers(api_key))
+            if response.status_code not in RETRY_STATUS:
+                if response.is_error: raise UpstreamError(f"AI upstream returned {response.status_code}: {response.text[:200]}")
+                return response.json()
+            error = UpstreamError(f"AI upstream returned {response.status_code}")
+        except httpx.TransportError as e:
+            error = UpstreamError(f"AI upstream unreachable: {e.__class__.__name__}")
+        if attempt < MAX_RETRIES: await asyncio.sleep(_delay(attempt, response))
+    raise error
+
+async def stream_message(system: str, messages: list, api_key: str) -> AsyncIterator[str]:
+    """Text of a streamed /v1/messages reply, chunk by chunk. Retried like create_message() until the
+    first chunk is out; a failure after that raises UpstreamError (the caller has already relayed text)."""
+    body = {"model": MODEL, "max_tokens": MAX_TOKENS, "system": system, "messages": messages, "stream": True}
+    started = False
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            async with get_client().stream("POST", "/v1/messages", json=body, headers=_headers(api_key)) as response:
+                if response.status_code in RETRY_STATUS:
+                    error = UpstreamError(f"AI upstream returned {response.status_code}")
+                else:
+                    if response.is_error:
+                        await response.aread()
+                        raise UpstreamError(f"AI upstream returned {response.status_code}: {response.text[:200]}")
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"): continue
+                        event = json.loads(line[5:])
+                        if event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                            started = True
+                            yield event["delta"]["text"]
+                        elif event.get("type") == "error":
+                            raise UpstreamError(f"AI upstream error: {event.get('error', {}).get('message', 'unknown')}")
+                    return
+        except httpx.TransportError as e:
+            error = UpstreamError(f"AI upstream unreachable: {e.__class__.__name__}")
+            if started: raise error
+        if attempt < MAX_RETRIES: await asyncio.sleep(_delay(attempt, response))
+    raise error
@@ -0,0 +1,116 @@
+"""
+Coach context for the /ai/command system prompt.
+
+The context is the coach's own clients (newest links first), the sessions on
+the coach's local today and the most recent sessions. The three lookups run
+concurrently, two of them on their own pooled connections. The rendered
+context is cached per coach for AI_CONTEXT_TTL_SECONDS and keyed on the
+coach's cache_versions (migration 010), so any write to the coach's clients,
+sessions, series or profile invalidates it on every instance.
+
+The prompt is size-bounded: today's sessions, then clients, then recent
+sessions are added item by item until AI_CONTEXT_MAX_CHARS (about 4 chars per
+token) is reached, and chat history is cut to AI_HISTORY_MAX_CHARS. A prompt
+longer than AI_PROMPT_MAX_CHARS is refused rather than cut.
+"""
+import asyncio, json, os, time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Awaitable, Callable, List, Optional
+from db import get_db, release_db
+from etags import scope_versions
+from localtime import DEFAULT_TIMEZONE, valid_timezone, local_today
+
+TTL_SECONDS = float(os.getenv("AI_CONTEXT_TTL_SECONDS", 60))
+MAX_CHARS = int(os.getenv("AI_CONTEXT_MAX_CHARS", 24000))
+HISTORY_MAX_CHARS = int(os.getenv("AI_HISTORY_MAX_CHARS", 8000))
+PROMPT_MAX_CHARS = int(os.getenv("AI_PROMPT_MAX_CHARS", 4000))
+CACHE_SIZE = int(os.getenv("AI_CONTEXT_CACHE_SIZE", 1000))
+MAX_CLIENTS = 200
+MAX_RECENT = 40
+HISTORY_TURNS = 6
+SESSION_KEYS = ("id", "scheduled_at", "status", "location", "client_name", "client_id")
+
+_cache: "OrderedDict[str, tuple]" = OrderedDict()  # coach_id -> (expires, versions, context)
+
+
+async def _on_own_conn(fn, *args, **kwargs):
+    conn = await get_db()
+    try: return await fn(conn, *args, **kwargs)
+    finally: await release_db(conn)
+
+async def _clients(conn, coach_id: str) -> List[dict]:
+    rows = await conn.fetch(
+        """SELECT u.id::text,u.full_name as name,u.email,u.phone,u.metadata::text FROM coach_clients cc JOIN users u ON u.id=cc.client_id
+           WHERE cc.coach_id=$1::uuid AND u.is_active=true AND u.deleted_at IS NULL ORDER BY cc.created_at DESC,cc.client_id DESC LIMIT $2""",
+        coach_id, MAX_CLIENTS)
+    out = [{**dict(r), "metadata": json.loads(r["metadata"]) if r["metadata"] else {}} for r in rows]
+    for c in out: c["metadata"].pop("coach_id", None)  # always this coach
+    return out
+
+async def _client_count(conn, coach_id: str) -> int:
+    """Roster size; the prompt lists at most MAX_CLIENTS of them."""
+    return await conn.fetchval(
+        """SELECT COUNT(*) FROM coach_clients cc JOIN users u ON u.id=cc.client_id
+           WHERE cc.coach_id=$1::uuid AND u.is_active=true AND u.deleted_at IS NULL""", coach_id)
+
+async def _recent(conn, coach_id: str) -> List[dict]:
+    rows = await conn.fetch(
+        """SELECT ss.id::text,ss.scheduled_at::text,ss.status,ss.location,u.full_name as client_name,ss.client_id::text
+           FROM scheduled_sessions ss LEFT JOIN users u ON ss.client_id=u.id
+           WHERE ss.coach_id=$1::uuid ORDER BY ss.scheduled_at DESC,ss.id DESC LIMIT $2""",
+        coach_id, MAX_RECENT)
+    return [dict(r) for r in rows]
+
+def _compact(item: dict) -> dict:
+    return {k: v for k, v in item.items() if v not in (None, "", {}, [])}
+
+def _fit(sections: List[list], budget: int) -> List[list]:
+    """Keep items in priority order (section by section) while the JSON stays within `budget` chars."""
+    kept, used = [], 0
+    for items in sections:
+        out = []
+        for item in items:
+            size = len(json.dumps(item, separators=(",", ":"))) + 1
+            if used + size > budget: break
+            out.append(item); used += size
+        kept.append(out)
+    return kept
+
+async def coach_context(conn, coach_id: Optional[str], sessions_on: Callable[..., Awaitable[list]]) -> dict:
+    """{coach_name, timezone, date, clients, today, recent, client_total, recent_total}, cached per coach.
+    client_total is the whole roster; `clients` may be cut to MAX_CLIENTS and by the size budget.
+    `sessions_on(conn, start, end, coach_id=...)` lists sessions on local days [start, end)."""
+    if not coach_id:
+        return {"coach_name": "Coach", "timezone": DEFAULT_TIMEZONE, "date": local_today(), "clients": [], "today": [], "recent": [],
+                "client_total": 0, "recent_total": 0}
+    versions = await scope_versions(conn, [("coach", coach_id), ("profile", coach_id)])
+    hit = _cache.get(coach_id)
+    if hit and hit[0] > time.monotonic() and hit[1] == versions and hit[2]["date"] == local_today(hit[2]["timezone"]):
+        _cache.move_to_end(coach_id)
+        return hit[2]
+    coach = await conn.fetchrow("SELECT full_name,timezone FROM users WHERE id=$1::uuid", coach_id)
+    tz = coach["timezone"] if coach and valid_timezone(coach["timezone"]) else DEFAULT_TIMEZONE
+    today = local_today(tz)
+    clients, today_list, recent = await asyncio.gather(
+        _clients(conn, coach_id),
+        _on_own_conn(sessions_on, today, today + timedelta(days=1), coach_id=coach_id),
+        _on_own_conn(_recent, coach_id))
+    client_total = len(clients) if len(clients) < MAX_CLIENTS else await _client_count(conn, coach_id)
+    today_list = [_compact({k: s.get(k) for k in SESSION_KEYS}) for s in today_list]
+    fitted = _fit([today_list, [_compact(c) for c in clients], [_compact(s) for s in recent]], MAX_CHARS)
+    ctx = {"coach_name": coach["full_name"] if coach else "Coach", "timezone": tz, "date": today,
+           "today": fitted[0], "clients": fitted[1], "recent": fitted[2], "client_total": client_total, "recent_total": len(recent)}
+    _cache[coach_id] = (time.monotonic() + TTL_SECONDS, versions, ctx)
+    _cache.move_to_end(coach_id)
+    while len(_cache) > CACHE_SIZE: _cache.popitem(last=False)
+    return ctx
+
+def clip_history(history: list) -> List[dict]:
+    """The last few chat turns, newest kept first, within HISTORY_MAX_CHARS."""
+    out, used = [], 0
+    for msg in reversed((history or [])[-HISTORY_TURNS:]):
+        if used >= HISTORY_MAX_CHARS: break
+        content = str(msg.get("content", ""))[:HISTORY_MAX_CHARS - used]
+        out.append({"role": msg.get("role", "user"), "content": content}); used += len(content)
+    return out[::-1]
@@ -0,0 +1,62 @@
+"""
+Server-Sent Events helpers for /ai/command/stream.
+
+The model replies with one JSON object, {"message": ..., "actions": [...]},
+delivered a few characters at a time. ActionScanner follows the JSON
+structure incrementally (strings, escapes, nesting) and hands back each
+element of the top-level "actions" array as soon as its closing brace
+arrives, so the UI can show an action before the reply is finished.
+"""
+import json
+from typing import List
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class ActionScanner:
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_str = False
+        self.escape = False
+        self.str_start = 0
+        self.closed = None       # string just closed at depth 1: a key if ':' comes next
+        self.last_key = None     # last key of the top-level object
+        self.in_actions = False
+        self.obj_start = None
+
+    def feed(self, text: str) -> List[dict]:
+        """Consume the next chunk; return the action objects it completed."""
+        self.buf += text
+        done = []
+        for i in range(self.pos, len(self.buf)):
+            ch = self.buf[i]
+            if self.in_str:
+                if self.escape: self.escape = False
+                elif ch == "\\": self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+                    if self.depth == 1: self.closed = self.buf[self.str_start + 1:i]
+                continue
+            if ch.isspace(): continue
+            if self.closed is not None:
+                if ch == ":": self.last_key = self.closed
+                self.closed = None
+            if ch == '"':
+                self.in_str, self.str_start = True, i
+            elif ch in "{[":
+                self.depth += 1
+                if ch == "[" and self.depth == 2 and self.last_key == "actions": self.in_actions = True
+                elif ch == "{" and self.in_actions and self.depth == 3: self.obj_start = i
+            elif ch in "}]":
+                if ch == "}" and self.in_actions and self.depth == 3 and self.obj_start is not None:
+                    try: done.append(json.loads(self.buf[self.obj_start:i + 1]))
+                    except ValueError: pass  # malformed element; the final parse decides
+                    self.obj_start = None
+                elif ch == "]" and self.depth == 2: self.in_actions = False
+                self.depth -= 1
+        self.pos = len(self.buf)
+        return done
@@ -0,0 +1,81 @@
+"""
+Content-addressed image store (coach logos).
+
+Images are decoded once and written to BLOB_STORE_DIR/<aa>/<sha256>, where the
+name is the SHA-256 of the bytes. Identical uploads share one file, a stored
+file never changes, and the hash doubles as a strong ETag, so GET /logos/{hash}
+can be cached forever. users.logo_hash holds only the hash. Point
+BLOB_STORE_DIR at shared storage when running more than one instance.
+"""
+import asyncio, base64, binascii, hashlib, os, re
+from pathlib import Path
+from typing import Optional, Tuple
+from fastapi import HTTPException
+
+STORE_DIR = Path(os.getenv("BLOB_STORE_DIR", Path(__file__).parent / "data" / "blobs"))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_LOGO_BYTES", 375 * 1024))
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+_HASH = re.compile(r"^[0-9a-f]{64}$")
+_SIGNATURES = ((b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"), (b"GIF87a", "image/gif"),
+               (b"GIF89a", "image/gif"), (b"RIFF", "image/webp"))
+
+
+def sniff_type(head: bytes) -> Optional[str]:
+    for magic, mime in _SIGNATURES:
+        if head.startswith(magic) and (mime != "image/webp" or head[8:12] == b"WEBP"): return mime
+    return None
+
+def decode_image(payload: str) -> Tuple[bytes, str]:
+    """Bytes and MIME type of a base64 image (plain or data: URL); 400 if it is not a supported image."""
+    if payload.startswith("data:"): payload = payload.split(",", 1)[-1]
+    try: raw = base64.b64decode(payload, validate=False)
+    except (binascii.Error, ValueError): raise HTTPException(400, "Logo is not valid base64")
+    if len(raw) > MAX_IMAGE_BYTES: raise HTTPException(400, f"Image too large (max {MAX_IMAGE_BYTES // 1024}KB)")
+    mime = sniff_type(raw[:16])
+    if not mime: raise HTTPException(400, "Logo must be a PNG, JPEG, GIF or WebP image")
+    return raw, mime
+
+def is_hash(digest: str) -> bool:
+    return bool(_HASH.match(digest or ""))
+
+def path_for(digest: str) -> Path:
+    return STORE_DIR / digest[:2] / digest
+
+def _write(digest: str, raw: bytes):
+    path = path_for(digest)
+    if path.exists(): return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{digest}.{os.getpid()}.tmp")
+    tmp.write_bytes(raw)
+    os.replace(tmp, path)  # atomic: readers never see a partial file
+
+async def put(raw: bytes) -> str:
+    digest = hashlib.sha256(raw).hexdigest()
+    await asyncio.to_thread(_write, digest, raw)
+    return digest
+
+async def store_image(payload: str) -> str:
+    raw, _ = decode_image(payload)
+    return await put(raw)
+
+def _stat(digest: str) -> Optional[Tuple[Path, str]]:
+    path = path_for(digest)
+    try:
+        with open(path, "rb") as f: return path, sniff_type(f.read(16)) or "application/octet-stream"
+    except FileNotFoundError: return None
+
+async def locate(digest: str) -> Optional[Tuple[Path, str]]:
+    """(path, MIME type) of a stored blob, or None."""
+    if not is_hash(digest): return None
+    return await asyncio.to_thread(_stat, digest)
+
+async def move_inline_logos(conn) -> int:
+    """One-off: move base64 logos still inlined in users.logo_url into the store."""
+    rows = await conn.fetch("SELECT id::text,logo_url FROM users WHERE logo_hash IS NULL AND logo_url IS NOT NULL AND logo_url<>'' AND logo_url NOT LIKE 'http%'")
+    moved = 0
+    for r in rows:
+        try: digest = await store_image(r["logo_url"])
+        except HTTPException: continue  # not a decodable image; leave as is
+        await conn.execute("UPDATE users SET logo_hash=$1,logo_url=NULL WHERE id=$2::uuid", digest, r["id"])
+        moved += 1
+    return moved
@@ -0,0 +1,114 @@
+"""
+Double-booking guard for a coach's sessions.
+
+Stored sessions are kept apart by the database (migration 011): a coach's
+live sessions may not overlap, and a violating write fails with an
+exclusion_violation on scheduled_sessions_no_overlap. Series occurrences
+are computed, not stored, so writers also check them here; every writer
+first takes the coach's advisory lock (the one the fallback trigger uses) so
+check and insert happen without a concurrent booking in between. Single
+writes answer a conflict with 409 and the clashing sessions; bulk writes
+flag the conflicting rows and insert the rest.
+"""
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from freebusy import _floating, merge
+from localtime import day_range
+from recurrence import occurrence_dates, occurrence_start, virtual_sessions
+
+LOCK_KEY = 7203116
+SERIES_HORIZON_DAYS = 366  # how far ahead a series write checks its occurrences; later bookings check against the series themselves
+LIVE = "ss.status<>'cancelled' AND NOT ss.overlap_ok"
+
+
+async def lock_coach(conn, coach_id: str):
+    """Serialize bookings for one coach until the transaction ends."""
+    await conn.execute("SELECT pg_advisory_xact_lock($1, hashtext($2))", LOCK_KEY, coach_id)
+
+def _span(at, minutes) -> Tuple[datetime, datetime]:
+    return _floating(at), _floating(at) + timedelta(minutes=minutes or 60)
+
+async def conflicts(conn, coach_id: str, start: datetime, minutes: int) -> List[dict]:
+    """Live sessions and series occurrences of the coach overlapping [start, start + minutes)."""
+    end = start + timedelta(minutes=minutes or 60)
+    rows = await conn.fetch(
+        f"""SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,u.full_name as client_name FROM scheduled_sessions ss
+            LEFT JOIN users u ON ss.client_id=u.id
+            WHERE ss.coach_id=$1::uuid AND {LIVE} AND ss.period && session_period($2,$3) ORDER BY ss.scheduled_at""",
+        coach_id, start, minutes or 60)
+    occ = await virtual_sessions(conn, start.date() - timedelta(days=1), end.date() + timedelta(days=1), coach_id=coach_id)
+    spans = ((v, _span(v["scheduled_at"], v["duration_minutes"])) for v in occ)
+    return [dict(r) for r in rows] + [{k: v[k] for k in ("id", "scheduled_at", "duration_minutes", "client_name")}
+                                      for v, (s, e) in spans if s < end and start < e]
+
+def conflict_error(found: List[dict]) -> HTTPException:
+    return HTTPException(409, {"message": "Overlaps another session", "conflicts": found})
+
+class Busy:
+    """Merged busy intervals of a coach, for checking many candidate times in Python."""
+
+    def __init__(self, intervals):
+        self.intervals = merge(intervals)
+        self.starts = [s for s, _ in self.intervals]
+
+    def overlaps(self, start: datetime, end: datetime) -> bool:
+        i = bisect_right(self.starts, start) - 1
+        if i >= 0 and self.intervals[i][1] > start: return True
+        return i + 1 < len(self.starts) and self.starts[i + 1] < end
+
+    def add(self, start: datetime, end: datetime):
+        """Add an interval that overlaps none already held."""
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start); self.intervals.insert(i, (start, end))
+
+async def series_busy(conn, coach_id: str, start: date, end: date, exclude_series: Optional[str] = None) -> Busy:
+    """Series occurrences of the coach touching days [start, end)."""
+    occ = await virtual_sessions(conn, start - timedelta(days=1), end, coach_id=coach_id)
+    return Busy(_span(v["scheduled_at"], v["duration_minutes"]) for v in occ if v["series_id"] != exclude_series)
+
+async def stored_busy(conn, coach_id: str, start: date, end: date) -> Busy:
+    """Live stored sessions of the coach touching days [start, end)."""
+    lo, hi = day_range(start - timedelta(days=1), end)
+    rows = await conn.fetch(f"SELECT ss.scheduled_at,ss.duration_minutes FROM scheduled_sessions ss WHERE ss.coach_id=$1::uuid AND {LIVE} AND ss.scheduled_at>=$2 AND ss.scheduled_at<$3",
+                            coach_id, lo, hi)
+    return Busy(_span(r["scheduled_at"], r["duration_minutes"]) for r in rows)
+
+async def flag_overlaps(conn, table: str, coach_id: str):
+    """Flag staged sessions (scheduled_at, duration_minutes) that would double-book the coach.
+
+    Rows are taken in row_no order, so of two overlapping rows the later one is
+    flagged; rows already flagged for other reasons don't count. Call under lock_coach().
+    """
+    await conn.execute(f"""UPDATE {table} s SET error='Overlaps an existing session' WHERE s.error IS NULL AND EXISTS (
+                             SELECT 1 FROM scheduled_sessions ss WHERE ss.coach_id=$1::uuid AND {LIVE}
+                             AND ss.period && session_period(s.scheduled_at,s.duration_minutes))""", coach_id)
+    rows = await conn.fetch(f"SELECT row_no,scheduled_at,duration_minutes FROM {table} WHERE error IS NULL ORDER BY row_no")
+    if not rows: return
+    series = await series_busy(conn, coach_id, min(_floating(r["scheduled_at"]) for r in rows).date(),
+                               max(_floating(r["scheduled_at"]) for r in rows).date() + timedelta(days=1))
+    taken, flagged = Busy([]), {}
+    for r in rows:
+        span = _span(r["scheduled_at"], r["duration_minutes"])
+        if series.overlaps(*span): flagged[r["row_no"]] = "Overlaps a recurring session"
+        elif taken.overlaps(*span): flagged[r["row_no"]] = "Overlaps an earlier row"
+        else: taken.add(*span)
+    if flagged:
+        await conn.execute(f"UPDATE {table} s SET error=x.error FROM unnest($1::int[],$2::text[]) x(row_no,error) WHERE s.row_no=x.row_no",
+                           list(flagged), list(flagged.values()))
+
+async def occurrence_clashes(conn, series, holidays=(), since: Optional[date] = None) -> List[date]:
+    """Dates of unmaterialised `series` occurrences overlapping other bookings of its coach.
+
+    Checks from `since` (default the series start) up to SERIES_HORIZON_DAYS
+    later, so an open-ended series is only checked for its first year; a
+    single session booked beyond that is still refused by conflicts().
+    """
+    start = max(series["start_date"], since) if since else series["start_date"]
+    end = min(series["until_date"] + timedelta(days=1) if series["until_date"] else date.max, start + timedelta(days=SERIES_HORIZON_DAYS))
+    busy = [await stored_busy(conn, series["coach_id"], start, end), await series_busy(conn, series["coach_id"], start, end, exclude_series=series["id"])]
+    done = {r["occurrence_date"] for r in await conn.fetch(
+        "SELECT occurrence_date FROM scheduled_sessions WHERE series_id=$1::uuid AND occurrence_date>=$2 AND occurrence_date<$3", series["id"], start, end)}
+    return [d for d in occurrence_dates(series, start, end, holidays)
+            if d not in done and any(b.overlaps(*_span(occurrence_start(series, d), series["duration_minutes"])) for b in busy)]
@@ -0,0 +1,37 @@
+"""
+Set-based bulk ingestion helpers.
+
+Rows are streamed into a temp staging table with COPY, validated there with
+set-based UPDATEs (first failing check wins), then merged into the target
+table with a single INSERT ... SELECT. Call these inside conn.transaction();
+staging tables are dropped on commit.
+"""
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+async def stage_rows(conn, table: str, columns: Dict[str, str], records: Iterable[tuple]):
+    """Create temp `table` (row_no, id, *columns, error) and COPY records into it.
+
+    Each record is (row_no, id, *values) in the order of `columns`.
+    """
+    cols = "".join(f", {name} {typ}" for name, typ in columns.items())
+    await conn.execute(f"CREATE TEMP TABLE {table} (row_no INT PRIMARY KEY, id UUID NOT NULL{cols}, error TEXT) ON COMMIT DROP")
+    await conn.copy_records_to_table(table, records=list(records), columns=["row_no", "id", *columns])
+
+async def flag_rows(conn, table: str, checks: Sequence[Tuple[str, str]], *args):
+    """Apply (sql_condition, message) checks in order; `s` aliases the staging row.
+    Conditions may reference `args` as $2, $3, ..."""
+    for condition, message in checks:
+        n = max((i + 1 for i in range(len(args)) if f"${i + 2}" in condition), default=0)
+        await conn.execute(f"UPDATE {table} s SET error=$1 WHERE s.error IS NULL AND ({condition})", message, *args[:n])
+
+async def flag_missing(conn, table: str, kept_ids: List, message: str):
+    """Flag staged rows that passed validation but were not merged (e.g. ON CONFLICT DO NOTHING)."""
+    await conn.execute(f"UPDATE {table} SET error=$2 WHERE error IS NULL AND id <> ALL($1::uuid[])", kept_ids, message)
+
+async def staged_errors(conn, table: str, label: str) -> List[dict]:
+    rows = await conn.fetch(f"SELECT row_no, {label} AS label, error FROM {table} WHERE error IS NOT NULL ORDER BY row_no")
+    return [row_error(r["row_no"], r["label"], r["error"]) for r in rows]
+
+def row_error(index: int, label, error: str) -> dict:
+    return {"index": index, "label": label, "error": error}
@@ -1,8 +1,22 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Body, Query, Header, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
-import asyncpg, json, os, uuid, hashlib, base64
+import asyncpg, json, os, uuid, base64
+from db import get_db, release_db, init_pool, close_pool
+from migrate import run_migrations
+from bulk import stage_rows, flag_rows, flag_missing, staged_errors, row_error
+import ai_client, ai_context, blobstore, booking, exports, messaging, passwords, progress, reminders, search
+from actions import ATTENDANCE_STATUS, MAX_ACTIONS, run_actions
+from ai_stream import ActionScanner, sse
+from etags import DIRECTORY, conditional
+from freebusy import MAX_COACHES, free_slots
+from counters import read_counters, reconcile, start_reconciler, stop_reconciler
+from localtime import DEFAULT_TIMEZONE, MAX_RANGE_DAYS, valid_timezone, local_now, local_today, day_range, coach_timezone
+from pagination import page_limit, keyset, next_page, after_cursor, decode_cursor, sort_key
+from recurrence import (FREQS, LEGACY_TYPES, LIST_AHEAD_DAYS, SERIES_COLS, is_virtual, parse_virtual_id, series_length, load_series,
+                        virtual_sessions, series_span, occurrences_before, materialize_occurrence, exclude_occurrence, store_lengths)
 from datetime import datetime, timedelta
 
 def parse_dt(s):
@@ -16,68 +30,48 @@ app = FastAPI(title="Coach Platform API", version="4.0")
 app.add_middleware(CORSMiddleware, allow_origins=["https://www.coachme.life","https://coachme.life","https://coachfront49992.z29.web.core.windows.net","https://coachfront49992.z13.web.core.windows.net","http://localhost:3000","http://localhost:5500","http://127.0.0.1:5500"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 router = APIRouter()
 
-DB_CONFIG = dict(
-    host=os.getenv("DB_HOST","coach-db-1770519048.postgres.database.azure.com"),
-    database=os.getenv("DB_NAME","coach_platform"), user=os.getenv("DB_USER","dbadmin"),
-    password=os.getenv("DB_PASSWORD","CoachPlatform2026!SecureDB"),
-    port=int(os.getenv("DB_PORT",5432)),
-    ssl="require" if os.getenv("DB_SSL","true").lower()=="true" else None,
-)
-
-async def get_db():
-    return await asyncpg.connect(**DB_CONFIG)
+async def startup():
+    await init_pool()
+    if os.getenv("RUN_MIGRATIONS","true").lower()=="true":
+        conn = await get_db()
+        try:
+            await run_migrations(conn)
+            await blobstore.move_inline_logos(conn)
+            await store_lengths(conn, missing=True)
+            await reminders.check_window(conn)
+        finally: await release_db(conn)
+    start_reconciler()
+    messaging.start_dispatcher()
+    reminders.start_scheduler()
+
+async def shutdown():
+    await stop_reconciler()
+    await reminders.stop_scheduler()
+    await messaging.stop_dispatcher()
+    await ai_client.close_client()
+    await close_pool()
+
+router.add_event_handler("startup", startup)
+router.add_event_handler("shutdown", shutdown)
 
 ORG_ID = "00000000-0000-0000-0000-000000000001"
+_org_id = None
 
 async def ensure_org(conn):
-    row = await conn.fetchrow("SELECT id::text FROM organizations LIMIT 1")
-    if row: return row["id"]
-    await conn.execute("INSERT INTO organizations (id,name,slug,subscription_tier,is_active,created_at) VALUES ($1::uuid,'CoachMe','coachme','pro',true,NOW()) ON CONFLICT DO NOTHING", ORG_ID)
-    return ORG_ID
-
-async def ensure_tables(conn):
-    """Auto-create tables that may not exist in schema."""
-    await conn.execute("""CREATE TABLE IF NOT EXISTS coach_reviews (
-        id UUID PRIMARY KEY DEFAULT gen_random_uuid(), coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        client_id UUID REFERENCES users(id) ON DELETE SET NULL, client_name VARCHAR(255), client_email VARCHAR(255),
-        rating INT NOT NULL CHECK (rating BETWEEN 1 AND 5), review_text TEXT,
-        is_public BOOLEAN DEFAULT true, is_approved BOOLEAN DEFAULT true, created_at TIMESTAMPTZ DEFAULT NOW())""")
-    await conn.execute("""CREATE TABLE IF NOT EXISTS leads (
-        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-        coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        lead_type VARCHAR(50) NOT NULL DEFAULT 'interest',
-        name VARCHAR(255) NOT NULL, email VARCHAR(255), phone VARCHAR(50),
-        message TEXT, referral_code VARCHAR(100),
-        referred_by_name VARCHAR(255), referred_by_email VARCHAR(255),
-        status VARCHAR(50) DEFAULT 'new', coach_notes TEXT,
-        created_at TIMESTAMPTZ DEFAULT NOW())""")
-    await conn.execute("""CREATE TABLE IF NOT EXISTS coach_availability (
-        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-        coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        working_days JSONB DEFAULT '[1,2,3,4,5]',
-        slots JSONB DEFAULT '[]',
-        updated_at TIMESTAMPTZ DEFAULT NOW(),
-        UNIQUE(coach_id))""")
-    await conn.execute("""CREATE TABLE IF NOT EXISTS coach_holidays (
-        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-        coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        holiday_date DATE NOT NULL,
-        reason VARCHAR(255),
-        created_at TIMESTAMPTZ DEFAULT NOW())""")
-    try: await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS logo_url TEXT")
-    except: pass
-    await conn.execute("""CREATE TABLE IF NOT EXISTS progress_records (
-        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-        org_id UUID, client_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        recorded_by UUID REFERENCES users(id) ON DELETE SET NULL,
-        record_type VARCHAR(50) DEFAULT 'measurement',
-        metrics JSONB DEFAULT '{}', notes TEXT,
-        recorded_at TIMESTAMPTZ DEFAULT NOW(), created_at TIMESTAMPTZ DEFAULT NOW())""")
-    # Allow cancel_requested status in scheduled_sessions
-    try: await conn.execute("ALTER TABLE scheduled_sessions DROP CONSTRAINT IF EXISTS scheduled_sessions_status_check")
-    except: pass
-    try: await conn.execute("ALTER TABLE scheduled_sessions ADD CONSTRAINT scheduled_sessions_status_check CHECK (status IN ('scheduled','confirmed','completed','cancelled','no_show','cancel_requested'))")
-    except: pass
+    """Default org id. The row is seeded by migration 001; resolved once per process."""
+    global _org_id
+    if _org_id: return _org_id
+    row = await conn.fetchrow("SELECT id::text FROM organizations ORDER BY created_at LIMIT 1")
+    if not row:
+        await conn.execute("INSERT INTO organizations (id,name,category,slug,subscription_tier,is_active,created_at) VALUES ($1::uuid,'CoachMe','fitness','coachme','pro',true,NOW()) ON CONFLICT DO NOTHING", ORG_ID)
+    _org_id = row["id"] if row else ORG_ID
+    return _org_id
+
+LOGO_BASE_URL = os.getenv("LOGO_BASE_URL")  # e.g. https://api.coachme.life/api/v1/logos; default: derived from the request
+
+def logo_url(request: Request, digest: Optional[str]) -> Optional[str]:
+    if not digest: return None
+    return f"{LOGO_BASE_URL.rstrip('/')}/{digest}" if LOGO_BASE_URL else str(request.url_for("get_logo", digest=digest))
 
 async def get_coach_id(request_coach_id: Optional[str], conn) -> Optional[str]:
     """Validate coach_id exists in users table. Returns None if invalid."""
@@ -85,62 +79,104 @@ async def get_coach_id(request_coach_id: Optional[str], conn) -> Optional[str]:
     row = await conn.fetchrow("SELECT id::text FROM users WHERE id=$1::uuid AND role='coach' AND is_active=true", request_coach_id)
     return row["id"] if row else None
 
+async def link_client(conn, coach_id: Optional[str], client_id: str):
+    """Record the coach-client relation (coach_clients). No-op without a coach."""
+    if not coach_id: return
+    await conn.execute("INSERT INTO coach_clients (coach_id,client_id) VALUES ($1::uuid,$2::uuid) ON CONFLICT DO NOTHING", coach_id, client_id)
+
+async def upgrade_password(conn, user_id: str, old_hash: str, new_hash: Optional[str]):
+    """Swap in the rehash passwords.verify() returned (legacy SHA-256 / old cost) unless the password changed meanwhile."""
+    if not new_hash: return
+    await conn.execute("UPDATE users SET password_hash=$1 WHERE id=$2::uuid AND password_hash=$3", new_hash, user_id, old_hash)
+
 
 # ==================== AUTH ====================
 class CoachRegister(BaseModel):
     full_name: str; email: str; phone: str; password: Optional[str]=None
     specialization: str="general"; bio: Optional[str]=None; experience_years: int=0
-    logo_base64: Optional[str]=None
+    logo_base64: Optional[str]=None; timezone: Optional[str]=None
 
 class LoginRequest(BaseModel):
     email: str; password: str
 
 @router.post("/coaches/register")
-async def register_coach(data: CoachRegister):
+async def register_coach(data: CoachRegister, request: Request):
     conn = await get_db()
     try:
-        org_id = await ensure_org(conn); await ensure_tables(conn)
-        pw = hashlib.sha256((data.password or "changeme").encode()).hexdigest()
+        if data.timezone and not valid_timezone(data.timezone): raise HTTPException(400, f"Unknown timezone: {data.timezone}")
+        org_id = await ensure_org(conn)
+        pw = await passwords.hash_password(data.password or "changeme")
         meta = json.dumps({"specialization":data.specialization,"bio":data.bio or "","experience_years":data.experience_years})
-        logo_url = None
-        if data.logo_base64:
-            # Store base64 logo in metadata (or could store in blob storage)
-            logo_url = data.logo_base64[:500000]  # Max ~375KB image
+        logo_hash = await blobstore.store_image(data.logo_base64) if data.logo_base64 else None
         row = await conn.fetchrow(
-            """INSERT INTO users (primary_org_id,full_name,email,phone,role,password_hash,is_active,is_verified,metadata,logo_url,created_at)
-               VALUES ($1,$2,$3,$4,'coach',$5,true,true,$6::jsonb,$7,NOW()) RETURNING id::text,full_name,email,phone,metadata,logo_url,created_at::text""",
-            org_id, data.full_name, data.email, data.phone, pw, meta, logo_url)
-        return {"success":True,"coach":dict(row),"message":"Coach registered successfully"}
+            """INSERT INTO users (primary_org_id,full_name,email,phone,role,password_hash,is_active,is_verified,metadata,logo_hash,timezone,created_at)
+               VALUES ($1,$2,$3,$4,'coach',$5,true,true,$6::jsonb,$7,$8,NOW()) RETURNING id::text,full_name,email,phone,metadata,logo_hash,timezone,created_at::text""",
+            org_id, data.full_name, data.email, data.phone, pw, meta, logo_hash, data.timezone)
+        coach = dict(row); coach["logo_url"] = logo_url(request, coach.pop("logo_hash"))
+        return {"success":True,"coach":coach,"message":"Coach registered successfully"}
+    except HTTPException: raise
     except asyncpg.UniqueViolationError: raise HTTPException(400, "Email or phone already exists")
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/auth/login")
-async def login(data: LoginRequest):
+async def login(data: LoginRequest, request: Request):
     conn = await get_db()
     try:
-        pw = hashlib.sha256(data.password.encode()).hexdigest()
-        row = await conn.fetchrow(
-            "SELECT id::text,full_name,email,phone,role,metadata,logo_url,created_at::text FROM users WHERE email=$1 AND password_hash=$2 AND is_active=true",
-            data.email, pw)
+        rows = await conn.fetch(
+            "SELECT id::text,full_name,email,phone,role,metadata,logo_hash,password_hash,created_at::text FROM users WHERE email=$1 AND is_active=true",
+            data.email)
+        row = None
+        for r in rows or [None]:
+            ok, new_hash = await passwords.verify(data.password, r and r["password_hash"])
+            if ok: row = r; break
         if not row: raise HTTPException(401, "Invalid email or password")
-        return {"success":True,"user":dict(row),"message":f"Welcome back, {row['full_name']}!"}
+        await upgrade_password(conn, row["id"], row["password_hash"], new_hash)
+        user = dict(row); user["logo_url"] = logo_url(request, user.pop("logo_hash")); del user["password_hash"]
+        return {"success":True,"user":user,"message":f"Welcome back, {row['full_name']}!"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/coaches/{cid}/logo")
-async def upload_logo(cid: str, data: dict = Body(...)):
-    """Upload coach logo as base64."""
+async def upload_logo(cid: str, request: Request, data: dict = Body(...)):
+    """Upload coach logo as base64; stored once by content hash, served from /logos/{hash}."""
     conn = await get_db()
     try:
-        logo = data.get("logo_base64", "")
-        if len(logo) > 500000: raise HTTPException(400, "Image too large (max ~375KB)")
-        await conn.execute("UPDATE users SET logo_url=$1 WHERE id=$2::uuid AND role='coach'", logo, cid)
-        return {"success":True,"message":"Logo uploaded"}
+        if not data.get("logo_base64"): raise HTTPException(400, "logo_base64 required")
+        digest = await blobstore.store_image(data["logo_base64"])
+        await conn.execute("UPDATE users SET logo_hash=$1,logo_url=NULL WHERE id=$2::uuid AND role='coach'", digest, cid)
+        return {"success":True,"message":"Logo uploaded","logo_url":logo_url(request, digest)}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+
+@router.put("/coaches/{cid}/timezone")
+async def set_timezone(cid: str, data: dict = Body(...)):
+    """Set the coach's IANA timezone (e.g. "Europe/London"); null resets to the default."""
+    conn = await get_db()
+    try:
+        tz = data.get("timezone")
+        if tz is not None and not valid_timezone(tz): raise HTTPException(400, f"Unknown timezone: {tz}")
+        row = await conn.fetchrow("UPDATE users SET timezone=$1 WHERE id=$2::uuid AND role='coach' RETURNING id::text", tz, cid)
+        if not row: raise HTTPException(404, "Coach not found")
+        return {"success":True,"timezone":tz or DEFAULT_TIMEZONE}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+
+@router.get("/logos/{digest}", name="get_logo")
+async def get_logo(digest: str, if_none_match: Optional[str] = Header(None)):
+    """Logo bytes by content hash. Immutable, so the hash is the ETag and caches may keep it for a year."""
+    headers = {"ETag": f'"{digest}"', "Cache-Control": blobstore.CACHE_CONTROL}
+    if if_none_match and f'"{digest}"' in [t.strip().removeprefix("W/") for t in if_none_match.split(",")] + ['"*"']:
+        return Response(status_code=304, headers=headers)
+    found = await blobstore.locate(digest)
+    if not found: raise HTTPException(404, "Logo not found")
+    path, mime = found
+    return FileResponse(path, media_type=mime, headers=headers)
 
 
 # ==================== CLIENTS (coach-isolated) ====================
@@ -153,34 +189,43 @@ async def create_client(data: dict = Body(...), x_coach_id: Optional[str] = Head
         meta = {"coach_id": coach_id} if coach_id else {}
         for k in ["goal","type","weight","height","injuries","diet","notes"]:
             if data.get(k): meta[k] = data[k]
-        row = await conn.fetchrow(
-            """INSERT INTO users (primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
-               VALUES ($1,$2,$3,$4,'client',true,true,$5::jsonb,NOW()) RETURNING id::text,full_name as name,email,phone,metadata,created_at::text""",
-            org_id, data.get("name","Unknown"), data.get("email"), data.get("phone"), json.dumps(meta))
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                """INSERT INTO users (primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
+                   VALUES ($1,$2,$3,$4,'client',true,true,$5::jsonb,NOW()) RETURNING id::text,full_name as name,email,phone,metadata,created_at::text""",
+                org_id, data.get("name","Unknown"), data.get("email"), data.get("phone"), json.dumps(meta))
+            await link_client(conn, coach_id, row["id"])
         return {"success":True,"client":dict(row)}
     except asyncpg.UniqueViolationError: raise HTTPException(400, "Client with this email/phone exists")
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.get("/clients")
-async def get_clients(x_coach_id: Optional[str] = Header(None)):
+async def get_clients(request: Request, response: Response, limit: Optional[int]=None, cursor: Optional[str]=None, x_coach_id: Optional[str] = Header(None)):
     conn = await get_db()
     try:
-        coach_id = await get_coach_id(x_coach_id, conn)
+        coach_id = await get_coach_id(x_coach_id, conn); limit = page_limit(limit)
+        if nm := await conditional(conn, request, response, "clients", [("coach", coach_id) if coach_id else ("org", await ensure_org(conn))]): return nm
         if coach_id:
-            rows = await conn.fetch("SELECT id::text,full_name as name,email,phone,metadata,created_at::text FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL AND metadata->>'coach_id'=$1 ORDER BY created_at DESC", coach_id)
+            p = [coach_id]
+            q = keyset("""SELECT u.id::text,u.full_name as name,u.email,u.phone,u.metadata,u.created_at::text,cc.created_at::text as linked_at FROM coach_clients cc JOIN users u ON u.id=cc.client_id
+                          WHERE cc.coach_id=$1::uuid AND u.role='client' AND u.is_active=true AND u.deleted_at IS NULL""", p, "cc.created_at", "cc.client_id", cursor, limit)
+            clients, nxt = next_page(await conn.fetch(q, *p), limit, "linked_at")
         else:
-            rows = await conn.fetch("SELECT id::text,full_name as name,email,phone,metadata,created_at::text FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL ORDER BY created_at DESC")
-        return {"success":True,"clients":[dict(r) for r in rows]}
-    except: return {"success":True,"clients":[]}
-    finally: await conn.close()
+            p = []
+            q = keyset("SELECT id::text,full_name as name,email,phone,metadata,created_at::text FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL", p, "created_at", "id", cursor, limit)
+            clients, nxt = next_page(await conn.fetch(q, *p), limit, "created_at")
+        return {"success":True,"clients":clients,"next_cursor":nxt}
+    except HTTPException: raise
+    except: return {"success":True,"clients":[],"next_cursor":None}
+    finally: await release_db(conn)
 
 @router.delete("/clients/{cid}")
 async def delete_client(cid: str):
     conn = await get_db()
     try: await conn.execute("UPDATE users SET deleted_at=NOW(),is_active=false WHERE id=$1::uuid AND role='client'", cid); return {"success":True}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.put("/clients/{cid}")
 async def update_client(cid: str, data: dict = Body(...)):
@@ -201,7 +246,7 @@ async def update_client(cid: str, data: dict = Body(...)):
         row = await conn.fetchrow(f"UPDATE users SET {','.join(sets)} WHERE id=$1::uuid RETURNING id::text,full_name as name,email,phone,metadata", *vals)
         return {"success": True, "client": dict(row) if row else None}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/clients/bulk-import")
 async def bulk_import_clients(data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
@@ -209,25 +254,42 @@ async def bulk_import_clients(data: dict = Body(...), x_coach_id: Optional[str]
     try:
         org_id = await ensure_org(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
-        meta = json.dumps({"coach_id":coach_id}) if coach_id else "{}"; n=0; errors=[]
-        for c in data.get("clients",[]):
-            try:
-                await conn.execute("INSERT INTO users (primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at) VALUES ($1,$2,$3,$4,'client',true,true,$5::jsonb,NOW())",
-                    org_id, c.get("name",c.get("full_name","Unknown")), c.get("email"), c.get("phone"), meta); n+=1
-            except Exception as ex: errors.append(f"{c.get('name','?')}: {str(ex)[:50]}")
-        msg = f"Imported {n} of {n+len(errors)} clients"
-        if errors: msg += f". Errors: {'; '.join(errors[:3])}"
-        return {"success":True,"message":msg,"imported":n,"errors":len(errors)}
+        meta = json.dumps({"coach_id":coach_id}) if coach_id else "{}"
+        clients = data.get("clients",[]); records, errors = [], []
+        for i, c in enumerate(clients):
+            try: records.append((i, uuid.uuid4(), str(c.get("name") or c.get("full_name") or "Unknown").strip(),
+                                 str(c.get("email") or "").strip() or None, str(c.get("phone") or "").strip() or None))
+            except Exception as ex: errors.append(row_error(i, None, str(ex)[:100]))
+        async with conn.transaction():
+            await stage_rows(conn, "stage_clients", {"name":"TEXT","email":"TEXT","phone":"TEXT"}, records)
+            await flag_rows(conn, "stage_clients", [
+                ("s.email IS NOT NULL AND EXISTS (SELECT 1 FROM stage_clients d WHERE d.email=s.email AND d.row_no<s.row_no)", "Duplicate email in import"),
+                ("s.phone IS NOT NULL AND EXISTS (SELECT 1 FROM stage_clients d WHERE d.phone=s.phone AND d.row_no<s.row_no)", "Duplicate phone in import"),
+                ("EXISTS (SELECT 1 FROM users u WHERE u.email=s.email)", "Email already exists"),
+                ("EXISTS (SELECT 1 FROM users u WHERE u.phone=s.phone)", "Phone already exists"),
+            ])
+            ids = await conn.fetch(
+                """WITH ins AS (INSERT INTO users (id,primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
+                                SELECT id,$1,name,email,phone,'client',true,true,$2::jsonb,NOW() FROM stage_clients WHERE error IS NULL ORDER BY row_no
+                                ON CONFLICT DO NOTHING RETURNING id),
+                        link AS (INSERT INTO coach_clients (coach_id,client_id) SELECT $3::uuid,id FROM ins WHERE $3::uuid IS NOT NULL)
+                   SELECT id FROM ins""", org_id, meta, coach_id)
+            await flag_missing(conn, "stage_clients", [r["id"] for r in ids], "Email or phone already exists")
+            errors += await staged_errors(conn, "stage_clients", "name")
+        n = len(ids); errors.sort(key=lambda e: e["index"])
+        msg = f"Imported {n} of {len(clients)} clients"
+        if errors: msg += ". Errors: " + "; ".join(f"{e['label'] or '?'}: {e['error']}" for e in errors[:3])
+        return {"success":True,"message":msg,"imported":n,"errors":len(errors),"row_errors":errors}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
-
+    finally: await release_db(conn)
 
 # ==================== WORKOUTS (coach-isolated) ====================
 @router.get("/workouts/library")
-async def get_workouts(category: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+async def get_workouts(request: Request, response: Response, category: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
         coach_id = await get_coach_id(x_coach_id, conn)
+        if nm := await conditional(conn, request, response, "workouts", [("coach", coach_id) if coach_id else ("org", await ensure_org(conn))]): return nm
         q = "SELECT id::text,name,description,session_type as category,duration_minutes,created_at::text FROM session_templates WHERE is_active=true AND deleted_at IS NULL"
         p = []
         if coach_id: q += f" AND created_by=${len(p)+1}::uuid"; p.append(coach_id)
@@ -236,7 +298,7 @@ async def get_workouts(category: Optional[str]=None, x_coach_id: Optional[str]=H
         rows = await conn.fetch(q, *p)
         return {"success":True,"workouts":[dict(r) for r in rows]}
     except: return {"success":True,"workouts":[]}
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/workouts/library")
 async def create_workout(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
@@ -252,14 +314,14 @@ async def create_workout(data: dict = Body(...), x_coach_id: Optional[str]=Heade
         return {"success":True,"workout":dict(row)}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.delete("/workouts/{wid}")
 async def delete_workout(wid: str):
     conn = await get_db()
     try: await conn.execute("UPDATE session_templates SET deleted_at=NOW(),is_active=false WHERE id=$1::uuid", wid); return {"success":True}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/workouts/bulk-import")
 async def bulk_import_workouts(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
@@ -268,35 +330,64 @@ async def bulk_import_workouts(data: dict = Body(...), x_coach_id: Optional[str]
         org_id = await ensure_org(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
-        n=0
-        for w in data.get("workouts",[]):
-            try:
-                await conn.execute("INSERT INTO session_templates (org_id,created_by,name,description,session_type,duration_minutes,is_active,created_at) VALUES ($1,$2::uuid,$3,$4,$5,$6,true,NOW())",
-                    org_id, coach_id, w.get("name"), w.get("description",""), w.get("category","strength"), int(w.get("duration_minutes",30))); n+=1
-            except: pass
-        return {"success":True,"message":f"Imported {n} workouts"}
+        workouts = data.get("workouts",[]); records, errors = [], []
+        for i, w in enumerate(workouts):
+            try: records.append((i, uuid.uuid4(), str(w.get("name") or "").strip() or None, w.get("description",""),
+                                 w.get("category","strength"), int(w.get("duration_minutes",30))))
+            except Exception as ex: errors.append(row_error(i, w.get("name") if isinstance(w, dict) else None, f"Invalid row: {str(ex)[:100]}"))
+        async with conn.transaction():
+            await stage_rows(conn, "stage_workouts", {"name":"TEXT","description":"TEXT","category":"TEXT","duration_minutes":"INT"}, records)
+            await flag_rows(conn, "stage_workouts", [
+                ("s.name IS NULL", "Name is required"),
+                ("s.duration_minutes <= 0", "Duration must be positive"),
+            ])
+            n = await conn.fetchval(
+                """WITH ins AS (INSERT INTO session_templates (id,org_id,created_by,name,description,session_type,duration_minutes,is_active,created_at)
+                                SELECT id,$1,$2::uuid,name,description,category,duration_minutes,true,NOW() FROM stage_workouts WHERE error IS NULL ORDER BY row_no
+                                RETURNING 1)
+                   SELECT COUNT(*) FROM ins""", org_id, coach_id)
+            errors += await staged_errors(conn, "stage_workouts", "name")
+        errors.sort(key=lambda e: e["index"])
+        return {"success":True,"message":f"Imported {n} workouts","imported":n,"errors":len(errors),"row_errors":errors}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
-
+    finally: await release_db(conn)
 
 # ==================== SESSIONS (coach-isolated) ====================
 @router.get("/sessions")
-async def get_sessions(client_id: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+async def get_sessions(request: Request, response: Response, client_id: Optional[str]=None, limit: Optional[int]=None, cursor: Optional[str]=None,
+                       x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
-        coach_id = await get_coach_id(x_coach_id, conn)
+        coach_id = await get_coach_id(x_coach_id, conn); limit = page_limit(limit)
+        today = local_today(await coach_timezone(conn, coach_id)) if coach_id or client_id else None
+        # open-ended series are listed to LIST_AHEAD_DAYS past the coach's today, so the date is part of the validator
+        if nm := await conditional(conn, request, response, "sessions", [("coach", coach_id) if coach_id else ("org", await ensure_org(conn))],
+                                   extra=[today]): return nm
         q = """SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.notes,ss.coach_id::text,ss.client_id::text,ss.location,ss.cancelled_reason,
                       u.full_name as client_name,st.name as workout_name FROM scheduled_sessions ss
                LEFT JOIN users u ON ss.client_id=u.id LEFT JOIN session_templates st ON ss.session_template_id=st.id WHERE 1=1"""
         p = []
         if coach_id: q += f" AND ss.coach_id=${len(p)+1}::uuid"; p.append(coach_id)
         if client_id: q += f" AND ss.client_id=${len(p)+1}::uuid"; p.append(client_id)
-        q += " ORDER BY ss.scheduled_at DESC LIMIT 200"
-        rows = await conn.fetch(q, *p)
-        return {"success":True,"sessions":[dict(r) for r in rows]}
-    except: return {"success":True,"sessions":[]}
-    finally: await conn.close()
+        q = keyset(q, p, "ss.scheduled_at", "ss.id", cursor, limit)
+        rows = [dict(r) for r in await conn.fetch(q, *p)]
+        if coach_id or client_id:
+            # occurrences from the cursor back to the oldest stored row of the page (all the way if stored rows ran out);
+            # bounded series to their last date, open-ended ones to the horizon
+            first, last = await series_span(conn, coach_id, client_id)
+            horizon, after = today + timedelta(days=LIST_AHEAD_DAYS), decode_cursor(cursor)
+            end = max(horizon, last + timedelta(days=1)) if last else horizon
+            if after: end = min(end, after[0].date() + timedelta(days=1))
+            floor = datetime.fromisoformat(rows[-1]["scheduled_at"]).date() if len(rows) > limit else first
+            virtual = await occurrences_before(conn, end, floor, limit + 1, lambda v: after_cursor(v, cursor, "scheduled_at"),
+                                               horizon=horizon, coach_id=coach_id, client_id=client_id)
+            rows = sorted(rows + virtual, key=sort_key("scheduled_at"), reverse=True)[:limit + 1]
+        sessions, nxt = next_page(rows, limit, "scheduled_at")
+        return {"success":True,"sessions":sessions,"next_cursor":nxt}
+    except HTTPException: raise
+    except: return {"success":True,"sessions":[],"next_cursor":None}
+    finally: await release_db(conn)
 
 @router.post("/sessions")
 async def create_session(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
@@ -306,105 +397,268 @@ async def create_session(data: dict = Body(...), x_coach_id: Optional[str]=Heade
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
         tid = data.get("template_id") or data.get("workout_id") or None
-        row = await conn.fetchrow(
-            "INSERT INTO scheduled_sessions (org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,location,created_at) VALUES ($1,$2::uuid,$3::uuid,$4,$5,$6,'scheduled',$7,NOW()) RETURNING id::text,scheduled_at::text,status",
-            org_id, coach_id, data["client_id"], tid, parse_dt(data["scheduled_at"]), data.get("duration_minutes",60), data.get("location","offline"))
+        at, minutes = parse_dt(data["scheduled_at"]), data.get("duration_minutes",60)
+        async with conn.transaction():
+            await booking.lock_coach(conn, coach_id)
+            found = await booking.conflicts(conn, coach_id, at, minutes)
+            if found: raise booking.conflict_error(found)
+            row = await conn.fetchrow(
+                "INSERT INTO scheduled_sessions (org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,location,created_at) VALUES ($1,$2::uuid,$3::uuid,$4,$5,$6,'scheduled',$7,NOW()) RETURNING id::text,scheduled_at::text,status",
+                org_id, coach_id, data["client_id"], tid, at, minutes, data.get("location","offline"))
         return {"success":True,"session":dict(row)}
     except HTTPException: raise
+    except asyncpg.ExclusionViolationError: raise booking.conflict_error([])
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+def parse_series_rule(data: dict, creating: bool = False) -> dict:
+    """Series rule fields present in a request body. On create, the legacy recurrence_type
+    (daily = weekdays only, weekly, biweekly, monthly) supplies freq/interval/weekdays."""
+    freq, interval, weekdays = LEGACY_TYPES.get(data.get("recurrence_type"), ("weekly", 1, None)) if creating else (None, 1, None)
+    rule = {}
+    if creating or "freq" in data: rule["freq"] = data.get("freq") or freq
+    if creating or "interval" in data: rule["freq_interval"] = int(data.get("interval") or interval)
+    if creating or "by_weekday" in data: rule["by_weekday"] = [int(d) for d in data["by_weekday"]] if data.get("by_weekday") else weekdays
+    if creating or "time" in data: rule["start_time"] = datetime.strptime((data.get("time") or "09:00")[:5], "%H:%M").time()
+    if "until" in data: rule["until_date"] = parse_dt(data["until"]).date() if data["until"] else None
+    if "count" in data or "num_sessions" in data:
+        n = data["count"] if "count" in data else data["num_sessions"]
+        rule["occurrence_count"] = int(n) if n else None
+    for k in ("duration_minutes","location","skip_holidays"):
+        if k in data: rule[k] = data[k]
+    if "template_id" in data or "workout_id" in data: rule["session_template_id"] = data.get("template_id") or data.get("workout_id") or None
+    if "freq" in rule and rule["freq"] not in FREQS: raise HTTPException(400, "freq must be daily, weekly or monthly")
+    if rule.get("freq_interval", 1) < 1: raise HTTPException(400, "interval must be at least 1")
+    if any(d < 1 or d > 7 for d in rule.get("by_weekday") or []): raise HTTPException(400, "by_weekday uses ISO weekdays 1 (Mon) to 7 (Sun)")
+    return rule
 
 @router.post("/sessions/create-recurring")
 async def create_recurring(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
+    """Create a recurring series. Stored as one session_series row; occurrences are expanded on read.
+    Occurrences in the first booking.SERIES_HORIZON_DAYS that overlap other sessions give a 409, or with
+    skip_conflicts are left out of the series."""
     conn = await get_db()
     try:
         org_id = await ensure_org(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
-        start = datetime.strptime(data["start_date"],"%Y-%m-%d")
-        h,m = map(int, data.get("time","09:00").split(":")); num = data.get("num_sessions",4); dur = data.get("duration_minutes",60)
-        rec = data.get("recurrence_type","weekly")
-        deltas = {"daily":timedelta(days=1),"weekly":timedelta(weeks=1),"biweekly":timedelta(weeks=2),"monthly":timedelta(days=30)}
-        delta = deltas.get(rec, timedelta(weeks=1)); n=0
-        for i in range(num):
-            dt = (start + delta*i).replace(hour=h,minute=m)
-            # Skip weekends if daily
-            if rec == "daily" and dt.weekday() >= 5:
-                start += timedelta(days=1); continue  # adjust start to skip
-            await conn.execute("INSERT INTO scheduled_sessions (org_id,coach_id,client_id,scheduled_at,duration_minutes,status,created_at) VALUES ($1,$2::uuid,$3::uuid,$4,$5,'scheduled',NOW())",
-                org_id, coach_id, data["client_id"], dt, dur); n+=1
-        return {"success":True,"message":f"Created {n} {rec} sessions"}
+        rule = {"duration_minutes": 60, "location": None, "skip_holidays": True, "until_date": None, "occurrence_count": None,
+                "session_template_id": None, **parse_series_rule(data, creating=True)}
+        rec = data.get("recurrence_type") or rule["freq"]
+        async with conn.transaction():
+            await booking.lock_coach(conn, coach_id)
+            row = await conn.fetchrow(
+                f"""INSERT INTO session_series (org_id,coach_id,client_id,start_date,{','.join(rule)})
+                    VALUES ($1,$2::uuid,$3::uuid,$4,{','.join(f'${i+5}' for i in range(len(rule)))}) RETURNING id::text""",
+                org_id, coach_id, data["client_id"], parse_dt(data["start_date"]).date(), *rule.values())
+            series = await load_series(conn, row["id"])
+            hol = [r["holiday_date"] for r in await conn.fetch("SELECT holiday_date FROM coach_holidays WHERE coach_id=$1::uuid AND holiday_date>=$2", coach_id, series["start_date"])]
+            # skip_conflicts leaves clashing dates out of the series; otherwise nothing is created
+            clashes = await booking.occurrence_clashes(conn, series, hol)
+            if clashes and not data.get("skip_conflicts"):
+                raise HTTPException(409, {"message": f"{len(clashes)} occurrences overlap other sessions", "dates": [d.isoformat() for d in clashes]})
+            if clashes:
+                await conn.execute("UPDATE session_series SET exdates=exdates || $2::date[] WHERE id=$1::uuid", row["id"], clashes)
+                series = await load_series(conn, row["id"])
+            await store_lengths(conn, series_ids=[row["id"]])
+        n = series_length(series, hol)
+        msg = f"Created {n} {rec} sessions" if n is not None else f"Created {rec} series"
+        return {"success":True,"message":msg,"series":dict(series),"occurrences":n,"skipped":[d.isoformat() for d in clashes]}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+@router.get("/sessions/series")
+async def get_series(client_id: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: return {"success":True,"series":[]}
+        q = f"SELECT {SERIES_COLS},u.full_name as client_name FROM session_series ser LEFT JOIN users u ON ser.client_id=u.id WHERE ser.coach_id=$1::uuid AND ser.status='active'"
+        p = [coach_id]
+        if client_id: q += " AND ser.client_id=$2::uuid"; p.append(client_id)
+        rows = await conn.fetch(q + " ORDER BY ser.start_date DESC", *p)
+        return {"success":True,"series":[dict(r) for r in rows]}
+    except: return {"success":True,"series":[]}
+    finally: await release_db(conn)
+
+@router.patch("/sessions/series/{series_id}")
+async def update_series(series_id: str, data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
+    """Change a whole series (time, duration, weekdays, until/count, ...). Materialised occurrences keep their own values.
+    A change to when it runs is checked like create_recurring, for occurrences from the coach's today on."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        rule = parse_series_rule(data)
+        if not rule: raise HTTPException(400, "Nothing to update")
+        sets = ",".join(f"{k}=${i+3}" for i, k in enumerate(rule))
+        clashes = []
+        async with conn.transaction():
+            await booking.lock_coach(conn, coach_id)
+            row = await conn.fetchrow(f"UPDATE session_series SET {sets} WHERE id=$1::uuid AND coach_id=$2::uuid RETURNING id::text", series_id, coach_id, *rule.values())
+            if not row: raise HTTPException(404, "Series not found")
+            series = await load_series(conn, series_id)
+            if series["status"] == "active" and rule.keys() - {"location", "session_template_id"}:
+                today = local_today(await coach_timezone(conn, coach_id))
+                hol = [r["holiday_date"] for r in await conn.fetch("SELECT holiday_date FROM coach_holidays WHERE coach_id=$1::uuid AND holiday_date>=$2", coach_id, today)]
+                clashes = await booking.occurrence_clashes(conn, series, hol, since=today)
+                if clashes and not data.get("skip_conflicts"):
+                    raise HTTPException(409, {"message": f"{len(clashes)} occurrences overlap other sessions", "dates": [d.isoformat() for d in clashes]})
+                if clashes:
+                    await conn.execute("UPDATE session_series SET exdates=exdates || $2::date[] WHERE id=$1::uuid", series_id, clashes)
+                    series = await load_series(conn, series_id)
+            await store_lengths(conn, series_ids=[series_id])
+        return {"success":True,"series":dict(series),"skipped":[d.isoformat() for d in clashes]}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+@router.delete("/sessions/series/{series_id}")
+async def end_series(series_id: str, from_date: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+    """Cancel a series, or end it before `from_date`. Materialised occurrences are kept."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        if from_date:
+            r = await conn.execute("UPDATE session_series SET until_date=$3::date-1 WHERE id=$1::uuid AND coach_id=$2::uuid", series_id, coach_id, parse_dt(from_date).date())
+            if not r.endswith(" 0"): await store_lengths(conn, series_ids=[series_id])
+        else:
+            r = await conn.execute("UPDATE session_series SET status='cancelled' WHERE id=$1::uuid AND coach_id=$2::uuid", series_id, coach_id)
+        if r.endswith(" 0"): raise HTTPException(404, "Series not found")
+        return {"success":True}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+@router.get("/sessions/series/{series_id}/occurrences")
+async def series_occurrences(series_id: str, from_: str = Query(..., alias="from"), to: str = Query(...), x_coach_id: Optional[str]=Header(None)):
+    """Occurrences of one series in [from, to): materialised rows plus computed ones."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        start, end = parse_dt(from_).date(), parse_dt(to).date()
+        rows = await conn.fetch(
+            """SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.notes,ss.coach_id::text,ss.client_id::text,ss.location,ss.cancelled_reason,
+                      ss.series_id::text,ss.occurrence_date FROM scheduled_sessions ss
+               WHERE ss.series_id=$1::uuid AND ss.coach_id=$2::uuid AND ss.occurrence_date>=$3 AND ss.occurrence_date<$4""", series_id, coach_id, start, end)
+        occ = [dict(r) for r in rows] + await virtual_sessions(conn, start, end, coach_id=coach_id, series_id=series_id)
+        return {"success":True,"occurrences":sorted(occ, key=lambda s: s["scheduled_at"])}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+async def resolve_session(conn, sid: str) -> str:
+    """Real scheduled_sessions id for `sid`, materialising a virtual series occurrence."""
+    if not is_virtual(sid): return sid
+    real = await materialize_occurrence(conn, sid)
+    if not real: raise HTTPException(404, "Session not found")
+    return real
 
 @router.delete("/sessions/{sid}")
 async def delete_session(sid: str):
     conn = await get_db()
-    try: await conn.execute("DELETE FROM scheduled_sessions WHERE id=$1::uuid", sid); return {"success":True}
+    try:
+        if is_virtual(sid): await exclude_occurrence(conn, *parse_virtual_id(sid))
+        else:
+            async with conn.transaction():
+                row = await conn.fetchrow("DELETE FROM scheduled_sessions WHERE id=$1::uuid RETURNING series_id::text,occurrence_date", sid)
+                # keep a deleted series occurrence from reappearing as a computed one
+                if row and row["series_id"]: await exclude_occurrence(conn, row["series_id"], row["occurrence_date"])
+        return {"success":True}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/sessions/{sid}/mark-attendance")
 async def mark_attendance(sid: str, data: dict = Body(...)):
     conn = await get_db()
     try:
-        m = {"attended":"confirmed","present":"confirmed","absent":"no_show","no_show":"no_show","completed":"completed"}
-        new_status = m.get(data.get("status",""), data.get("status","no_show"))
+        new_status = ATTENDANCE_STATUS.get(data.get("status",""), data.get("status","no_show"))
+        sid = await resolve_session(conn, sid)
         await conn.execute("UPDATE scheduled_sessions SET status=$1 WHERE id=$2::uuid", new_status, sid)
-        return {"success":True,"new_status":new_status}
+        return {"success":True,"new_status":new_status,"session_id":sid}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/sessions/{sid}/start")
 async def start_session(sid: str):
     conn = await get_db()
     try:
+        sid = await resolve_session(conn, sid)
         await conn.execute("UPDATE scheduled_sessions SET status='in_progress' WHERE id=$1::uuid", sid)
         s = await conn.fetchrow("SELECT ss.*,st.name as wn,st.structure as ws FROM scheduled_sessions ss LEFT JOIN session_templates st ON ss.session_template_id=st.id WHERE ss.id=$1::uuid", sid)
         w = None
         if s and s.get("ws"): w = {"name":s["wn"],"structure":json.loads(s["ws"]) if isinstance(s["ws"],str) else s["ws"]}
-        return {"success":True,"workout":w}
+        return {"success":True,"workout":w,"session_id":sid}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/sessions/{sid}/complete")
 async def complete_session(sid: str, data: dict = Body(...)):
     conn = await get_db()
     try:
         meta = json.dumps({"exercises_completed":data.get("exercises_completed",[])})
+        sid = await resolve_session(conn, sid)
         await conn.execute("UPDATE scheduled_sessions SET status='completed',completed_at=NOW(),notes=$1,metadata=$2::jsonb WHERE id=$3::uuid", data.get("notes",""), meta, sid)
-        return {"success":True}
+        return {"success":True,"session_id":sid}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/sessions/{sid}/cancel")
 async def cancel_session(sid: str, data: dict = Body(...)):
     conn = await get_db()
-    try: await conn.execute("UPDATE scheduled_sessions SET status='cancelled',cancelled_reason=$1,cancelled_at=NOW() WHERE id=$2::uuid", data.get("reason",""), sid); return {"success":True}
+    try:
+        sid = await resolve_session(conn, sid)
+        await conn.execute("UPDATE scheduled_sessions SET status='cancelled',cancelled_reason=$1,cancelled_at=NOW() WHERE id=$2::uuid", data.get("reason",""), sid)
+        return {"success":True,"session_id":sid}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+async def schedule_sessions(conn, start, end, coach_id: Optional[str] = None, client_id: Optional[str] = None) -> list:
+    """Sessions on local days [start, end), oldest first, with series occurrences merged in.
+    A plain range on scheduled_at so the (coach_id|client_id, scheduled_at) indexes apply."""
+    lo, hi = day_range(start, end)
+    q = """SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.notes,ss.coach_id::text,ss.client_id::text,ss.location,ss.cancelled_reason,
+                  u.full_name as client_name,st.name as workout_name FROM scheduled_sessions ss
+           LEFT JOIN users u ON ss.client_id=u.id LEFT JOIN session_templates st ON ss.session_template_id=st.id
+           WHERE ss.scheduled_at>=$1 AND ss.scheduled_at<$2"""
+    p = [lo, hi]
+    if coach_id: q += f" AND ss.coach_id=${len(p)+1}::uuid"; p.append(coach_id)
+    if client_id: q += f" AND ss.client_id=${len(p)+1}::uuid"; p.append(client_id)
+    rows = [dict(r) for r in await conn.fetch(q + " ORDER BY ss.scheduled_at,ss.id", *p)]
+    return sorted(rows + await virtual_sessions(conn, start, end, coach_id=coach_id, client_id=client_id), key=sort_key("scheduled_at"))
 
 @router.get("/schedule/today")
 async def get_today(x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
         coach_id = await get_coach_id(x_coach_id, conn)
-        # Use IST for "today" since users are in India
-        from datetime import timezone, timedelta
-        ist = timezone(timedelta(hours=5, minutes=30))
-        today = datetime.now(ist).strftime("%Y-%m-%d")
-        q = """SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.notes,ss.coach_id::text,ss.client_id::text,ss.location,ss.cancelled_reason,
-                      u.full_name as client_name,st.name as workout_name FROM scheduled_sessions ss
-               LEFT JOIN users u ON ss.client_id=u.id LEFT JOIN session_templates st ON ss.session_template_id=st.id
-               WHERE ss.scheduled_at::date=$1::date"""
-        p = [today]
-        if coach_id: q += " AND ss.coach_id=$2::uuid"; p.append(coach_id)
-        q += " ORDER BY ss.scheduled_at ASC"
-        rows = await conn.fetch(q, *p)
-        return {"success":True,"sessions":[dict(r) for r in rows]}
+        tz = await coach_timezone(conn, coach_id)
+        today = local_today(tz)
+        return {"success":True,"date":today.isoformat(),"timezone":tz,"sessions":await schedule_sessions(conn, today, today + timedelta(days=1), coach_id=coach_id)}
     except: return {"success":True,"sessions":[]}
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+@router.get("/schedule")
+async def get_schedule(from_: str = Query(..., alias="from"), to: str = Query(...), client_id: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+    """Sessions on local days [from, to) (YYYY-MM-DD, `to` exclusive), oldest first."""
+    try: start, end = datetime.strptime(from_, "%Y-%m-%d").date(), datetime.strptime(to, "%Y-%m-%d").date()
+    except ValueError: raise HTTPException(400, "from and to must be YYYY-MM-DD")
+    if end <= start: raise HTTPException(400, "to must be after from")
+    if (end - start).days > MAX_RANGE_DAYS: raise HTTPException(400, f"Range is limited to {MAX_RANGE_DAYS} days")
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        return {"success":True,"from":from_,"to":to,"sessions":await schedule_sessions(conn, start, end, coach_id=coach_id, client_id=client_id)}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 @router.post("/schedule/bulk-plan")
 async def bulk_plan(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
@@ -413,37 +667,44 @@ async def bulk_plan(data: dict = Body(...), x_coach_id: Optional[str]=Header(Non
         org_id = await ensure_org(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
-        n=0
-        for s in data.get("sessions",[]):
-            try:
-                await conn.execute("INSERT INTO scheduled_sessions (org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,created_at) VALUES ($1,$2::uuid,$3::uuid,$4,$5,$6,'scheduled',NOW())",
-                    org_id, coach_id, s["client_id"], s.get("workout_id") or None, parse_dt(s["scheduled_at"]), s.get("duration_minutes",60)); n+=1
-            except: pass
-        return {"success":True,"message":f"Planned {n} sessions"}
+        sessions = data.get("sessions",[]); records, errors = [], []
+        for i, x in enumerate(sessions):
+            try: records.append((i, uuid.uuid4(), uuid.UUID(str(x["client_id"])), uuid.UUID(str(x["workout_id"])) if x.get("workout_id") else None,
+                                 parse_dt(x["scheduled_at"]), int(x.get("duration_minutes",60))))
+            except Exception as ex: errors.append(row_error(i, x.get("scheduled_at") if isinstance(x, dict) else None, f"Invalid row: {str(ex)[:100]}"))
+        async with conn.transaction():
+            await booking.lock_coach(conn, coach_id)
+            await stage_rows(conn, "stage_sessions", {"client_id":"UUID","template_id":"UUID","scheduled_at":"TIMESTAMPTZ","duration_minutes":"INT"}, records)
+            await flag_rows(conn, "stage_sessions", [
+                ("NOT EXISTS (SELECT 1 FROM users u WHERE u.id=s.client_id AND u.role='client')", "Client not found"),
+                ("s.template_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM session_templates t WHERE t.id=s.template_id)", "Workout not found"),
+                ("s.duration_minutes <= 0", "Duration must be positive"),
+            ])
+            await booking.flag_overlaps(conn, "stage_sessions", coach_id)
+            n = await conn.fetchval(
+                """WITH ins AS (INSERT INTO scheduled_sessions (id,org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,created_at)
+                                SELECT id,$1,$2::uuid,client_id,template_id,scheduled_at,duration_minutes,'scheduled',NOW() FROM stage_sessions WHERE error IS NULL ORDER BY row_no
+                                RETURNING 1)
+                   SELECT COUNT(*) FROM ins""", org_id, coach_id)
+            errors += await staged_errors(conn, "stage_sessions", "scheduled_at::text")
+        errors.sort(key=lambda e: e["index"])
+        return {"success":True,"message":f"Planned {n} sessions","planned":n,"errors":len(errors),"row_errors":errors}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
-
+    finally: await release_db(conn)
 
 # ==================== DASHBOARD (coach-isolated) ====================
 @router.get("/dashboard/stats")
 async def stats(x_coach_id: Optional[str]=Header(None)):
+    """Counts from dashboard_counters. total_sessions includes every occurrence of a bounded series;
+    open-ended series are left out."""
     conn = await get_db()
     try:
         coach_id = await get_coach_id(x_coach_id, conn)
-        if coach_id:
-            cl = await conn.fetchval("SELECT COUNT(*) FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL AND metadata->>'coach_id'=$1", coach_id)
-            se = await conn.fetchval("SELECT COUNT(*) FROM scheduled_sessions WHERE coach_id=$1::uuid", coach_id)
-            co = await conn.fetchval("SELECT COUNT(*) FROM scheduled_sessions WHERE coach_id=$1::uuid AND status IN ('completed','confirmed')", coach_id)
-            wo = await conn.fetchval("SELECT COUNT(*) FROM session_templates WHERE created_by=$1::uuid AND is_active=true AND deleted_at IS NULL", coach_id)
-        else:
-            cl = await conn.fetchval("SELECT COUNT(*) FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL")
-            se = await conn.fetchval("SELECT COUNT(*) FROM scheduled_sessions")
-            co = await conn.fetchval("SELECT COUNT(*) FROM scheduled_sessions WHERE status IN ('completed','confirmed')")
-            wo = await conn.fetchval("SELECT COUNT(*) FROM session_templates WHERE is_active=true AND deleted_at IS NULL")
-        return {"success":True,"stats":{"total_clients":cl,"total_sessions":se,"completed_sessions":co,"total_workouts":wo}}
+        c = await read_counters(conn, "coach", coach_id) if coach_id else await read_counters(conn, "org", await ensure_org(conn))
+        return {"success":True,"stats":{"total_clients":c["clients"],"total_sessions":c["sessions"],"completed_sessions":c["completed_sessions"],"total_workouts":c["workouts"]}}
     except: return {"success":True,"stats":{"total_clients":0,"total_sessions":0,"completed_sessions":0,"total_workouts":0}}
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 
 # ==================== PROGRESS ====================
@@ -452,19 +713,88 @@ async def upload_progress(data: dict = Body(...)):
     conn = await get_db()
     try:
         org_id = await ensure_org(conn)
-        await ensure_tables(conn)
         await conn.execute("INSERT INTO progress_records (org_id,client_id,recorded_by,record_type,metrics,notes,recorded_at,created_at) VALUES ($1,$2::uuid,$2::uuid,$3,$4::jsonb,$5,$6,NOW())",
             org_id, data["client_id"], data.get("type","measurement"),
             json.dumps({"weight":data.get("weight"),"measurements":data.get("measurements",{})}),
             data.get("notes",""), parse_dt(data.get("date",datetime.now().strftime("%Y-%m-%d"))))
         return {"success":True}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+@router.post("/progress/import")
+async def import_progress(request: Request, format: Optional[str] = None, client_id: Optional[str] = None, columns: Optional[str] = None,
+                          x_coach_id: Optional[str] = Header(None)):
+    """Stream a CSV (header row) or NDJSON body of progress rows; Content-Encoding: gzip is accepted.
+    Each row needs a date and a client (client_id or client_email column, else the `client_id` parameter);
+    other columns are metrics ("measurements.waist" nests). `columns` is a JSON object renaming columns, "" to skip one."""
+    ctype = request.headers.get("content-type", "")
+    fmt = format or ("ndjson" if "ndjson" in ctype or "jsonl" in ctype else "csv")
+    if fmt not in progress.FORMATS: raise HTTPException(400, f"format must be one of {', '.join(progress.FORMATS)}")
+    try: renames = json.loads(columns) if columns else {}
+    except ValueError: raise HTTPException(400, "columns must be a JSON object")
+    if not isinstance(renames, dict) or not all(isinstance(v, str) for v in renames.values()):
+        raise HTTPException(400, "columns must map column names to metric names")
+    conn = await get_db()
+    try:
+        org_id = await ensure_org(conn)
+        coach_id = await get_coach_id(x_coach_id, conn)
+    finally: await release_db(conn)
+    if not coach_id: raise HTTPException(400, "Valid coach ID required")
+    try:
+        s = await progress.import_records(request.stream(), fmt, coach_id, org_id, client_id, renames,
+                                          gzipped=request.headers.get("content-encoding", "").lower() == "gzip")
+        return {"success":True,"message":f"Imported {s['imported']} of {s['rows']} rows",**s}
+    except progress.ImportFormatError as e: raise HTTPException(400, {"message":str(e),**e.summary})
+    except Exception as e: raise HTTPException(500, str(e))
 
 
 # ==================== REMINDERS ====================
 @router.post("/reminders/send")
-async def send_reminders(data: dict = Body(...)): return {"success":True,"message":"Reminders sent (demo)"}
+async def send_reminders(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
+    """Queue an immediate reminder to the client of each of `session_ids` (sent by the message_queue dispatcher)."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        method = data.get("method") or "whatsapp"
+        if method not in reminders.CHANNELS: raise HTTPException(400, f"method must be one of {', '.join(reminders.CHANNELS)}")
+        n = await reminders.send_now(conn, coach_id, [str(s) for s in data.get("session_ids") or []], method, data.get("message"))
+        return {"success":True,"message":f"Queued {n} reminders","queued":n}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+@router.get("/reminders/policy")
+async def get_reminder_policy(x_coach_id: Optional[str]=Header(None)):
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        row = await conn.fetchrow("SELECT offsets_minutes,channel,message_template,enabled FROM reminder_policies WHERE coach_id=$1::uuid", coach_id)
+        return {"success":True,"policy":dict(row) if row else {"offsets_minutes":[],"channel":"whatsapp","message_template":None,"enabled":False}}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+@router.put("/reminders/policy")
+async def save_reminder_policy(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
+    """Remind clients automatically `offsets_minutes` before each session (e.g. [1440, 60]) on `channel`."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        try: offsets = sorted({int(m) for m in data.get("offsets_minutes") or []}, reverse=True)
+        except (TypeError, ValueError): raise HTTPException(400, "offsets_minutes must be a list of minutes")
+        if len(offsets) > reminders.MAX_OFFSETS or any(m < 1 or m > reminders.MAX_OFFSET_MINUTES for m in offsets):
+            raise HTTPException(400, f"Up to {reminders.MAX_OFFSETS} offsets between 1 and {reminders.MAX_OFFSET_MINUTES} minutes")
+        channel = data.get("channel") or "whatsapp"
+        if channel not in reminders.CHANNELS: raise HTTPException(400, f"channel must be one of {', '.join(reminders.CHANNELS)}")
+        policy = await reminders.save_policy(conn, coach_id, {"offsets_minutes":offsets,"channel":channel,
+                                                              "message_template":data.get("message_template") or None,"enabled":bool(data.get("enabled", True))})
+        return {"success":True,"policy":policy}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 @router.post("/reminders/send-personal")
 async def send_personal(data: dict = Body(...)):
@@ -474,6 +804,13 @@ async def send_personal(data: dict = Body(...)):
         if not cl: raise HTTPException(404, "Client not found")
         name = cl["full_name"] or "Client"; msg = data.get("message") or f"Hi {name}, reminder about your session!"
         method = data.get("method","whatsapp")
+        if data.get("queue"):
+            # sent by the message_queue dispatcher instead of returning a link for the coach to open
+            if method not in ("whatsapp","sms","email"): return {"success":False,"message":"Unknown method"}
+            if not (cl["email"] if method=="email" else cl["phone"]): return {"success":False,"message":f"No {'email' if method=='email' else 'phone number'} for this client"}
+            mid = await messaging.enqueue(conn, method, msg, recipient_id=data["client_id"], message_type="personal",
+                                          metadata={"subject":"Session Reminder"}, org_id=await ensure_org(conn))
+            return {"success":True,"method":method,"queued":True,"message_id":mid,"client_name":name}
         import urllib.parse
         if method=="whatsapp":
             ph = (cl["phone"] or "").replace("+","").replace(" ","").replace("-","")
@@ -486,7 +823,7 @@ async def send_personal(data: dict = Body(...)):
         return {"success":False,"message":"Unknown method"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 
 # ==================== PAYMENTS ====================
@@ -500,65 +837,97 @@ async def razorpay_link(data: dict = Body(...)):
         return {"success":True,"payment_link":f"https://rzp.io/demo/{uuid.uuid4().hex[:8]}","amount":amt,"client_name":cl["full_name"],"mode":"demo"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 
 # ==================== PUBLIC COACH PROFILES & REVIEWS ====================
 @router.get("/coaches")
-async def get_coaches():
+async def get_coaches(request: Request, response: Response, limit: Optional[int]=None, cursor: Optional[str]=None):
     conn = await get_db()
     try:
-        rows = await conn.fetch("SELECT id::text,full_name,email,phone,metadata,logo_url,created_at::text FROM users WHERE role='coach' AND is_active=true AND deleted_at IS NULL ORDER BY created_at DESC")
+        if nm := await conditional(conn, request, response, "coaches", [DIRECTORY], public=True): return nm
+        p, limit = [], page_limit(limit)
+        q = keyset("SELECT id::text,full_name,email,phone,metadata,logo_hash,created_at::text FROM users WHERE role='coach' AND is_active=true AND deleted_at IS NULL", p, "created_at", "id", cursor, limit)
+        rows, nxt = next_page(await conn.fetch(q, *p), limit, "created_at")
         coaches = []
         for r in rows:
             m = json.loads(r["metadata"]) if isinstance(r["metadata"],str) else (r["metadata"] or {})
             coaches.append({"id":r["id"],"name":r["full_name"],"email":r["email"],"specialization":m.get("specialization","general"),
-                "bio":m.get("bio",""),"experience_years":m.get("experience_years",0),"logo_url":r.get("logo_url")})
-        return {"success":True,"coaches":coaches}
-    except: return {"success":True,"coaches":[]}
-    finally: await conn.close()
+                "bio":m.get("bio",""),"experience_years":m.get("experience_years",0),"logo_url":logo_url(request, r["logo_hash"])})
+        return {"success":True,"coaches":coaches,"next_cursor":nxt}
+    except HTTPException: raise
+    except: return {"success":True,"coaches":[],"next_cursor":None}
+    finally: await release_db(conn)
 
 @router.get("/coaches/{cid}/profile")
-async def coach_profile(cid: str):
+async def coach_profile(cid: str, request: Request, response: Response):
+    """Public profile in one round trip: counts come from dashboard_counters and
+    coach_review_stats, so the cost does not grow with the coach's history."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
-        c = await conn.fetchrow("SELECT id::text,full_name,email,metadata,logo_url,created_at::text FROM users WHERE id=$1::uuid AND role='coach'", cid)
+        try: uuid.UUID(cid)
+        except ValueError: raise HTTPException(404, "Coach not found")
+        if nm := await conditional(conn, request, response, "profile", [("profile", cid)], public=True): return nm
+        c = await conn.fetchrow("""SELECT u.id::text,u.full_name,u.email,u.metadata,u.logo_hash,u.timezone,u.created_at::text,
+                   COALESCE(dc.clients,0) AS client_count,COALESCE(dc.completed_sessions,0) AS session_count,
+                   COALESCE(rs.review_count,0) AS review_count,COALESCE(rs.rating_sum,0) AS rating_sum,
+                   ARRAY[COALESCE(rs.stars_1,0),COALESCE(rs.stars_2,0),COALESCE(rs.stars_3,0),COALESCE(rs.stars_4,0),COALESCE(rs.stars_5,0)] AS stars,
+                   (SELECT COALESCE(json_agg(json_build_object('id',r.id::text,'client_name',r.client_name,'rating',r.rating,'review_text',r.review_text,'created_at',r.created_at::text)
+                                             ORDER BY r.created_at DESC,r.id DESC),'[]')
+                    FROM (SELECT * FROM coach_reviews WHERE coach_id=u.id AND is_public=true ORDER BY created_at DESC,id DESC LIMIT 20) r) AS reviews
+            FROM users u LEFT JOIN dashboard_counters dc ON dc.scope_type='coach' AND dc.scope_id=u.id
+            LEFT JOIN coach_review_stats rs ON rs.coach_id=u.id
+            WHERE u.id=$1::uuid AND u.role='coach'""", cid)
         if not c: raise HTTPException(404, "Coach not found")
         m = json.loads(c["metadata"]) if isinstance(c["metadata"],str) else (c["metadata"] or {})
-        revs = await conn.fetch("SELECT id::text,client_name,rating,review_text,created_at::text FROM coach_reviews WHERE coach_id=$1::uuid AND is_public=true ORDER BY created_at DESC LIMIT 20", cid)
-        cl_count = await conn.fetchval("SELECT COUNT(*) FROM users WHERE role='client' AND metadata->>'coach_id'=$1 AND is_active=true", cid)
-        sess_count = await conn.fetchval("SELECT COUNT(*) FROM scheduled_sessions WHERE coach_id=$1::uuid AND status IN ('completed','confirmed')", cid)
-        avg = await conn.fetchval("SELECT COALESCE(AVG(rating),0) FROM coach_reviews WHERE coach_id=$1::uuid AND is_public=true", cid)
+        avg = c["rating_sum"] / c["review_count"] if c["review_count"] else 0
         return {"success":True,"profile":{"id":c["id"],"name":c["full_name"],"email":c["email"],
             "specialization":m.get("specialization","general"),"bio":m.get("bio",""),"experience_years":m.get("experience_years",0),
-            "client_count":cl_count,"session_count":sess_count,"avg_rating":round(float(avg),1),
-            "reviews":[dict(r) for r in revs],"joined":c["created_at"],"logo_url":c.get("logo_url")}}
+            "client_count":c["client_count"],"session_count":c["session_count"],"avg_rating":round(float(avg),1),
+            "review_count":c["review_count"],"rating_histogram":{str(i+1):n for i,n in enumerate(c["stars"])},
+            "reviews":json.loads(c["reviews"]),"joined":c["created_at"],"logo_url":logo_url(request, c["logo_hash"]),
+            "timezone":c["timezone"] or DEFAULT_TIMEZONE}}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/coaches/{cid}/reviews")
 async def add_review(cid: str, data: dict = Body(...)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         row = await conn.fetchrow(
             "INSERT INTO coach_reviews (coach_id,client_name,client_email,rating,review_text,is_public,created_at) VALUES ($1::uuid,$2,$3,$4,$5,true,NOW()) RETURNING id::text,client_name,rating,review_text,created_at::text",
             cid, data.get("client_name","Anonymous"), data.get("client_email"), int(data.get("rating",5)), data.get("review_text",""))
         return {"success":True,"review":dict(row),"message":"Review submitted!"}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+@router.patch("/coaches/{cid}/reviews/{rid}")
+async def moderate_review(cid: str, rid: str, data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
+    """Hide or re-publish a review (is_public). Review aggregates follow via trigger."""
+    conn = await get_db()
+    try:
+        if "is_public" not in data: raise HTTPException(400, "Nothing to update")
+        if await get_coach_id(x_coach_id, conn) != cid: raise HTTPException(403, "Not your review")
+        row = await conn.fetchrow("UPDATE coach_reviews SET is_public=$1 WHERE id=$2::uuid AND coach_id=$3::uuid RETURNING id::text,is_public",
+                                  bool(data["is_public"]), rid, cid)
+        if not row: raise HTTPException(404, "Review not found")
+        return {"success":True,"review":dict(row)}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 @router.get("/coaches/{cid}/reviews")
-async def get_reviews(cid: str):
+async def get_reviews(cid: str, limit: Optional[int]=None, cursor: Optional[str]=None):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
-        rows = await conn.fetch("SELECT id::text,client_name,rating,review_text,created_at::text FROM coach_reviews WHERE coach_id=$1::uuid AND is_public=true ORDER BY created_at DESC", cid)
-        return {"success":True,"reviews":[dict(r) for r in rows]}
-    except: return {"success":True,"reviews":[]}
-    finally: await conn.close()
+        p, limit = [cid], page_limit(limit)
+        q = keyset("SELECT id::text,client_name,rating,review_text,created_at::text FROM coach_reviews WHERE coach_id=$1::uuid AND is_public=true", p, "created_at", "id", cursor, limit)
+        reviews, nxt = next_page(await conn.fetch(q, *p), limit, "created_at")
+        return {"success":True,"reviews":reviews,"next_cursor":nxt}
+    except HTTPException: raise
+    except: return {"success":True,"reviews":[],"next_cursor":None}
+    finally: await release_db(conn)
 
 
 # ==================== LEADS / INTEREST REQUESTS ====================
@@ -567,7 +936,6 @@ async def submit_interest(cid: str, data: dict = Body(...)):
     """Client expresses interest in a coach — callback request, interest, or referral."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         # Validate coach exists
         coach = await conn.fetchrow("SELECT id::text,full_name FROM users WHERE id=$1::uuid AND role='coach'", cid)
         if not coach: raise HTTPException(404, "Coach not found")
@@ -587,31 +955,30 @@ async def submit_interest(cid: str, data: dict = Body(...)):
         return {"success":True,"lead":dict(row),"message":f"Your {lead_type} request has been sent to {coach['full_name']}!"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.get("/leads")
-async def get_leads(status: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
-    """Get all leads/interest requests for a coach."""
+async def get_leads(status: Optional[str]=None, limit: Optional[int]=None, cursor: Optional[str]=None, x_coach_id: Optional[str]=Header(None)):
+    """Get leads/interest requests for a coach, newest first, one page at a time."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
-        coach_id = await get_coach_id(x_coach_id, conn)
-        if not coach_id: return {"success":True,"leads":[]}
+        coach_id = await get_coach_id(x_coach_id, conn); limit = page_limit(limit)
+        if not coach_id: return {"success":True,"leads":[],"next_cursor":None}
         q = "SELECT id::text,lead_type,name,email,phone,message,referral_code,referred_by_name,referred_by_email,status,coach_notes,created_at::text FROM leads WHERE coach_id=$1::uuid"
         p = [coach_id]
         if status: q += " AND status=$2"; p.append(status)
-        q += " ORDER BY created_at DESC"
-        rows = await conn.fetch(q, *p)
-        return {"success":True,"leads":[dict(r) for r in rows]}
-    except: return {"success":True,"leads":[]}
-    finally: await conn.close()
+        q = keyset(q, p, "created_at", "id", cursor, limit)
+        leads, nxt = next_page(await conn.fetch(q, *p), limit, "created_at")
+        return {"success":True,"leads":leads,"next_cursor":nxt}
+    except HTTPException: raise
+    except: return {"success":True,"leads":[],"next_cursor":None}
+    finally: await release_db(conn)
 
 @router.patch("/leads/{lid}")
 async def update_lead(lid: str, data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
     """Coach updates a lead — change status, add notes, convert to client."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         updates = []
         params = []
         idx = 1
@@ -625,40 +992,41 @@ async def update_lead(lid: str, data: dict = Body(...), x_coach_id: Optional[str
         return {"success":True,"message":"Lead updated"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/leads/{lid}/convert")
 async def convert_lead_to_client(lid: str, x_coach_id: Optional[str]=Header(None)):
     """Convert a lead into a client."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
         org_id = await ensure_org(conn)
         lead = await conn.fetchrow("SELECT * FROM leads WHERE id=$1::uuid", lid)
         if not lead: raise HTTPException(404, "Lead not found")
         meta = json.dumps({"coach_id": coach_id, "converted_from_lead": str(lid)})
-        row = await conn.fetchrow(
-            """INSERT INTO users (primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
-               VALUES ($1,$2,$3,$4,'client',true,true,$5::jsonb,NOW())
-               RETURNING id::text,full_name as name,email,phone""",
-            org_id, lead["name"], lead["email"], lead["phone"], meta)
-        await conn.execute("UPDATE leads SET status='converted' WHERE id=$1::uuid", lid)
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                """INSERT INTO users (primary_org_id,full_name,email,phone,role,is_active,is_verified,metadata,created_at)
+                   VALUES ($1,$2,$3,$4,'client',true,true,$5::jsonb,NOW())
+                   RETURNING id::text,full_name as name,email,phone""",
+                org_id, lead["name"], lead["email"], lead["phone"], meta)
+            await link_client(conn, coach_id, row["id"])
+            await conn.execute("UPDATE leads SET status='converted' WHERE id=$1::uuid", lid)
         return {"success":True,"client":dict(row),"message":f"{lead['name']} converted to client!"}
     except asyncpg.UniqueViolationError: raise HTTPException(400, "Client with this email/phone already exists")
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 
 # ==================== AVAILABILITY ====================
 @router.get("/availability")
-async def get_availability(x_coach_id: Optional[str]=Header(None)):
+async def get_availability(request: Request, response: Response, x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
+        if nm := await conditional(conn, request, response, "availability", [("coach", coach_id)] if coach_id else []): return nm
         if not coach_id: return {"success":True,"availability":{"working_days":[1,2,3,4,5],"slots":[]},"holidays":[]}
         row = await conn.fetchrow("SELECT working_days,slots FROM coach_availability WHERE coach_id=$1::uuid", coach_id)
         if not row:
@@ -670,13 +1038,12 @@ async def get_availability(x_coach_id: Optional[str]=Header(None)):
         holidays = [dict(r) for r in hrows]
         return {"success":True,"availability":{"working_days":wd,"slots":sl},"holidays":holidays}
     except: return {"success":True,"availability":{"working_days":[1,2,3,4,5],"slots":[]},"holidays":[]}
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.put("/availability")
 async def set_availability(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
         wd = json.dumps(data.get("working_days",[1,2,3,4,5]))
@@ -688,41 +1055,109 @@ async def set_availability(data: dict = Body(...), x_coach_id: Optional[str]=Hea
         return {"success":True,"message":"Availability saved"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+@router.get("/availability/free")
+async def get_free_slots(from_: str = Query(..., alias="from"), to: str = Query(...), coach_id: Optional[str] = None,
+                         duration: int = 60, step: Optional[int] = None, x_coach_id: Optional[str]=Header(None)):
+    """Open time on days [from, to) for X-Coach-Id or `coach_id` (comma-separated for several coaches):
+    free intervals and `duration`-minute start times every `step` minutes (default: duration)."""
+    try: start, end = datetime.strptime(from_, "%Y-%m-%d").date(), datetime.strptime(to, "%Y-%m-%d").date()
+    except ValueError: raise HTTPException(400, "from and to must be YYYY-MM-DD")
+    if end <= start: raise HTTPException(400, "to must be after from")
+    if (end - start).days > MAX_RANGE_DAYS: raise HTTPException(400, f"Range is limited to {MAX_RANGE_DAYS} days")
+    step = step or duration
+    if not 5 <= duration <= 720 or not 5 <= step <= 720: raise HTTPException(400, "duration and step must be 5-720 minutes")
+    ids = [c.strip() for c in (coach_id or x_coach_id or "").split(",") if c.strip()]
+    if not ids: raise HTTPException(400, "coach_id or X-Coach-Id required")
+    if len(ids) > MAX_COACHES: raise HTTPException(400, f"At most {MAX_COACHES} coaches per request")
+    try: ids = list(dict.fromkeys(str(uuid.UUID(c)) for c in ids))
+    except ValueError: raise HTTPException(400, "Invalid coach id")
+    conn = await get_db()
+    try:
+        coaches = await free_slots(conn, ids, start, end, duration, step)
+        return {"success":True,"from":start.isoformat(),"to":end.isoformat(),"duration_minutes":duration,"coaches":coaches}
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 @router.get("/holidays")
 async def get_holidays(x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: return {"success":True,"holidays":[]}
         rows = await conn.fetch("SELECT id::text,holiday_date::text,reason FROM coach_holidays WHERE coach_id=$1::uuid ORDER BY holiday_date", coach_id)
         return {"success":True,"holidays":[dict(r) for r in rows]}
     except: return {"success":True,"holidays":[]}
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/holidays")
 async def add_holiday(data: dict = Body(...), x_coach_id: Optional[str]=Header(None)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         coach_id = await get_coach_id(x_coach_id, conn)
         if not coach_id: raise HTTPException(400, "Valid coach ID required")
         row = await conn.fetchrow(
             "INSERT INTO coach_holidays (coach_id,holiday_date,reason) VALUES ($1::uuid,$2,$3) RETURNING id::text,holiday_date::text,reason",
             coach_id, parse_dt(data["date"]).date() if isinstance(data["date"], str) else data["date"], data.get("reason",""))
+        await store_lengths(conn, coach_id=coach_id)
         return {"success":True,"holiday":dict(row)}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.delete("/holidays/{hid}")
 async def delete_holiday(hid: str):
     conn = await get_db()
-    try: await conn.execute("DELETE FROM coach_holidays WHERE id=$1::uuid", hid); return {"success":True}
+    try:
+        row = await conn.fetchrow("DELETE FROM coach_holidays WHERE id=$1::uuid RETURNING coach_id::text", hid)
+        if row: await store_lengths(conn, coach_id=row["coach_id"])
+        return {"success":True}
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+
+
+# ==================== SEARCH ====================
+@router.get("/search")
+async def search_people(q: str = "", types: Optional[str] = None, limit: int = 10, x_coach_id: Optional[str] = Header(None)):
+    """Ranked matches for `q` (name, email or phone; prefixes and, with pg_trgm, fragments and typos) among the coach's
+    clients and leads and the coach directory. `types` is a comma-separated subset of clients,leads,coaches."""
+    kinds = [t.strip() for t in (types or ",".join(search.TYPES)).split(",") if t.strip()]
+    if any(k not in search.TYPES for k in kinds): raise HTTPException(400, f"types must be among {', '.join(search.TYPES)}")
+    if not 1 <= limit <= search.MAX_LIMIT: raise HTTPException(400, f"limit must be 1-{search.MAX_LIMIT}")
+    if len(q.strip()) < search.MIN_QUERY: return {"success":True,"query":q,"results":{k: [] for k in kinds}}
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        return {"success":True,"query":q,"results":await search.search(conn, q, kinds, coach_id, limit)}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
-
+    finally: await release_db(conn)
+
+# ==================== EXPORTS ====================
+@router.get("/export/{kind}")
+async def export_data(kind: str, format: str = "csv", gzip: bool = False, from_: Optional[str] = Query(None, alias="from"), to: Optional[str] = None,
+                      x_coach_id: Optional[str] = Header(None)):
+    """Download clients, sessions, attendance, leads or progress as CSV or NDJSON, streamed.
+    Scoped to the X-Coach-Id coach; a platform admin or org owner id exports the whole org. from/to (YYYY-MM-DD, to exclusive)
+    filter on the session, record, lead or client creation date. gzip=true compresses the body (Content-Encoding: gzip)."""
+    if kind not in exports.EXPORTS: raise HTTPException(404, f"Unknown export; one of {', '.join(exports.EXPORTS)}")
+    if format not in exports.FORMATS: raise HTTPException(400, f"format must be one of {', '.join(exports.FORMATS)}")
+    try: start, end = (datetime.strptime(d, "%Y-%m-%d").date() if d else None for d in (from_, to))
+    except ValueError: raise HTTPException(400, "from and to must be YYYY-MM-DD")
+    try: uuid.UUID(x_coach_id or "")
+    except ValueError: raise HTTPException(400, "Valid coach ID required")
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        org_wide = not coach_id and await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM users WHERE id=$1::uuid AND role IN ('platform_admin','org_owner') AND is_active=true)", x_coach_id)
+        tz = await coach_timezone(conn, coach_id)
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
+    if not coach_id and not org_wide: raise HTTPException(400, "Valid coach ID required")
+    headers = {"Content-Disposition": f'attachment; filename="{kind}-{local_today(tz).isoformat()}.{format}"'}
+    if gzip: headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(exports.stream_export(kind, format, coach_id, start, end, gzip), media_type=exports.MEDIA_TYPES[format], headers=headers)
 
 # ==================== ADMIN ====================
 @router.post("/admin/reset-database")
@@ -741,26 +1176,57 @@ async def reset_db(data: dict = Body(...)):
         try: await conn.execute("DELETE FROM users"); r["users"]="done"
         except Exception as e: r["users"]=str(e)
         await ensure_org(conn)
+        r["dashboard_counters"] = f"{len(await reconcile(conn) or [])} repaired"
         return {"success":True,"message":"Database wiped","details":r}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.get("/")
 async def root(): return {"status":"ok","version":"4.0-production"}
 
 @router.get("/progress/{client_id}")
-async def get_progress(client_id: str, x_coach_id: Optional[str] = Header(None)):
+async def get_progress(client_id: str, limit: Optional[int] = None, cursor: Optional[str] = None, x_coach_id: Optional[str] = Header(None)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
-        rows = await conn.fetch(
-            "SELECT id::text, record_type, metrics, notes, recorded_at::text, created_at::text FROM progress_records WHERE client_id=$1::uuid ORDER BY recorded_at DESC",
-            client_id)
-        return {"success": True, "records": [dict(r) for r in rows]}
+        p, limit = [client_id], page_limit(limit)
+        q = keyset("SELECT id::text, record_type, metrics, notes, recorded_at::text, created_at::text FROM progress_records WHERE client_id=$1::uuid",
+                   p, "recorded_at", "id", cursor, limit)
+        records, nxt = next_page(await conn.fetch(q, *p), limit, "recorded_at")
+        return {"success": True, "records": records, "next_cursor": nxt}
+    except HTTPException:
+        raise
     except:
-        return {"success": True, "records": []}
+        return {"success": True, "records": [], "next_cursor": None}
     finally:
-        await conn.close()
+        await release_db(conn)
+
+@router.get("/progress/{client_id}/metrics")
+async def get_progress_metrics(client_id: str, from_: Optional[str] = Query(None, alias="from"), to: Optional[str] = None,
+                               bucket: Optional[str] = None, metric: Optional[str] = None, x_coach_id: Optional[str] = Header(None)):
+    """Per-metric series over days [from, to) (default: the last year) in day/week/month buckets
+    (default: by range length). `metric` is a comma-separated subset, e.g. weight,measurements.waist."""
+    if bucket and bucket not in progress.BUCKETS: raise HTTPException(400, f"bucket must be one of {', '.join(progress.BUCKETS)}")
+    metrics = [m.strip() for m in (metric or "").split(",") if m.strip()]
+    if len(metrics) > progress.MAX_METRICS: raise HTTPException(400, f"At most {progress.MAX_METRICS} metrics per request")
+    try: start, end = (datetime.strptime(d, "%Y-%m-%d").date() if d else None for d in (from_, to))
+    except ValueError: raise HTTPException(400, "from and to must be YYYY-MM-DD")
+    try: uuid.UUID(client_id)
+    except ValueError: raise HTTPException(400, "Invalid client ID")
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM coach_clients cc WHERE cc.coach_id=$1::uuid AND cc.client_id=$2::uuid)", coach_id, client_id):
+            raise HTTPException(404, "Client not found")
+        if not end: end = local_today(await coach_timezone(conn, coach_id)) + timedelta(days=1)
+        start = start or end - timedelta(days=365)
+        if end <= start: raise HTTPException(400, "to must be after from")
+        bucket = bucket or progress.pick_bucket(start, end)
+        series = await progress.metric_series(conn, client_id, start, end, bucket, metrics)
+        return {"success":True,"from":start.isoformat(),"to":end.isoformat(),"bucket":bucket,"metrics":series}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 @router.put("/clients/{cid}/metadata")
 async def update_client_metadata(cid: str, data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
@@ -773,22 +1239,26 @@ async def update_client_metadata(cid: str, data: dict = Body(...), x_coach_id: O
             current = json.loads(row["metadata"]) if isinstance(row["metadata"], str) else dict(row["metadata"])
         for k, v in data.items():
             if k != "id": current[k] = v
-        await conn.execute("UPDATE users SET metadata=$1::jsonb WHERE id=$2::uuid", json.dumps(current), cid)
+        async with conn.transaction():
+            await conn.execute("UPDATE users SET metadata=$1::jsonb WHERE id=$2::uuid", json.dumps(current), cid)
+            if "coach_id" in data:  # reassigned to another coach
+                await conn.execute("DELETE FROM coach_clients WHERE client_id=$1::uuid", cid)
+                await link_client(conn, await get_coach_id(data["coach_id"], conn), cid)
         return {"success": True, "metadata": current}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 # ─── CLIENT AUTH & PORTAL ENDPOINTS ──────────────────
 @router.post("/auth/client-register")
 async def client_register(data: dict = Body(...)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         email = data.get("email","").strip().lower()
         if not email: raise HTTPException(400, "Email required")
-        pw = hashlib.sha256(data.get("password","").encode()).hexdigest()
+        pw = await passwords.hash_password(data.get("password",""))
         meta_new = {k: data.get(k,"") for k in ["goal","type","weight","height","injuries","diet"] if data.get(k)}
+        coach_id = await get_coach_id(data.get("coach_id"), conn)  # signup from a coach's page
         existing = await conn.fetchrow("SELECT id::text,full_name as name,email,phone,password_hash,metadata FROM users WHERE LOWER(email)=$1 AND role='client'", email)
         if existing:
             # Client already added by coach — let them claim by setting password
@@ -799,6 +1269,8 @@ async def client_register(data: dict = Body(...)):
             if existing["metadata"]:
                 old_meta = json.loads(existing["metadata"]) if isinstance(existing["metadata"], str) else dict(existing["metadata"])
             old_meta.update(meta_new)
+            coach_id = await get_coach_id(old_meta.get("coach_id"), conn) or coach_id
+            if coach_id: old_meta["coach_id"] = coach_id
             # Set password and update details
             updates = ["password_hash=$2"]
             vals = [existing["id"], pw]
@@ -808,9 +1280,11 @@ async def client_register(data: dict = Body(...)):
             if data.get("phone") and not existing["phone"]:
                 updates.append(f"phone=${idx}"); vals.append(data["phone"]); idx+=1
             updates.append(f"metadata=${idx}::jsonb"); vals.append(json.dumps(old_meta)); idx+=1
-            row = await conn.fetchrow(
-                f"UPDATE users SET {','.join(updates)} WHERE id=$1::uuid RETURNING id::text,full_name as name,email,phone,metadata",
-                *vals)
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    f"UPDATE users SET {','.join(updates)} WHERE id=$1::uuid RETURNING id::text,full_name as name,email,phone,metadata",
+                    *vals)
+                await link_client(conn, coach_id, row["id"])
             client = dict(row)
             if isinstance(client.get("metadata"), str):
                 try: client["metadata"] = json.loads(client["metadata"])
@@ -819,22 +1293,24 @@ async def client_register(data: dict = Body(...)):
         else:
             # Brand new client self-registration
             org_id = await ensure_org(conn)
+            if coach_id: meta_new["coach_id"] = coach_id
             meta = json.dumps(meta_new)
-            row = await conn.fetchrow(
-                """INSERT INTO users (primary_org_id,full_name,email,phone,password_hash,role,metadata,is_active,is_verified,created_at)
-                   VALUES ($1,$2,$3,$4,$5,'client',$6::jsonb,true,true,NOW())
-                   RETURNING id::text,full_name as name,email,phone,metadata""",
-                org_id, data.get("name",""), email, data.get("phone",""), pw, meta)
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    """INSERT INTO users (primary_org_id,full_name,email,phone,password_hash,role,metadata,is_active,is_verified,created_at)
+                       VALUES ($1,$2,$3,$4,$5,'client',$6::jsonb,true,true,NOW())
+                       RETURNING id::text,full_name as name,email,phone,metadata""",
+                    org_id, data.get("name",""), email, data.get("phone",""), pw, meta)
+                await link_client(conn, coach_id, row["id"])
             return {"success": True, "client": dict(row)}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/auth/client-login")
 async def client_login(data: dict = Body(...)):
     conn = await get_db()
     try:
-        await ensure_tables(conn)
         email = data.get("email","").strip().lower()
         phone_last4 = data.get("phone","").strip()
         password = data.get("password","").strip()
@@ -848,9 +1324,10 @@ async def client_login(data: dict = Body(...)):
         if password:
             if not has_password:
                 raise HTTPException(401, "No password set. Please use the Register tab to activate your account.")
-            pw_hash = hashlib.sha256(password.encode()).hexdigest()
-            if row["password_hash"] != pw_hash:
+            ok, new_hash = await passwords.verify(password, row["password_hash"])
+            if not ok:
                 raise HTTPException(401, "Invalid password")
+            await upgrade_password(conn, row["id"], row["password_hash"], new_hash)
         elif phone_last4:
             if not (row["phone"] or "").endswith(phone_last4):
                 raise HTTPException(401, "Phone digits don't match")
@@ -864,62 +1341,62 @@ async def client_login(data: dict = Body(...)):
         return {"success": True, "client": client}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
+
+DASHBOARD_SESSION = """json_build_object('id',ss.id::text,'scheduled_at',ss.scheduled_at::text,'duration_minutes',ss.duration_minutes,'status',ss.status,
+    'location',ss.location,'cancelled_reason',ss.cancelled_reason,'workout_name',st.name,'coach_name',c.full_name)"""
+DASHBOARD_SESSION_JOINS = """JOIN scheduled_sessions ss ON ss.id=k.id LEFT JOIN session_templates st ON ss.session_template_id=st.id
+    LEFT JOIN users c ON ss.coach_id=c.id"""
 
 @router.get("/client/{cid}/dashboard")
 async def client_dashboard(cid: str):
+    """Client home in one round trip: bounded index range scans on (client_id, scheduled_at)
+    for the next 20 and last 50 sessions, attendance counts from the (client_id, status)
+    index, coach name and progress as subqueries. Series occurrences in the upcoming
+    window are merged in."""
     conn = await get_db()
     try:
-        await ensure_tables(conn)
-        from datetime import timezone, timedelta
-        ist = timezone(timedelta(hours=5, minutes=30))
-        now_str = datetime.now(ist).strftime("%Y-%m-%d")
-        sessions = await conn.fetch(
-            """SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.location,ss.cancelled_reason,
-                      st.name as workout_name, c.full_name as coach_name
-               FROM scheduled_sessions ss
-               LEFT JOIN session_templates st ON ss.session_template_id=st.id
-               LEFT JOIN users c ON ss.coach_id=c.id
-               WHERE ss.client_id=$1::uuid ORDER BY ss.scheduled_at DESC""", cid)
-        all_s = [dict(r) for r in sessions]
-        upcoming = [s for s in all_s if (s["scheduled_at"] or "")[:10] >= now_str and s["status"] not in ('cancelled','cancel_requested')]
-        past = [s for s in all_s if (s["scheduled_at"] or "")[:10] < now_str or s["status"] in ('completed','confirmed','no_show')]
-        attended = len([s for s in past if s["status"] in ('confirmed','completed')])
-        absent = len([s for s in past if s["status"]=='no_show'])
+        d = await conn.fetchrow(
+            f"""WITH b AS (
+                 -- start of today in the timezone of the client's coach (stored as wall clock, see localtime.py)
+                 SELECT date_trunc('day', NOW() AT TIME ZONE COALESCE((SELECT c.timezone FROM coach_clients cc JOIN users c ON c.id=cc.coach_id
+                          WHERE cc.client_id=$1::uuid ORDER BY cc.created_at DESC LIMIT 1), $2)) AT TIME ZONE 'UTC' AS day0),
+               upcoming AS (
+                 SELECT id,scheduled_at FROM scheduled_sessions WHERE client_id=$1::uuid AND scheduled_at>=(SELECT day0 FROM b)
+                   AND status NOT IN ('cancelled','cancel_requested') ORDER BY scheduled_at,id LIMIT 20),
+               past AS (
+                 SELECT id,scheduled_at FROM (
+                   (SELECT id,scheduled_at FROM scheduled_sessions WHERE client_id=$1::uuid AND scheduled_at<(SELECT day0 FROM b) ORDER BY scheduled_at DESC,id DESC LIMIT 50)
+                   UNION ALL
+                   (SELECT id,scheduled_at FROM scheduled_sessions WHERE client_id=$1::uuid AND scheduled_at>=(SELECT day0 FROM b) AND status IN ('completed','confirmed','no_show'))
+                 ) p ORDER BY scheduled_at DESC,id DESC LIMIT 50)
+               SELECT
+                 (SELECT COALESCE(json_agg({DASHBOARD_SESSION} ORDER BY k.scheduled_at,k.id),'[]') FROM upcoming k {DASHBOARD_SESSION_JOINS}) AS upcoming,
+                 (SELECT COALESCE(json_agg({DASHBOARD_SESSION} ORDER BY k.scheduled_at DESC,k.id DESC),'[]') FROM past k {DASHBOARD_SESSION_JOINS}) AS past,
+                 (SELECT COUNT(*) FROM scheduled_sessions WHERE client_id=$1::uuid AND scheduled_at>=(SELECT day0 FROM b) AND status NOT IN ('cancelled','cancel_requested')) AS upcoming_count,
+                 (SELECT COUNT(*) FROM scheduled_sessions WHERE client_id=$1::uuid AND status IN ('confirmed','completed')) AS attended,
+                 (SELECT COUNT(*) FROM scheduled_sessions WHERE client_id=$1::uuid AND status='no_show') AS absent,
+                 COALESCE((SELECT c.full_name FROM scheduled_sessions ss JOIN users c ON c.id=ss.coach_id WHERE ss.client_id=$1::uuid ORDER BY ss.scheduled_at DESC LIMIT 1),
+                          (SELECT c.full_name FROM coach_clients cc JOIN users c ON c.id=cc.coach_id WHERE cc.client_id=$1::uuid ORDER BY cc.created_at DESC LIMIT 1)) AS coach_name,
+                 (SELECT COALESCE(json_agg(json_build_object('metrics',pr.metrics::text,'recorded_at',pr.recorded_at::text) ORDER BY pr.recorded_at DESC,pr.id DESC),'[]')
+                  FROM (SELECT * FROM progress_records WHERE client_id=$1::uuid ORDER BY recorded_at DESC,id DESC LIMIT 10) pr) AS progress,
+                 (SELECT COALESCE(json_agg(w),'[]') FROM (SELECT DISTINCT st.id::text,st.name,st.session_type as category FROM scheduled_sessions ss
+                   JOIN session_templates st ON st.id=ss.session_template_id WHERE ss.client_id=$1::uuid AND st.name IS NOT NULL) w) AS workouts,
+                 (SELECT day0 FROM b) AS day0""",
+            cid, DEFAULT_TIMEZONE)
+        today = d["day0"].date()
+        _, last = await series_span(conn, client_id=cid)
+        horizon = today + timedelta(days=LIST_AHEAD_DAYS)
+        virtual = await virtual_sessions(conn, today, max(horizon, last + timedelta(days=1)) if last else horizon, client_id=cid, horizon=horizon)
+        upcoming = sorted(json.loads(d["upcoming"]) + virtual, key=sort_key("scheduled_at"))[:20]
+        attended, absent = d["attended"], d["absent"]
         total = attended + absent
         rate = round(attended/total*100) if total else 0
-        # Coach info
-        coach_name = all_s[0]["coach_name"] if all_s and all_s[0].get("coach_name") else None
-        # Also try from user metadata
-        if not coach_name:
-            try:
-                user = await conn.fetchrow("SELECT metadata FROM users WHERE id=$1::uuid", cid)
-                if user and user["metadata"]:
-                    meta = json.loads(user["metadata"]) if isinstance(user["metadata"], str) else user["metadata"]
-                    if meta.get("coach_id"):
-                        crow = await conn.fetchrow("SELECT full_name FROM users WHERE id=$1::uuid", meta["coach_id"])
-                        if crow: coach_name = crow["full_name"]
-            except: pass
-        # Progress
-        progress = []
-        try:
-            rows = await conn.fetch("SELECT metrics,recorded_at::text FROM progress_records WHERE client_id=$1::uuid ORDER BY recorded_at DESC LIMIT 10", cid)
-            progress = [dict(r) for r in rows]
-        except: pass
-        # Mapped workouts (from session_templates used in sessions)
-        workouts = []
-        try:
-            wrows = await conn.fetch(
-                """SELECT DISTINCT st.id::text, st.name, st.category FROM session_templates st
-                   INNER JOIN scheduled_sessions ss ON ss.session_template_id=st.id
-                   WHERE ss.client_id=$1::uuid AND st.name IS NOT NULL""", cid)
-            workouts = [dict(r) for r in wrows]
-        except: pass
-        return {"success": True, "upcoming": upcoming[:20], "past": past[:50], "progress": progress,
-                "workouts": workouts, "coach_name": coach_name,
-                "stats": {"attended": attended, "absent": absent, "rate": rate, "upcoming_count": len(upcoming)}}
+        return {"success": True, "upcoming": upcoming, "past": json.loads(d["past"]), "progress": json.loads(d["progress"]),
+                "workouts": json.loads(d["workouts"]), "coach_name": d["coach_name"],
+                "stats": {"attended": attended, "absent": absent, "rate": rate, "upcoming_count": d["upcoming_count"] + len(virtual)}}
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.get("/client/{cid}/payments")
 async def client_payments(cid: str):
@@ -931,12 +1408,13 @@ async def client_payments(cid: str):
         return {"success": True, "payments": [dict(r) for r in rows]}
     except:
         return {"success": True, "payments": []}
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/sessions/{sid}/cancel-request")
 async def cancel_request(sid: str, data: dict = Body(...)):
     conn = await get_db()
     try:
+        sid = await resolve_session(conn, sid)
         row = await conn.fetchrow("SELECT status FROM scheduled_sessions WHERE id=$1::uuid", sid)
         if not row: raise HTTPException(404, "Session not found")
         if row["status"] in ('cancelled','completed','confirmed','no_show'):
@@ -947,7 +1425,7 @@ async def cancel_request(sid: str, data: dict = Body(...)):
         return {"success": True, "message": "Cancel request sent to coach"}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
 @router.post("/auth/reset-password")
 async def reset_password(data: dict = Body(...)):
@@ -979,59 +1457,36 @@ async def reset_password(data: dict = Body(...)):
             # Phone exists but no verification provided - require it
             raise HTTPException(400, "Please enter last 4 digits of your registered phone for verification")
         
-        pw_hash = hashlib.sha256(new_password.encode()).hexdigest()
+        pw_hash = await passwords.hash_password(new_password)
         await conn.execute("UPDATE users SET password_hash=$1 WHERE id=$2::uuid", pw_hash, row["id"])
         return {"success": True, "message": "Password reset successfully. Please sign in with your new password."}
     except HTTPException: raise
     except Exception as e: raise HTTPException(500, str(e))
-    finally: await conn.close()
+    finally: await release_db(conn)
 
-@router.post("/ai/command")
-async def ai_command(data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
-    """AI agent proxy - forwards to Anthropic API and returns structured response"""
-    import urllib.request, ssl
+async def ai_prompt(data: dict, x_coach_id: Optional[str]):
+    """(system prompt, messages) for an /ai/command request. The DB connection is returned before the model is called."""
+    prompt = str(data.get("prompt",""))
+    if len(prompt) > ai_context.PROMPT_MAX_CHARS: raise HTTPException(400, f"Prompt is longer than {ai_context.PROMPT_MAX_CHARS} characters")
     conn = await get_db()
     try:
         coach_id = await get_coach_id(x_coach_id, conn)
-        coach = await conn.fetchrow("SELECT full_name FROM users WHERE id=$1::uuid", coach_id) if coach_id else None
-        coach_name = coach["full_name"] if coach else "Coach"
-
-        # Gather context
-        clients = await conn.fetch("SELECT id::text,full_name as name,email,phone,metadata FROM users WHERE role='client' AND is_active=true AND deleted_at IS NULL ORDER BY created_at DESC LIMIT 50")
-        clients_list = [{"id":r["id"],"name":r["name"],"email":r["email"],"phone":r["phone"],"metadata":json.loads(r["metadata"]) if isinstance(r["metadata"],str) else dict(r["metadata"]) if r["metadata"] else {}} for r in clients]
-
-        from datetime import timezone
-        ist = timezone(timedelta(hours=5, minutes=30))
-        now = datetime.now(ist)
+        ctx = await ai_context.coach_context(conn, coach_id, schedule_sessions)
+        now = local_now(ctx["timezone"])
         today_str = now.strftime("%Y-%m-%d")
         day_names = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
-
-        today_sessions = await conn.fetch(
-            """SELECT ss.id::text,ss.scheduled_at::text,ss.status,ss.location,u.full_name as client_name,ss.client_id::text
-               FROM scheduled_sessions ss LEFT JOIN users u ON ss.client_id=u.id
-               WHERE ss.scheduled_at::date=$1::date AND ss.coach_id=$2::uuid ORDER BY ss.scheduled_at""",
-            now.date(), coach_id) if coach_id else []
-        today_list = [dict(r) for r in today_sessions]
-
-        recent_sessions = await conn.fetch(
-            """SELECT ss.id::text,ss.scheduled_at::text,ss.status,ss.location,u.full_name as client_name,ss.client_id::text
-               FROM scheduled_sessions ss LEFT JOIN users u ON ss.client_id=u.id
-               WHERE ss.coach_id=$1::uuid ORDER BY ss.scheduled_at DESC LIMIT 60""",
-            coach_id) if coach_id else []
-        recent_list = [dict(r) for r in recent_sessions]
-
-        prompt = data.get("prompt","")
-        history = data.get("history",[])
+        clients_list, today_list, recent_list = ctx["clients"], ctx["today"], ctx["recent"]
+        partial = len(clients_list) < ctx["client_total"]
 
         system_prompt = f"""You are CoachFlow AI, an assistant for a fitness coach platform. You help manage clients, schedule sessions, and mark attendance.
 
 CURRENT CONTEXT:
 - Today: {today_str} ({day_names[now.weekday()]})
-- Current time: {now.strftime('%H:%M')} IST
-- Coach: {coach_name} (ID: {coach_id})
-- Clients ({len(clients_list)}): {json.dumps(clients_list)}
-- Today's sessions ({len(today_list)}): {json.dumps(today_list)}
-- Recent sessions: {json.dumps(recent_list[:40])}
+- Current time: {now.strftime('%H:%M')} ({ctx["timezone"]})
+- Coach: {ctx["coach_name"]} (ID: {coach_id})
+- Clients ({len(clients_list)} of {ctx["client_total"]} shown{"; the list is INCOMPLETE" if partial else ""}): {json.dumps(clients_list, separators=(",",":"))}
+- Today's sessions ({len(today_list)}): {json.dumps(today_list, separators=(",",":"))}
+- Recent sessions ({len(recent_list)} of {ctx["recent_total"]} shown): {json.dumps(recent_list, separators=(",",":"))}
 
 You MUST respond ONLY in valid JSON. No markdown, no backticks, no text before/after. Schema:
 {{
@@ -1060,57 +1515,80 @@ RULES:
 1. Resolve names to IDs from the client list. Use fuzzy matching.
 2. Relative dates: "tomorrow" = day after {today_str}, "next Monday" = calculate from today.
 3. For bulk ops, create multiple actions in the array.
-4. If a client name doesn't match anyone, use add_client.
+4. If a client name doesn't match anyone, use add_client{" only when the coach clearly asks to add a new client: the client list above is incomplete, so an unmatched name may be an existing client that is not shown. Otherwise use none and ask for the client's phone or email" if partial else ""}.
 5. Default time: 07:00. Default duration: 60 min. Default location: match client type or 'offline'.
 6. Be smart: "Schedule Aparna at 5pm for 3 days" = 3 separate schedule_session actions on consecutive days.
 7. "mark all present today" = one mark_attendance per today's session with status 'scheduled'.
 8. NEVER ask for clarification if you can infer. Just do it.
 9. Keep message concise with emoji."""
+    finally: await release_db(conn)
+    messages = ai_context.clip_history(data.get("history",[]))
+    messages.append({"role": "user", "content": prompt})
+    return system_prompt, messages
+
+def ai_api_key() -> str:
+    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        raise HTTPException(500, "ANTHROPIC_API_KEY not configured")
+    return api_key
+
+def parse_reply(raw_text: str) -> dict:
+    cleaned = raw_text.replace("```json","").replace("```","").strip()
+    try:
+        return json.loads(cleaned)
+    except:
+        return {"message": raw_text, "actions": []}
 
-        messages = []
-        for h_msg in history[-6:]:
-            messages.append({"role": h_msg.get("role","user"), "content": h_msg.get("content","")})
-        messages.append({"role": "user", "content": prompt})
-
-        api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-        if not api_key:
-            raise HTTPException(500, "ANTHROPIC_API_KEY not configured")
-
-        req_body = json.dumps({
-            "model": "claude-sonnet-4-20250514",
-            "max_tokens": 2000,
-            "system": system_prompt,
-            "messages": messages
-        }).encode()
-
-        req = urllib.request.Request(
-            "https://api.anthropic.com/v1/messages",
-            data=req_body,
-            headers={
-                "Content-Type": "application/json",
-                "x-api-key": api_key,
-                "anthropic-version": "2023-06-01"
-            },
-            method="POST"
-        )
-        ctx = ssl.create_default_context()
-        with urllib.request.urlopen(req, timeout=30, context=ctx) as resp:
-            result = json.loads(resp.read().decode())
-
+@router.post("/ai/command")
+async def ai_command(data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
+    """AI agent proxy - forwards to Anthropic API and returns structured response"""
+    try:
+        api_key = ai_api_key()
+        system_prompt, messages = await ai_prompt(data, x_coach_id)
+        result = await ai_client.create_message(system_prompt, messages, api_key)
         raw_text = "".join(c.get("text","") for c in result.get("content",[]))
-        # Parse JSON from response
-        cleaned = raw_text.replace("```json","").replace("```","").strip()
-        try:
-            parsed = json.loads(cleaned)
-        except:
-            parsed = {"message": raw_text, "actions": []}
-
-        return {"success": True, "response": parsed, "raw": raw_text}
-
+        return {"success": True, "response": parse_reply(raw_text), "raw": raw_text}
     except HTTPException: raise
     except Exception as e:
         return {"success": False, "detail": str(e), "response": {"message": f"Error: {str(e)}", "actions": []}}
-    finally:
-        await conn.close()
+
+@router.post("/ai/command/stream")
+async def ai_command_stream(data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
+    """/ai/command as Server-Sent Events: `delta` {text} per upstream chunk, `action` per complete action object,
+    then `done` with the same body /ai/command returns (or `error`)."""
+    api_key = ai_api_key()
+    try: system_prompt, messages = await ai_prompt(data, x_coach_id)
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+
+    async def events():
+        scanner, chunks = ActionScanner(), []
+        try:
+            async for text in ai_client.stream_message(system_prompt, messages, api_key):
+                chunks.append(text)
+                yield sse("delta", {"text": text})
+                for action in scanner.feed(text): yield sse("action", action)
+            raw_text = "".join(chunks)
+            yield sse("done", {"success": True, "response": parse_reply(raw_text), "raw": raw_text})
+        except Exception as e:
+            yield sse("error", {"success": False, "detail": str(e)})
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/ai/actions")
+async def ai_actions(data: dict = Body(...), x_coach_id: Optional[str] = Header(None)):
+    """Validate and apply the actions /ai/command proposed, in one transaction; one result per action."""
+    conn = await get_db()
+    try:
+        coach_id = await get_coach_id(x_coach_id, conn)
+        if not coach_id: raise HTTPException(400, "Valid coach ID required")
+        actions = data.get("actions")
+        if not isinstance(actions, list): raise HTTPException(400, "actions must be a list")
+        if len(actions) > MAX_ACTIONS: raise HTTPException(400, f"At most {MAX_ACTIONS} actions per request")
+        results = await run_actions(conn, actions, coach_id, await ensure_org(conn))
+        n = sum(r["success"] for r in results)
+        return {"success":True,"message":f"Applied {n} of {len(results)} actions","applied":n,"errors":len(results)-n,"results":results}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+    finally: await release_db(conn)
 
 app.include_router(router, prefix="/api/v1")
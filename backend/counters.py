@@ -0,0 +1,99 @@
+"""
+Dashboard counters.
+
+dashboard_counters (migration 005) holds clients / sessions / completed
+sessions / workouts per coach and per org. Statement-level triggers on the
+source tables keep it current, so /dashboard/stats is one index range read:
+a coach's counts are one row, an org's are spread over up to 16 slot rows
+(migration 017) so concurrent writers do not queue on a single row lock.
+reconcile() recomputes every scope from the source tables and repairs drift
+(e.g. links dropped by a hard user delete); it runs periodically in the
+background and from the CLI: `python counters.py`.
+"""
+import asyncio, logging, os
+from typing import List, Optional
+from db import get_db, release_db
+
+COUNTERS = ("clients", "sessions", "completed_sessions", "workouts")
+RECONCILE_INTERVAL = float(os.getenv("COUNTERS_RECONCILE_SECONDS", 3600))  # 0 disables the background job
+LOCK_KEY = 7203115  # one reconcile at a time across workers
+
+log = logging.getLogger(__name__)
+_task: Optional[asyncio.Task] = None
+
+
+async def read_counters(conn, scope_type: str, scope_id: str) -> dict:
+    row = await conn.fetchrow(f"SELECT {','.join(f'COALESCE(SUM({c}),0)::bigint AS {c}' for c in COUNTERS)} FROM dashboard_counters "
+                              "WHERE scope_type=$1 AND scope_id=$2::uuid", scope_type, scope_id)
+    return dict(row)
+
+async def reconcile(conn) -> Optional[List[dict]]:
+    """Repair every counter that differs from dashboard_counts_actual; returns the repaired rows.
+
+    Holds an EXCLUSIVE lock on dashboard_counters while it runs: trigger upserts
+    from concurrent writes wait and apply their deltas on top of the repaired
+    values. Returns None if another worker is already reconciling.
+    """
+    async with conn.transaction():
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", LOCK_KEY): return None
+        await conn.execute("LOCK TABLE dashboard_counters IN EXCLUSIVE MODE")
+        rows = await conn.fetch("""
+            WITH counted AS (
+                SELECT scope_type, scope_id, SUM(clients)::bigint AS clients, SUM(sessions)::bigint AS sessions,
+                       SUM(completed_sessions)::bigint AS completed_sessions, SUM(workouts)::bigint AS workouts
+                FROM dashboard_counters GROUP BY scope_type, scope_id
+            ), drift AS (
+                SELECT scope_type, scope_id, COALESCE(a.clients,0) AS clients, COALESCE(a.sessions,0) AS sessions,
+                       COALESCE(a.completed_sessions,0) AS completed_sessions, COALESCE(a.workouts,0) AS workouts,
+                       c.clients AS was_clients, c.sessions AS was_sessions, c.completed_sessions AS was_completed_sessions, c.workouts AS was_workouts
+                FROM dashboard_counts_actual a FULL JOIN counted c USING (scope_type, scope_id)
+                WHERE (COALESCE(a.clients,0), COALESCE(a.sessions,0), COALESCE(a.completed_sessions,0), COALESCE(a.workouts,0))
+                      IS DISTINCT FROM (c.clients, c.sessions, c.completed_sessions, c.workouts)
+            ), folded AS (  -- the repaired value goes to slot 0
+                DELETE FROM dashboard_counters d USING drift WHERE d.slot<>0 AND d.scope_type=drift.scope_type AND d.scope_id=drift.scope_id
+            ), fixed AS (
+                INSERT INTO dashboard_counters (scope_type,scope_id,slot,clients,sessions,completed_sessions,workouts)
+                SELECT scope_type,scope_id,0,clients,sessions,completed_sessions,workouts FROM drift
+                ON CONFLICT (scope_type,scope_id,slot) DO UPDATE SET clients=EXCLUDED.clients,sessions=EXCLUDED.sessions,
+                    completed_sessions=EXCLUDED.completed_sessions,workouts=EXCLUDED.workouts,updated_at=NOW()
+            )
+            SELECT scope_type,scope_id::text,clients,sessions,completed_sessions,workouts,
+                   was_clients,was_sessions,was_completed_sessions,was_workouts FROM drift ORDER BY scope_type,scope_id""")
+    return [dict(r) for r in rows]
+
+async def _reconcile_loop():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            conn = await get_db()
+            try: repaired = await reconcile(conn)
+            finally: await release_db(conn)
+            if repaired: log.warning("dashboard counters: repaired %d scopes: %s", len(repaired), repaired)
+        except Exception: log.exception("dashboard counter reconcile failed")
+
+def start_reconciler():
+    global _task
+    if RECONCILE_INTERVAL > 0 and _task is None: _task = asyncio.create_task(_reconcile_loop())
+
+async def stop_reconciler():
+    global _task
+    if _task is None: return
+    task, _task = _task, None
+    task.cancel()
+    try: await task
+    except asyncio.CancelledError: pass
+
+
+if __name__ == "__main__":
+    import asyncpg
+    from db import DB_CONFIG
+
+    async def main():
+        conn = await asyncpg.connect(**DB_CONFIG)
+        try:
+            repaired = await reconcile(conn)
+            if repaired is None: print("Another reconcile is running")
+            else: print(f"Repaired {len(repaired)} counter rows" + "".join(f"\n  {r}" for r in repaired))
+        finally: await conn.close()
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""
+Shared asyncpg connection pool.
+
+The pool is created once at startup and closed at shutdown. Route handlers
+borrow a connection with get_db() and hand it back with release_db().
+"""
+import asyncio, os, time
+from typing import Optional
+import asyncpg
+from fastapi import HTTPException
+
+DB_CONFIG = dict(
+    host=os.getenv("DB_HOST","coach-db-1770519048.postgres.database.azure.com"),
+    database=os.getenv("DB_NAME","coach_platform"), user=os.getenv("DB_USER","dbadmin"),
+    password=os.getenv("DB_PASSWORD","CoachPlatform2026!SecureDB"),
+    port=int(os.getenv("DB_PORT",5432)),
+    ssl="require" if os.getenv("DB_SSL","true").lower()=="true" else None,
+)
+
+POOL_CONFIG = dict(
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE",2)),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE",10)),
+    max_inactive_connection_lifetime=float(os.getenv("DB_POOL_MAX_IDLE_SECONDS",300)),
+    command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT",30)),
+    server_settings={"application_name": os.getenv("DB_APPLICATION_NAME","coach_platform")},
+)
+ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT",10))
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+_stats = {"acquired": 0, "released": 0, "acquire_timeouts": 0, "acquire_wait_ms": 0.0, "max_acquire_wait_ms": 0.0}
+
+
+async def init_pool() -> asyncpg.Pool:
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(**DB_CONFIG, **POOL_CONFIG)
+    return _pool
+
+async def close_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            pool, _pool = _pool, None
+            await pool.close()
+
+async def get_db():
+    """Borrow a connection from the pool. Pair every call with release_db()."""
+    pool = _pool or await init_pool()
+    t0 = time.monotonic()
+    try:
+        conn = await pool.acquire(timeout=ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _stats["acquire_timeouts"] += 1
+        raise HTTPException(503, "Database busy, please retry")
+    waited = (time.monotonic() - t0) * 1000
+    _stats["acquired"] += 1
+    _stats["acquire_wait_ms"] += waited
+    _stats["max_acquire_wait_ms"] = max(_stats["max_acquire_wait_ms"], waited)
+    return conn
+
+async def release_db(conn):
+    if _pool is None: return  # pool already closed at shutdown
+    await _pool.release(conn)
+    _stats["released"] += 1
+
+def pool_stats() -> dict:
+    s = {**_stats, "acquire_wait_ms": round(_stats["acquire_wait_ms"], 2), "max_acquire_wait_ms": round(_stats["max_acquire_wait_ms"], 2)}
+    s["avg_acquire_wait_ms"] = round(_stats["acquire_wait_ms"] / _stats["acquired"], 2) if _stats["acquired"] else 0.0
+    if _pool is None: return {"initialized": False, **s}
+    return {"initialized": True, "size": _pool.get_size(), "idle": _pool.get_idle_size(),
+            "in_use": _pool.get_size() - _pool.get_idle_size(),
+            "min_size": _pool.get_min_size(), "max_size": _pool.get_max_size(), **s}
@@ -0,0 +1,45 @@
+"""
+Conditional GETs for list and profile endpoints.
+
+cache_versions (migration 010) keeps a counter per cache scope that triggers
+bump on every write feeding that scope; shared scopes are spread over slot
+rows (migration 018) and their version is the sum. An ETag is a hash of the resource
+name, the scope versions, the query string and the deployed code, so it
+changes whenever the response could. Endpoints call conditional() before
+running their query: a matching If-None-Match is answered with 304 after
+one index lookup.
+"""
+import hashlib
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Tuple
+from fastapi import Request, Response
+
+DIRECTORY = ("directory", "00000000-0000-0000-0000-000000000000")
+# Same code => same ETags on every instance; a deploy that reshapes a response invalidates them
+_CODE = hashlib.sha1(b"".join(f.read_bytes() for f in sorted(Path(__file__).parent.glob("*.py")))).hexdigest()[:12]
+
+
+async def scope_versions(conn, scopes: Sequence[Tuple[str, str]]) -> str:
+    rows = await conn.fetch("""SELECT s.t, (SELECT COALESCE(SUM(v.version),0) FROM cache_versions v WHERE v.scope_type=s.t AND v.scope_id=s.id) AS version
+                               FROM unnest($1::text[],$2::uuid[]) WITH ORDINALITY s(t,id,n) ORDER BY s.n""",
+                            [t for t, _ in scopes], [i for _, i in scopes])
+    return ",".join(f"{t}:{i}:{r['version']}" for (t, i), r in zip(scopes, rows))
+
+def make_etag(request: Request, resource: str, versions: str, extra: Iterable = ()) -> str:
+    key = "|".join([_CODE, resource, versions, str(sorted(request.query_params.multi_items())), *map(str, extra)])
+    return f'W/"{hashlib.sha1(key.encode()).hexdigest()[:24]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header: return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+async def conditional(conn, request: Request, response: Response, resource: str, scopes: Sequence[Tuple[str, str]],
+                      extra: Iterable = (), public: bool = False) -> Optional[Response]:
+    """Set ETag/Cache-Control on `response`; return a 304 to send instead if the client copy is current."""
+    etag = make_etag(request, resource, await scope_versions(conn, scopes), extra)
+    headers = {"ETag": etag, "Cache-Control": f"{'public' if public else 'private'}, no-cache", "Vary": "X-Coach-Id"}
+    if etag_matches(request, etag): return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
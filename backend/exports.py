@@ -0,0 +1,107 @@
+"""
+Streaming exports of a coach's (or the whole org's) data as CSV or NDJSON.
+
+Rows are read from a server-side cursor inside a read-only REPEATABLE READ
+transaction, FETCH_ROWS at a time, and written to the response in chunks of
+about CHUNK_BYTES (optionally gzip-compressed), so the first bytes go out
+after the first fetch and memory stays flat whatever the row count. The
+connection is held for the length of the download and released when the
+stream ends or the client disconnects. Sessions are stored sessions only;
+series occurrences that were never materialised are not rows yet.
+"""
+import csv, io, json, os, zlib
+from datetime import date
+from typing import AsyncIterator, Optional
+from db import get_db, release_db
+
+FORMATS = ("csv", "ndjson")
+FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", 1000))
+CHUNK_BYTES = 64 * 1024
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+ATTENDED = ("confirmed", "completed")
+
+# kind: SELECT with a {where} slot, coach-scope condition ($1), time column for from/to, order, jsonb columns
+EXPORTS = {
+    "clients": dict(
+        sql="""SELECT u.id::text,u.full_name as name,u.email,u.phone,u.metadata,u.created_at::text,cc.created_at::text as linked_at,cc.coach_id::text
+               FROM users u LEFT JOIN coach_clients cc ON cc.client_id=u.id
+               WHERE u.role='client' AND u.is_active=true AND u.deleted_at IS NULL{where}""",
+        coach="cc.coach_id=$1::uuid", time="u.created_at", order="u.created_at,u.id,cc.coach_id", json=("metadata",)),
+    "sessions": dict(
+        sql="""SELECT ss.id::text,ss.scheduled_at::text,ss.duration_minutes,ss.status,ss.client_id::text,u.full_name as client_name,
+                      st.name as workout_name,ss.location,ss.notes,ss.cancelled_reason,ss.series_id::text,ss.coach_id::text
+               FROM scheduled_sessions ss LEFT JOIN users u ON ss.client_id=u.id LEFT JOIN session_templates st ON ss.session_template_id=st.id
+               WHERE true{where}""",
+        coach="ss.coach_id=$1::uuid", time="ss.scheduled_at", order="ss.scheduled_at,ss.id", json=()),
+    "attendance": dict(
+        sql=f"""SELECT ss.id::text as session_id,ss.scheduled_at::text,ss.client_id::text,u.full_name as client_name,ss.status,
+                       ss.status IN ('{"','".join(ATTENDED)}') as attended,ss.coach_id::text
+                FROM scheduled_sessions ss LEFT JOIN users u ON ss.client_id=u.id
+                WHERE ss.scheduled_at < NOW() AND ss.status IN ('confirmed','completed','no_show'){{where}}""",
+        coach="ss.coach_id=$1::uuid", time="ss.scheduled_at", order="ss.scheduled_at,ss.id", json=()),
+    "leads": dict(
+        sql="""SELECT id::text,lead_type,name,email,phone,message,referral_code,referred_by_name,referred_by_email,status,coach_notes,
+                      created_at::text,coach_id::text
+               FROM leads WHERE true{where}""",
+        coach="coach_id=$1::uuid", time="created_at", order="created_at,id", json=()),
+    "progress": dict(
+        sql="""SELECT pr.id::text,pr.client_id::text,u.full_name as client_name,pr.record_type,pr.recorded_at::text,pr.metrics,pr.notes
+               FROM progress_records pr JOIN users u ON u.id=pr.client_id
+               WHERE true{where}""",
+        coach="EXISTS (SELECT 1 FROM coach_clients cc WHERE cc.coach_id=$1::uuid AND cc.client_id=pr.client_id)",
+        time="pr.recorded_at", order="pr.client_id,pr.recorded_at,pr.id", json=("metrics",)),
+}
+
+
+def build_query(kind: str, coach_id: Optional[str], start: Optional[date] = None, end: Optional[date] = None):
+    """(sql, params) for an export; no coach_id means every row in the org. Days are [start, end)."""
+    e, where, p = EXPORTS[kind], "", []
+    if coach_id: p.append(coach_id); where += f" AND {e['coach']}"
+    if start: p.append(start); where += f" AND {e['time']}>=${len(p)}::date::timestamp AT TIME ZONE 'UTC'"
+    if end: p.append(end); where += f" AND {e['time']}<${len(p)}::date::timestamp AT TIME ZONE 'UTC'"
+    return e["sql"].format(where=where) + f" ORDER BY {e['order']}", p
+
+def _csv_value(v):
+    if v is None: return ""
+    if isinstance(v, bool): return "true" if v else "false"
+    return v
+
+class _Encoder:
+    """Serialises rows into an output buffer, gzip-compressed if asked."""
+    def __init__(self, fmt: str, json_cols, gzipped: bool):
+        self.json_cols = set(json_cols)
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text, lineterminator="\n") if fmt == "csv" else None
+        self.z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzipped else None
+
+    def add(self, r):
+        if self.writer: self.writer.writerow([_csv_value(v) for v in r.values()])
+        else:
+            row = dict(r)
+            for c in self.json_cols:
+                if isinstance(row.get(c), str): row[c] = json.loads(row[c])
+            self.text.write(json.dumps(row, default=str)); self.text.write("\n")
+
+    def full(self) -> bool:
+        return self.text.tell() >= CHUNK_BYTES
+
+    def take(self, final: bool = False) -> bytes:
+        data = self.text.getvalue().encode(); self.text.seek(0); self.text.truncate()
+        if self.z: data = self.z.compress(data) + (self.z.flush() if final else b"")
+        return data
+
+async def stream_export(kind: str, fmt: str, coach_id: Optional[str], start: Optional[date] = None, end: Optional[date] = None,
+                        gzipped: bool = False) -> AsyncIterator[bytes]:
+    """Body chunks of an export. CSV starts with a header row (the column names) even when there are no rows."""
+    sql, p = build_query(kind, coach_id, start, end)
+    out = _Encoder(fmt, EXPORTS[kind]["json"], gzipped)
+    conn = await get_db()
+    try:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            stmt = await conn.prepare(sql)
+            if fmt == "csv": out.writer.writerow([a.name for a in stmt.get_attributes()])
+            async for r in stmt.cursor(*p, prefetch=FETCH_ROWS):
+                out.add(r)
+                if out.full(): yield out.take()
+        yield out.take(final=True)
+    finally: await release_db(conn)
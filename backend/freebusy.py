@@ -0,0 +1,102 @@
+"""
+Free/busy: when a coach can be booked.
+
+Bookable windows are the coach's slot templates (coach_availability.slots,
+{"start": "HH:MM", "end": "HH:MM"}) on working days (ISO weekdays) that are
+not holidays. Busy time is every non-cancelled session, stored or a series
+occurrence, as [scheduled_at, scheduled_at + duration). Both become sorted,
+merged interval lists and the busy list is subtracted from the windows in one
+linear sweep, so a coach costs O((windows + sessions) log n) whatever the
+range. The data for all requested coaches is loaded with one query per
+source. Times are floating wall-clock times, as stored (see localtime.py).
+"""
+import json
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Tuple
+from localtime import DEFAULT_TIMEZONE, day_range, local_now, valid_timezone
+from recurrence import virtual_sessions
+
+Interval = Tuple[datetime, datetime]
+MAX_COACHES = 50
+DEFAULT_WORKING_DAYS = [1, 2, 3, 4, 5]
+
+
+def merge(intervals: Iterable[Interval]) -> List[Interval]:
+    """Sorted union of `intervals`; overlapping and touching intervals are joined."""
+    out: List[Interval] = []
+    for s, e in sorted(i for i in intervals if i[0] < i[1]):
+        if out and s <= out[-1][1]: out[-1] = (out[-1][0], max(out[-1][1], e))
+        else: out.append((s, e))
+    return out
+
+def subtract(windows: List[Interval], busy: List[Interval]) -> List[Interval]:
+    """Parts of `windows` not covered by `busy`; both merged and sorted (see merge)."""
+    out, j = [], 0
+    for s, e in windows:
+        while j < len(busy) and busy[j][1] <= s: j += 1
+        k = j
+        while k < len(busy) and busy[k][0] < e:
+            if busy[k][0] > s: out.append((s, busy[k][0]))
+            s = max(s, busy[k][1])
+            k += 1
+        if s < e: out.append((s, e))
+    return out
+
+def slot_times(slots) -> List[Tuple[time, time]]:
+    """(start, end) of each well-formed slot template; others are ignored."""
+    out = []
+    for sl in slots or []:
+        try: s, e = time.fromisoformat(str(sl["start"])[:5]), time.fromisoformat(str(sl["end"])[:5])
+        except (KeyError, TypeError, ValueError): continue
+        if s < e: out.append((s, e))
+    return out
+
+def windows(start: date, end: date, working_days, slots: List[Tuple[time, time]], holidays) -> List[Interval]:
+    days = [start + timedelta(days=n) for n in range((end - start).days)]
+    return merge((datetime.combine(d, s), datetime.combine(d, e)) for d in days
+                 if d.isoweekday() in working_days and d not in holidays for s, e in slots)
+
+def starts(free: List[Interval], duration: timedelta, step: timedelta) -> List[datetime]:
+    """Start times of `duration`-long bookings inside `free`, every `step` from each interval's start."""
+    out = []
+    for s, e in free:
+        while s + duration <= e: out.append(s); s += step
+    return out
+
+def _floating(ts) -> datetime:
+    return ts.replace(tzinfo=None) if isinstance(ts, datetime) else datetime.strptime(ts[:19], "%Y-%m-%d %H:%M:%S")
+
+async def free_slots(conn, coach_ids: List[str], start: date, end: date, duration: int, step: int) -> List[dict]:
+    """Per coach: open intervals and bookable start times on days [start, end), nothing before the coach's local now."""
+    coaches = await conn.fetch(
+        """SELECT u.id::text,u.timezone,a.working_days::text,a.slots::text FROM users u LEFT JOIN coach_availability a ON a.coach_id=u.id
+           WHERE u.id=ANY($1::uuid[]) AND u.role='coach'""", coach_ids)
+    ids = [c["id"] for c in coaches]
+    holidays: Dict[str, set] = {}
+    for r in await conn.fetch("SELECT coach_id::text,holiday_date FROM coach_holidays WHERE coach_id=ANY($1::uuid[]) AND holiday_date>=$2 AND holiday_date<$3",
+                              ids, start, end):
+        holidays.setdefault(r["coach_id"], set()).add(r["holiday_date"])
+    # from the day before: a late session can run past midnight
+    lo, hi = day_range(start - timedelta(days=1), end)
+    booked: Dict[str, list] = {}
+    for r in await conn.fetch("""SELECT coach_id::text,scheduled_at,duration_minutes FROM scheduled_sessions
+                                 WHERE coach_id=ANY($1::uuid[]) AND scheduled_at>=$2 AND scheduled_at<$3 AND status<>'cancelled'""", ids, lo, hi):
+        booked.setdefault(r["coach_id"], []).append((r["scheduled_at"], r["duration_minutes"]))
+    for v in await virtual_sessions(conn, start - timedelta(days=1), end, coach_ids=ids):
+        booked.setdefault(v["coach_id"], []).append((v["scheduled_at"], v["duration_minutes"]))
+
+    length, every, out = timedelta(minutes=duration), timedelta(minutes=step), []
+    for c in sorted(coaches, key=lambda c: coach_ids.index(c["id"])):
+        tz = c["timezone"] if valid_timezone(c["timezone"]) else DEFAULT_TIMEZONE
+        working_days = json.loads(c["working_days"]) if c["working_days"] else DEFAULT_WORKING_DAYS
+        open_ = windows(start, end, working_days, slot_times(json.loads(c["slots"]) if c["slots"] else []), holidays.get(c["id"], set()))
+        busy = merge((_floating(at), _floating(at) + timedelta(minutes=m or 60)) for at, m in booked.get(c["id"], []))
+        now = local_now(tz).replace(tzinfo=None, second=0, microsecond=0)
+        free = subtract(open_, merge(busy + [(datetime.min, now)]))
+        days: Dict[date, dict] = {}
+        for s, e in free:
+            days.setdefault(s.date(), {"date": s.date().isoformat(), "free": [], "slots": []})["free"].append(
+                {"start": s.strftime("%H:%M"), "end": e.strftime("%H:%M")})
+        for s in starts(free, length, every): days[s.date()]["slots"].append(s.strftime("%H:%M"))
+        out.append({"coach_id": c["id"], "timezone": tz, "days": [days[d] for d in sorted(days)]})
+    return out
@@ -0,0 +1,43 @@
+"""
+Coach-local days as index-friendly ranges.
+
+Session times are stored as wall-clock ("floating") time: the frontend sends
+"2026-03-02T09:00" and it is kept as 09:00+00, so a calendar day D is the
+half-open range [D 00:00+00, D+1 00:00+00) whatever the coach's zone. The
+coach's timezone (users.timezone, else DEFAULT_TIMEZONE) decides which day
+"today" is. Queries compare scheduled_at against the range bounds instead of
+casting it to date, so (coach_id, scheduled_at) indexes are used.
+"""
+import os
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional, Tuple
+import pytz
+
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Kolkata")  # same env var as Settings.DEFAULT_TIMEZONE
+MAX_RANGE_DAYS = int(os.getenv("SCHEDULE_MAX_RANGE_DAYS", 93))
+
+
+def valid_timezone(name: Optional[str]) -> bool:
+    return bool(name) and name in pytz.all_timezones_set
+
+def zone(name: Optional[str]):
+    return pytz.timezone(name if valid_timezone(name) else DEFAULT_TIMEZONE)
+
+def local_now(tzname: Optional[str] = None) -> datetime:
+    return datetime.now(zone(tzname))
+
+def local_today(tzname: Optional[str] = None) -> date:
+    return local_now(tzname).date()
+
+def day_start(d: date) -> datetime:
+    """Stored instant at which calendar day `d` begins (wall clock kept as UTC)."""
+    return datetime.combine(d, time.min, tzinfo=timezone.utc)
+
+def day_range(start: date, end: Optional[date] = None) -> Tuple[datetime, datetime]:
+    """Half-open [start, end) in stored time; `end` defaults to the day after `start`."""
+    return day_start(start), day_start(end or start + timedelta(days=1))
+
+async def coach_timezone(conn, coach_id: Optional[str]) -> str:
+    if not coach_id: return DEFAULT_TIMEZONE
+    tz = await conn.fetchval("SELECT timezone FROM users WHERE id=$1::uuid", coach_id)
+    return tz if valid_timezone(tz) else DEFAULT_TIMEZONE
@@ -1,7 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import asyncpg
-import os
+from db import get_db, release_db, pool_stats
 
 app = FastAPI(
     title="Coach Platform API",
@@ -37,19 +36,12 @@ def root():
 @app.get("/health")
 async def health():
     try:
-        conn = await asyncpg.connect(
-            host=os.getenv("DB_HOST", "coach-db-1770519048.postgres.database.azure.com"),
-            port=int(os.getenv("DB_PORT", 5432)),
-            user=os.getenv("DB_USER", "dbadmin"),
-            password=os.getenv("DB_PASSWORD", "CoachPlatform2026!SecureDB"),
-            database=os.getenv("DB_NAME", "coach_platform"),
-            ssl="require" if os.getenv("DB_SSL", "true").lower() == "true" else None,
-        )
-        await conn.execute('SELECT 1')
-        await conn.close()
-        return {"success": True, "status": "healthy", "checks": {"api": "operational", "database": "connected"}}
+        conn = await get_db()
+        try: await conn.execute('SELECT 1')
+        finally: await release_db(conn)
+        return {"success": True, "status": "healthy", "checks": {"api": "operational", "database": "connected"}, "pool": pool_stats()}
     except Exception as e:
-        return {"success": False, "status": "degraded", "checks": {"api": "operational", "database": f"error: {str(e)}"}}
+        return {"success": False, "status": "degraded", "checks": {"api": "operational", "database": f"error: {str(e)}"}, "pool": pool_stats()}
 
 # Import the router from complete_api (which has NO prefix — we add it here)
 from complete_api import router
@@ -0,0 +1,257 @@
+"""
+Outgoing messages: message_queue and the dispatcher that drains it.
+
+enqueue() adds a row; the dispatcher claims due rows in batches with
+FOR UPDATE SKIP LOCKED, so any number of workers (the in-process loop and
+`python messaging.py` processes) can drain the queue in parallel without two
+of them taking the same row. A claim is a lease (migration 012): the rows are
+marked 'sending' with the batch's claimed_by token and a claimed_until
+deadline, sent outside any transaction, and the outcome is written back only
+if the claim is still ours. A worker that dies mid-batch leaves its rows to
+be requeued once the lease runs out, so delivery is at-least-once.
+
+Each channel (whatsapp, sms, email) is sent by an adapter from CHANNELS:
+Meta WhatsApp Cloud API, Twilio SMS and SendGrid when configured, or for
+every channel the file/log transports (MESSAGE_TRANSPORT=file|log) for local
+runs and tests. Only channels with an adapter are claimed. Network errors,
+429 and 5xx are retried with exponential backoff by moving scheduled_for;
+other failures, and the last allowed attempt, mark the row 'failed'.
+"""
+import asyncio, json, logging, os, random, re, uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+import httpx
+from db import get_db, release_db
+
+BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", 50))
+CONCURRENCY = int(os.getenv("MESSAGE_SEND_CONCURRENCY", 10))  # sends in flight per batch
+POLL_SECONDS = float(os.getenv("MESSAGE_POLL_SECONDS", 5))  # 0 disables the in-process dispatcher
+LEASE_SECONDS = int(os.getenv("MESSAGE_LEASE_SECONDS", 300))
+MAX_ATTEMPTS = int(os.getenv("MESSAGE_MAX_ATTEMPTS", 5))
+BACKOFF_SECONDS = float(os.getenv("MESSAGE_RETRY_BACKOFF_SECONDS", 30))
+MAX_BACKOFF_SECONDS = 3600
+TRANSPORT = os.getenv("MESSAGE_TRANSPORT", "provider")  # provider, file or log
+OUTBOX = os.getenv("MESSAGE_OUTBOX", "outbox.jsonl")
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+log = logging.getLogger(__name__)
+_client: Optional[httpx.AsyncClient] = None
+_task: Optional[asyncio.Task] = None
+
+
+class SendError(Exception):
+    """A message could not be sent; `retry` if a later attempt may succeed."""
+
+    def __init__(self, message: str, retry: bool = False):
+        super().__init__(message)
+        self.retry = retry
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(30, connect=5))
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None: await _client.aclose()
+    _client = None
+
+def digits(phone: Optional[str]) -> str:
+    return re.sub(r"\D", "", phone or "")
+
+async def _post(url: str, **kwargs) -> httpx.Response:
+    try: response = await get_client().post(url, **kwargs)
+    except (httpx.TimeoutException, httpx.NetworkError) as e: raise SendError(f"Provider unreachable: {e.__class__.__name__}", retry=True)
+    if response.is_error: raise SendError(f"Provider returned {response.status_code}: {response.text[:200]}", retry=response.status_code in RETRY_STATUS)
+    return response
+
+
+# ==================== CHANNELS ====================
+class Channel:
+    """Sends one claimed message ({id, channel, phone, email, content, metadata}); returns the provider's message id."""
+
+    async def send(self, msg: dict) -> Optional[str]:
+        raise NotImplementedError
+
+class WhatsAppCloud(Channel):
+    def __init__(self, phone_number_id: str, token: str, version: str = "v18.0"):
+        self.url, self.headers = f"https://graph.facebook.com/{version}/{phone_number_id}/messages", {"Authorization": f"Bearer {token}"}
+
+    async def send(self, msg: dict) -> Optional[str]:
+        if not digits(msg["phone"]): raise SendError("No phone number")
+        body = {"messaging_product": "whatsapp", "to": digits(msg["phone"]), "type": "text", "text": {"body": msg["content"]}}
+        return ((await _post(self.url, json=body, headers=self.headers)).json().get("messages") or [{}])[0].get("id")
+
+class TwilioSms(Channel):
+    def __init__(self, account_sid: str, auth_token: str, sender: str):
+        self.url, self.auth, self.sender = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json", (account_sid, auth_token), sender
+
+    async def send(self, msg: dict) -> Optional[str]:
+        if not digits(msg["phone"]): raise SendError("No phone number")
+        data = {"To": "+" + digits(msg["phone"]), "From": self.sender, "Body": msg["content"]}
+        return (await _post(self.url, data=data, auth=self.auth)).json().get("sid")
+
+class SendGridEmail(Channel):
+    def __init__(self, api_key: str, sender: str, sender_name: str = ""):
+        self.headers, self.sender = {"Authorization": f"Bearer {api_key}"}, {"email": sender, **({"name": sender_name} if sender_name else {})}
+
+    async def send(self, msg: dict) -> Optional[str]:
+        if not msg["email"]: raise SendError("No email address")
+        body = {"personalizations": [{"to": [{"email": msg["email"]}]}], "from": self.sender,
+                "subject": msg["metadata"].get("subject") or "Message from your coach", "content": [{"type": "text/plain", "value": msg["content"]}]}
+        return (await _post("https://api.sendgrid.com/v3/mail/send", json=body, headers=self.headers)).headers.get("x-message-id")
+
+class FileTransport(Channel):
+    """Appends each message as a JSON line to `path` instead of sending it."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def send(self, msg: dict) -> Optional[str]:
+        line = json.dumps({**msg, "sent_at": datetime.utcnow().isoformat()}, default=str) + "\n"
+        await asyncio.to_thread(self._append, line)
+        return f"file:{msg['id']}"
+
+    def _append(self, line: str):
+        with open(self.path, "a") as f: f.write(line)
+
+class LogTransport(Channel):
+    async def send(self, msg: dict) -> Optional[str]:
+        log.info("message %s via %s to %s: %s", msg["id"], msg["channel"], msg["phone"] or msg["email"], msg["content"][:200])
+        return f"log:{msg['id']}"
+
+def default_channels() -> Dict[str, Channel]:
+    if TRANSPORT == "file": return dict.fromkeys(("whatsapp", "sms", "email"), FileTransport(OUTBOX))
+    if TRANSPORT == "log": return dict.fromkeys(("whatsapp", "sms", "email"), LogTransport())
+    env, out = os.environ, {}
+    if env.get("META_WHATSAPP_PHONE_NUMBER_ID") and env.get("META_WHATSAPP_ACCESS_TOKEN"):
+        out["whatsapp"] = WhatsAppCloud(env["META_WHATSAPP_PHONE_NUMBER_ID"], env["META_WHATSAPP_ACCESS_TOKEN"], env.get("META_WHATSAPP_API_VERSION", "v18.0"))
+    if env.get("TWILIO_ACCOUNT_SID") and env.get("TWILIO_AUTH_TOKEN") and env.get("TWILIO_SMS_NUMBER"):
+        out["sms"] = TwilioSms(env["TWILIO_ACCOUNT_SID"], env["TWILIO_AUTH_TOKEN"], env["TWILIO_SMS_NUMBER"])
+    if env.get("SENDGRID_API_KEY") and env.get("EMAIL_FROM_ADDRESS"):
+        out["email"] = SendGridEmail(env["SENDGRID_API_KEY"], env["EMAIL_FROM_ADDRESS"], env.get("EMAIL_FROM_NAME", ""))
+    return out
+
+CHANNELS: Dict[str, Channel] = default_channels()
+
+def register_channel(name: str, channel: Optional[Channel]):
+    """Send `name` messages through `channel` (None stops claiming them)."""
+    if channel is None: CHANNELS.pop(name, None)
+    else: CHANNELS[name] = channel
+
+
+# ==================== QUEUE ====================
+async def enqueue(conn, channel: str, content: str, recipient_id: Optional[str] = None, phone: Optional[str] = None, email: Optional[str] = None,
+                  message_type: Optional[str] = None, metadata: Optional[dict] = None, scheduled_for: Optional[datetime] = None,
+                  org_id: Optional[str] = None) -> str:
+    """Queue a message; phone/email default to the recipient's when the batch is claimed. Returns its id."""
+    return await conn.fetchval(
+        """INSERT INTO message_queue (org_id,recipient_id,recipient_phone,recipient_email,channel,message_type,message_content,metadata,scheduled_for)
+           VALUES ($1::uuid,$2::uuid,$3,$4,$5,$6,$7,$8::jsonb,COALESCE($9,NOW())) RETURNING id::text""",
+        org_id, recipient_id, phone, email, channel, message_type, content, json.dumps(metadata or {}), scheduled_for)
+
+async def requeue_expired(conn) -> int:
+    """Put rows of claims whose lease ran out back in the queue (their worker died or hung); counts as an attempt."""
+    r = await conn.execute("""UPDATE message_queue SET status=CASE WHEN retry_count+1>=$1 THEN 'failed' ELSE 'queued' END,retry_count=retry_count+1,
+                                     claimed_by=NULL,claimed_until=NULL,scheduled_for=NOW(),failed_reason='Claim expired'
+                              WHERE status='sending' AND claimed_until<NOW()""", MAX_ATTEMPTS)
+    return int(r.split()[-1])
+
+async def claim(conn, limit: int, channels: List[str]) -> List[dict]:
+    """Claim up to `limit` due messages for `channels`; rows locked by another worker are skipped."""
+    token = uuid.uuid4()
+    rows = await conn.fetch(
+        """WITH due AS (SELECT id FROM message_queue WHERE status='queued' AND scheduled_for<=NOW() AND channel=ANY($2::text[])
+                        ORDER BY scheduled_for LIMIT $1 FOR UPDATE SKIP LOCKED)
+           UPDATE message_queue m SET status='sending',claimed_by=$3,claimed_until=NOW()+make_interval(secs=>$4)
+           FROM due WHERE m.id=due.id
+           RETURNING m.id::text,m.channel,COALESCE(m.recipient_phone,(SELECT phone FROM users WHERE id=m.recipient_id)) AS phone,
+                     COALESCE(m.recipient_email,(SELECT email FROM users WHERE id=m.recipient_id)) AS email,
+                     m.message_type,m.message_content AS content,m.metadata::text,m.retry_count,m.claimed_by""",
+        limit, channels, token, LEASE_SECONDS)
+    return [{**dict(r), "metadata": json.loads(r["metadata"] or "{}")} for r in rows]
+
+def backoff(attempt: int) -> float:
+    return min(BACKOFF_SECONDS * 2 ** attempt, MAX_BACKOFF_SECONDS) * (0.5 + random.random())
+
+async def _send(msg: dict, limit: asyncio.Semaphore) -> tuple:
+    """(id, status, provider id, error, retry delay) for one claimed message."""
+    async with limit:
+        try: return msg["id"], "sent", await CHANNELS[msg["channel"]].send(msg), None, 0.0
+        except Exception as e:
+            retry = e.retry if isinstance(e, SendError) else True
+            error = str(e)[:500] or e.__class__.__name__
+            if retry and msg["retry_count"] + 1 < MAX_ATTEMPTS: return msg["id"], "queued", None, error, backoff(msg["retry_count"])
+            return msg["id"], "failed", None, error, 0.0
+
+async def record(conn, token, results: List[tuple]):
+    """Write send outcomes back in one statement, skipping rows whose claim was taken over."""
+    if not results: return
+    ids, statuses, providers, errors, delays = map(list, zip(*results))
+    await conn.execute(
+        """UPDATE message_queue m SET status=r.status,provider_message_id=COALESCE(r.provider_id,m.provider_message_id),failed_reason=r.error,
+                  sent_at=CASE WHEN r.status='sent' THEN NOW() ELSE m.sent_at END,
+                  retry_count=m.retry_count+(r.status<>'sent')::int,
+                  scheduled_for=CASE WHEN r.status='queued' THEN NOW()+make_interval(secs=>r.delay) ELSE m.scheduled_for END,
+                  claimed_by=NULL,claimed_until=NULL
+           FROM unnest($1::uuid[],$2::text[],$3::text[],$4::text[],$5::float8[]) r(id,status,provider_id,error,delay)
+           WHERE m.id=r.id AND m.status='sending' AND m.claimed_by=$6""",
+        ids, statuses, providers, errors, delays, token)
+
+async def dispatch_once(limit: int = BATCH_SIZE) -> dict:
+    """Claim one batch, send it and record the outcome; counts by status."""
+    if not CHANNELS: return {}
+    conn = await get_db()
+    try:
+        await requeue_expired(conn)
+        batch = await claim(conn, limit, list(CHANNELS))
+    finally: await release_db(conn)
+    if not batch: return {}
+    sem = asyncio.Semaphore(CONCURRENCY)
+    results = await asyncio.gather(*(_send(m, sem) for m in batch))
+    conn = await get_db()
+    try: await record(conn, batch[0]["claimed_by"], results)
+    finally: await release_db(conn)
+    counts: Dict[str, int] = {}
+    for r in results: counts[r[1]] = counts.get(r[1], 0) + 1
+    return counts
+
+async def run_dispatcher(poll_seconds: float = POLL_SECONDS):
+    """Drain the queue forever: batches back to back while full, otherwise poll every `poll_seconds`."""
+    while True:
+        try: counts = await dispatch_once()
+        except Exception: log.exception("message dispatch failed"); counts = {}
+        if counts: log.info("messages dispatched: %s", counts)
+        if sum(counts.values()) < BATCH_SIZE: await asyncio.sleep(poll_seconds or 5)
+
+def start_dispatcher():
+    global _task
+    if POLL_SECONDS > 0 and _task is None: _task = asyncio.create_task(run_dispatcher())
+
+async def stop_dispatcher():
+    global _task
+    if _task is not None:
+        task, _task = _task, None
+        task.cancel()
+        try: await task
+        except asyncio.CancelledError: pass
+    await close_client()
+
+
+if __name__ == "__main__":
+    import sys
+    from db import init_pool, close_pool
+
+    async def main():
+        logging.basicConfig(level=logging.INFO)
+        await init_pool()
+        try:
+            if "--once" in sys.argv: print(await dispatch_once())
+            else: await run_dispatcher()
+        finally:
+            await close_client()
+            await close_pool()
+
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Versioned schema migrations.
+
+Applies backend/migrations/NNN_name.sql in order, each in its own transaction,
+and records applied versions in schema_migrations. Runs once at startup (or
+from a deploy step: `python migrate.py`) so request handlers do no DDL.
+"""
+import asyncio, os, re
+from pathlib import Path
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+# Base schema for an empty database (docker-compose loads the same file via initdb)
+BASE_SCHEMA = Path(os.getenv("DB_SCHEMA_FILE", Path(__file__).parent.parent / "database" / "schema.sql"))
+LOCK_KEY = 7203114  # pg_advisory_lock key; serializes workers starting at the same time
+_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def list_migrations():
+    found = []
+    for f in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        m = _NAME.match(f.name)
+        if m: found.append((int(m.group(1)), m.group(2), f))
+    versions = [v for v, _, _ in found]
+    if len(versions) != len(set(versions)): raise RuntimeError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return sorted(found)
+
+async def run_migrations(conn) -> list:
+    """Apply pending migrations. Returns the list of versions applied by this call."""
+    await conn.execute("SELECT pg_advisory_lock($1)", LOCK_KEY)
+    try:
+        if not await conn.fetchval("SELECT to_regclass('users') IS NOT NULL"):
+            if not BASE_SCHEMA.exists(): raise RuntimeError(f"Empty database and base schema {BASE_SCHEMA} not found")
+            async with conn.transaction():
+                await conn.execute(BASE_SCHEMA.read_text())
+        await conn.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY, name VARCHAR(255) NOT NULL, applied_at TIMESTAMPTZ DEFAULT NOW())""")
+        done = {r["version"] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+        applied = []
+        for version, name, path in list_migrations():
+            if version in done: continue
+            async with conn.transaction():
+                await conn.execute(path.read_text())
+                await conn.execute("INSERT INTO schema_migrations (version,name) VALUES ($1,$2)", version, name)
+            applied.append(version)
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
+
+async def schema_version(conn):
+    return await conn.fetchval("SELECT MAX(version) FROM schema_migrations")
+
+
+if __name__ == "__main__":
+    import asyncpg
+    from db import DB_CONFIG
+
+    async def main():
+        conn = await asyncpg.connect(**DB_CONFIG)
+        try:
+            applied = await run_migrations(conn)
+            print(f"Applied {applied or 'nothing'}; schema version {await schema_version(conn)}")
+        finally: await conn.close()
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+-- ================================================================
+-- 001: tables/columns the API used to create on every request (ensure_tables)
+-- Idempotent so it can be applied to databases that already have them.
+-- ================================================================
+
+ALTER TABLE organizations ADD COLUMN IF NOT EXISTS slug VARCHAR(100);
+ALTER TABLE organizations ADD COLUMN IF NOT EXISTS subscription_tier VARCHAR(50);
+
+-- Default organization (was inserted lazily by ensure_org)
+INSERT INTO organizations (id, name, category, slug, subscription_tier, is_active, created_at)
+SELECT '00000000-0000-0000-0000-000000000001'::uuid, 'CoachMe', 'fitness', 'coachme', 'pro', true, NOW()
+WHERE NOT EXISTS (SELECT 1 FROM organizations);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS logo_url TEXT;
+
+CREATE TABLE IF NOT EXISTS coach_reviews (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    client_id UUID REFERENCES users(id) ON DELETE SET NULL,
+    client_name VARCHAR(255),
+    client_email VARCHAR(255),
+    rating INT NOT NULL CHECK (rating BETWEEN 1 AND 5),
+    review_text TEXT,
+    is_public BOOLEAN DEFAULT true,
+    is_approved BOOLEAN DEFAULT true,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_reviews_coach ON coach_reviews(coach_id) WHERE is_public = true;
+
+CREATE TABLE IF NOT EXISTS leads (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    lead_type VARCHAR(50) NOT NULL DEFAULT 'interest',
+    name VARCHAR(255) NOT NULL,
+    email VARCHAR(255),
+    phone VARCHAR(50),
+    message TEXT,
+    referral_code VARCHAR(100),
+    referred_by_name VARCHAR(255),
+    referred_by_email VARCHAR(255),
+    status VARCHAR(50) DEFAULT 'new',
+    coach_notes TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_leads_coach_created ON leads(coach_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS coach_availability (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    working_days JSONB DEFAULT '[1,2,3,4,5]',
+    slots JSONB DEFAULT '[]',
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE(coach_id)
+);
+
+CREATE TABLE IF NOT EXISTS coach_holidays (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    holiday_date DATE NOT NULL,
+    reason VARCHAR(255),
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_coach_holidays_coach_date ON coach_holidays(coach_id, holiday_date);
+
+CREATE TABLE IF NOT EXISTS progress_records (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    org_id UUID,
+    client_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    recorded_by UUID REFERENCES users(id) ON DELETE SET NULL,
+    record_type VARCHAR(50) DEFAULT 'measurement',
+    metrics JSONB DEFAULT '{}',
+    notes TEXT,
+    recorded_at TIMESTAMPTZ DEFAULT NOW(),
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_progress_records_client ON progress_records(client_id, recorded_at DESC);
+
+-- Allow cancel_requested (client portal) and in_progress (/sessions/{sid}/start)
+ALTER TABLE scheduled_sessions DROP CONSTRAINT IF EXISTS scheduled_sessions_status_check;
+ALTER TABLE scheduled_sessions ADD CONSTRAINT scheduled_sessions_status_check
+    CHECK (status IN ('scheduled', 'confirmed', 'in_progress', 'completed', 'cancelled', 'no_show', 'cancel_requested'));
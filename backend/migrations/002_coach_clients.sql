@@ -0,0 +1,21 @@
+-- ================================================================
+-- 002: first-class coach <-> client relation
+-- Replaces filtering users on metadata->>'coach_id' (unindexed JSONB scan).
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS coach_clients (
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    client_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (coach_id, client_id)
+);
+CREATE INDEX IF NOT EXISTS idx_coach_clients_coach_created ON coach_clients(coach_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_coach_clients_client ON coach_clients(client_id);
+
+-- Backfill from existing metadata (text join so malformed ids are skipped, not cast errors)
+INSERT INTO coach_clients (coach_id, client_id, created_at)
+SELECT c.id, u.id, u.created_at
+FROM users u
+JOIN users c ON c.id::text = u.metadata->>'coach_id' AND c.role = 'coach'
+WHERE u.role = 'client' AND u.metadata ? 'coach_id'
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,36 @@
+-- ================================================================
+-- 003: recurring session series stored once, expanded on read
+-- Occurrences are only materialised into scheduled_sessions when a
+-- single occurrence is attended, cancelled or otherwise touched.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS session_series (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    org_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+    coach_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    client_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    session_template_id UUID REFERENCES session_templates(id) ON DELETE SET NULL,
+    freq VARCHAR(10) NOT NULL CHECK (freq IN ('daily', 'weekly', 'monthly')),
+    freq_interval INT NOT NULL DEFAULT 1 CHECK (freq_interval >= 1),
+    by_weekday SMALLINT[],                       -- ISO weekdays 1=Mon..7=Sun
+    start_date DATE NOT NULL,
+    start_time TIME NOT NULL,
+    until_date DATE,
+    occurrence_count INT CHECK (occurrence_count > 0),
+    exdates DATE[] NOT NULL DEFAULT '{}',
+    skip_holidays BOOLEAN NOT NULL DEFAULT true,
+    duration_minutes INT DEFAULT 60,
+    location VARCHAR(255),
+    status VARCHAR(20) NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'cancelled')),
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_session_series_coach ON session_series(coach_id, start_date) WHERE status = 'active';
+CREATE INDEX IF NOT EXISTS idx_session_series_client ON session_series(client_id, start_date) WHERE status = 'active';
+
+DROP TRIGGER IF EXISTS update_session_series_updated_at ON session_series;
+CREATE TRIGGER update_session_series_updated_at BEFORE UPDATE ON session_series FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+ALTER TABLE scheduled_sessions ADD COLUMN IF NOT EXISTS series_id UUID REFERENCES session_series(id) ON DELETE CASCADE;
+ALTER TABLE scheduled_sessions ADD COLUMN IF NOT EXISTS occurrence_date DATE;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_scheduled_sessions_occurrence ON scheduled_sessions(series_id, occurrence_date) WHERE series_id IS NOT NULL;
@@ -0,0 +1,24 @@
+-- Indexes matching the keyset order of the paginated list endpoints:
+-- (scope, sort timestamp DESC, id DESC), so a page is one index range scan.
+
+CREATE INDEX IF NOT EXISTS idx_users_clients_created ON users(created_at DESC, id DESC)
+    WHERE role = 'client' AND is_active = true AND deleted_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_users_coaches_created ON users(created_at DESC, id DESC)
+    WHERE role = 'coach' AND is_active = true AND deleted_at IS NULL;
+
+DROP INDEX IF EXISTS idx_coach_clients_coach_created;
+CREATE INDEX IF NOT EXISTS idx_coach_clients_coach_page ON coach_clients(coach_id, created_at DESC, client_id DESC);
+
+DROP INDEX IF EXISTS idx_leads_coach_created;
+CREATE INDEX IF NOT EXISTS idx_leads_coach_page ON leads(coach_id, created_at DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_reviews_coach;
+CREATE INDEX IF NOT EXISTS idx_reviews_coach_page ON coach_reviews(coach_id, created_at DESC, id DESC) WHERE is_public = true;
+
+DROP INDEX IF EXISTS idx_progress_records_client;
+CREATE INDEX IF NOT EXISTS idx_progress_records_client_page ON progress_records(client_id, recorded_at DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_scheduled_sessions_coach;
+DROP INDEX IF EXISTS idx_scheduled_sessions_client;
+CREATE INDEX IF NOT EXISTS idx_scheduled_sessions_coach_page ON scheduled_sessions(coach_id, scheduled_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_scheduled_sessions_client_page ON scheduled_sessions(client_id, scheduled_at DESC, id DESC);
@@ -0,0 +1,126 @@
+-- ================================================================
+-- 005: incrementally maintained dashboard counters
+-- /dashboard/stats reads one row per coach (or org) instead of four COUNT(*)s.
+-- Statement-level triggers fold each INSERT/UPDATE/DELETE into one upsert per
+-- affected scope, so bulk imports cost one counter write, not one per row.
+-- counters.reconcile() recomputes the same numbers from the source tables.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS dashboard_counters (
+    scope_type VARCHAR(10) NOT NULL CHECK (scope_type IN ('coach', 'org')),
+    scope_id UUID NOT NULL,
+    clients BIGINT NOT NULL DEFAULT 0,
+    sessions BIGINT NOT NULL DEFAULT 0,
+    completed_sessions BIGINT NOT NULL DEFAULT 0,
+    workouts BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (scope_type, scope_id)
+);
+
+-- What one source row contributes to each scope it counts towards.
+-- reconcile() sums the same functions over whole tables, so both paths agree by construction.
+CREATE OR REPLACE FUNCTION session_counts(r scheduled_sessions)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT v.k, v.id, 0, 1, COALESCE(r.status IN ('completed', 'confirmed'), false)::int, 0
+    FROM (VALUES ('coach', r.coach_id), ('org', r.org_id)) v(k, id) WHERE v.id IS NOT NULL
+$$;
+
+CREATE OR REPLACE FUNCTION template_counts(r session_templates)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT v.k, v.id, 0, 0, 0, 1
+    FROM (VALUES ('coach', r.created_by), ('org', r.org_id)) v(k, id)
+    WHERE v.id IS NOT NULL AND r.is_active AND r.deleted_at IS NULL
+$$;
+
+-- An active client counts once for its org and once for every linked coach.
+-- Inserting or deleting a user only moves the org count: the coach counts move
+-- with the coach_clients rows (link_counts), which may be written by the same statement.
+CREATE OR REPLACE FUNCTION client_org_counts(r users)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'org', r.primary_org_id, 1, 0, 0, 0
+    WHERE r.primary_org_id IS NOT NULL AND r.role = 'client' AND r.is_active AND r.deleted_at IS NULL
+$$;
+
+CREATE OR REPLACE FUNCTION client_counts(r users)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql STABLE AS $$
+    SELECT * FROM client_org_counts(r)
+    UNION ALL
+    SELECT 'coach', cc.coach_id, 1, 0, 0, 0 FROM coach_clients cc
+    WHERE cc.client_id = r.id AND r.role = 'client' AND r.is_active AND r.deleted_at IS NULL
+$$;
+
+-- A link counts while its client is active. Links removed by a hard user
+-- delete (ON DELETE CASCADE) no longer see the user and are left to reconcile().
+CREATE OR REPLACE FUNCTION link_counts(r coach_clients)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql STABLE AS $$
+    SELECT 'coach', r.coach_id, 1, 0, 0, 0 FROM users u
+    WHERE u.id = r.client_id AND u.role = 'client' AND u.is_active AND u.deleted_at IS NULL
+$$;
+
+-- Statement trigger: TG_ARGV[0] names the *_counts function for the table.
+-- Unchanged rows of an UPDATE cancel out and groups with no net change are skipped.
+-- Scopes are upserted in key order so concurrent statements cannot deadlock.
+CREATE OR REPLACE FUNCTION maintain_dashboard_counters() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    f TEXT := quote_ident(TG_ARGV[0]);
+    src TEXT;
+BEGIN
+    src := CASE TG_OP
+        WHEN 'INSERT' THEN format('SELECT c.*, 1 AS sign FROM new_rows r, %s(r) c', f)
+        WHEN 'DELETE' THEN format('SELECT c.*, -1 AS sign FROM old_rows r, %s(r) c', f)
+        ELSE format('SELECT c.*, 1 AS sign FROM new_rows r, %1$s(r) c UNION ALL SELECT c.*, -1 FROM old_rows r, %1$s(r) c', f)
+    END;
+    EXECUTE format($q$
+        INSERT INTO dashboard_counters AS d (scope_type, scope_id, clients, sessions, completed_sessions, workouts)
+        SELECT scope_type, scope_id, SUM(sign * clients), SUM(sign * sessions), SUM(sign * completed_sessions), SUM(sign * workouts)
+        FROM (%s) x
+        GROUP BY scope_type, scope_id
+        HAVING SUM(sign * clients) <> 0 OR SUM(sign * sessions) <> 0 OR SUM(sign * completed_sessions) <> 0 OR SUM(sign * workouts) <> 0
+        ORDER BY scope_type, scope_id
+        ON CONFLICT (scope_type, scope_id) DO UPDATE SET
+            clients = d.clients + EXCLUDED.clients, sessions = d.sessions + EXCLUDED.sessions,
+            completed_sessions = d.completed_sessions + EXCLUDED.completed_sessions,
+            workouts = d.workouts + EXCLUDED.workouts, updated_at = NOW()
+    $q$, src);
+    RETURN NULL;
+END $$;
+
+DO $$
+DECLARE
+    t RECORD;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES
+            ('scheduled_sessions', 'session_counts', 'session_counts'), ('session_templates', 'template_counts', 'template_counts'),
+            ('users', 'client_org_counts', 'client_counts'), ('coach_clients', 'link_counts', 'link_counts')
+        ) v(tbl, fn, upd_fn) LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %1$s_counters_ins ON %1$s; DROP TRIGGER IF EXISTS %1$s_counters_upd ON %1$s; DROP TRIGGER IF EXISTS %1$s_counters_del ON %1$s', t.tbl);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_ins AFTER INSERT ON %1$s REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.fn);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_upd AFTER UPDATE ON %1$s REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.upd_fn);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_del AFTER DELETE ON %1$s REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.fn);
+    END LOOP;
+END $$;
+
+-- Exact values from the source tables (also what reconcile() compares against)
+CREATE OR REPLACE VIEW dashboard_counts_actual AS
+SELECT scope_type, scope_id, SUM(clients)::bigint AS clients, SUM(sessions)::bigint AS sessions,
+       SUM(completed_sessions)::bigint AS completed_sessions, SUM(workouts)::bigint AS workouts
+FROM (
+    SELECT c.* FROM scheduled_sessions r, session_counts(r) c
+    UNION ALL SELECT c.* FROM session_templates r, template_counts(r) c
+    UNION ALL SELECT c.* FROM users r, client_counts(r) c
+) x
+GROUP BY scope_type, scope_id;
+
+INSERT INTO dashboard_counters (scope_type, scope_id, clients, sessions, completed_sessions, workouts)
+SELECT scope_type, scope_id, clients, sessions, completed_sessions, workouts FROM dashboard_counts_actual
+ON CONFLICT (scope_type, scope_id) DO UPDATE SET
+    clients = EXCLUDED.clients, sessions = EXCLUDED.sessions, completed_sessions = EXCLUDED.completed_sessions,
+    workouts = EXCLUDED.workouts, updated_at = NOW();
@@ -0,0 +1,64 @@
+-- ================================================================
+-- 006: per-coach review aggregates
+-- Public reviews only (is_public). Kept exact by a statement-level trigger on
+-- coach_reviews, so inserts, moderation (is_public / rating changes) and
+-- deletes all move the aggregate; the profile never scans a coach's reviews.
+-- No FK to users: reviews cascade-delete with the coach and the trigger must
+-- still be able to upsert while that cascade runs.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS coach_review_stats (
+    coach_id UUID PRIMARY KEY,
+    review_count INT NOT NULL DEFAULT 0,
+    rating_sum INT NOT NULL DEFAULT 0,
+    stars_1 INT NOT NULL DEFAULT 0,
+    stars_2 INT NOT NULL DEFAULT 0,
+    stars_3 INT NOT NULL DEFAULT 0,
+    stars_4 INT NOT NULL DEFAULT 0,
+    stars_5 INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION maintain_review_stats() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    src TEXT;
+BEGIN
+    src := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT coach_id, rating, 1 AS sign FROM new_rows WHERE is_public'
+        WHEN 'DELETE' THEN 'SELECT coach_id, rating, -1 AS sign FROM old_rows WHERE is_public'
+        ELSE 'SELECT coach_id, rating, 1 AS sign FROM new_rows WHERE is_public UNION ALL SELECT coach_id, rating, -1 FROM old_rows WHERE is_public'
+    END;
+    EXECUTE format($q$
+        INSERT INTO coach_review_stats AS s (coach_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+        SELECT coach_id, SUM(sign), SUM(sign * rating),
+               SUM(sign * (rating = 1)::int), SUM(sign * (rating = 2)::int), SUM(sign * (rating = 3)::int),
+               SUM(sign * (rating = 4)::int), SUM(sign * (rating = 5)::int)
+        FROM (%s) x
+        GROUP BY coach_id
+        HAVING SUM(sign) <> 0 OR SUM(sign * rating) <> 0
+        ORDER BY coach_id
+        ON CONFLICT (coach_id) DO UPDATE SET
+            review_count = s.review_count + EXCLUDED.review_count, rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+            stars_1 = s.stars_1 + EXCLUDED.stars_1, stars_2 = s.stars_2 + EXCLUDED.stars_2, stars_3 = s.stars_3 + EXCLUDED.stars_3,
+            stars_4 = s.stars_4 + EXCLUDED.stars_4, stars_5 = s.stars_5 + EXCLUDED.stars_5, updated_at = NOW()
+    $q$, src);
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS coach_reviews_stats_ins ON coach_reviews;
+DROP TRIGGER IF EXISTS coach_reviews_stats_upd ON coach_reviews;
+DROP TRIGGER IF EXISTS coach_reviews_stats_del ON coach_reviews;
+CREATE TRIGGER coach_reviews_stats_ins AFTER INSERT ON coach_reviews REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_review_stats();
+CREATE TRIGGER coach_reviews_stats_upd AFTER UPDATE ON coach_reviews REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_review_stats();
+CREATE TRIGGER coach_reviews_stats_del AFTER DELETE ON coach_reviews REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_review_stats();
+
+INSERT INTO coach_review_stats (coach_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+SELECT coach_id, COUNT(*), SUM(rating), COUNT(*) FILTER (WHERE rating = 1), COUNT(*) FILTER (WHERE rating = 2),
+       COUNT(*) FILTER (WHERE rating = 3), COUNT(*) FILTER (WHERE rating = 4), COUNT(*) FILTER (WHERE rating = 5)
+FROM coach_reviews WHERE is_public GROUP BY coach_id
+ON CONFLICT (coach_id) DO UPDATE SET
+    review_count = EXCLUDED.review_count, rating_sum = EXCLUDED.rating_sum, stars_1 = EXCLUDED.stars_1, stars_2 = EXCLUDED.stars_2,
+    stars_3 = EXCLUDED.stars_3, stars_4 = EXCLUDED.stars_4, stars_5 = EXCLUDED.stars_5, updated_at = NOW();
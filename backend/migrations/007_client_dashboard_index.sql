@@ -0,0 +1,2 @@
+-- Attendance counts on /client/{cid}/dashboard (COUNT by status) as index-only scans
+CREATE INDEX IF NOT EXISTS idx_scheduled_sessions_client_status ON scheduled_sessions(client_id, status);
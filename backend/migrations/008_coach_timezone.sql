@@ -0,0 +1,2 @@
+-- Per-coach IANA timezone; NULL means DEFAULT_TIMEZONE. Decides which calendar day is "today".
+ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64);
@@ -0,0 +1,3 @@
+-- Coach logos live in the content-addressed blob store (blobstore.py); users keeps only the SHA-256.
+-- Inline base64 left in logo_url is moved out by blobstore.move_inline_logos() at startup.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS logo_hash CHAR(64);
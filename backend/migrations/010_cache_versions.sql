@@ -0,0 +1,98 @@
+-- ================================================================
+-- 010: version counters for conditional GETs (ETag / If-None-Match)
+-- One row per cache scope, bumped by statement-level triggers whenever a
+-- row that feeds that scope's responses changes:
+--   coach     : a coach's clients, sessions, series, workouts, availability, holidays
+--   org       : the same lists requested without a coach header
+--   profile   : a coach's public profile (user row, reviews, counters)
+--   directory : the public coach list (scope_id = nil uuid)
+-- etags.py turns the versions into ETags; a 304 costs one primary-key lookup.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS cache_versions (
+    scope_type VARCHAR(10) NOT NULL,
+    scope_id UUID NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (scope_type, scope_id)
+);
+
+-- Scopes a changed row invalidates (the old and new row of an UPDATE both count)
+CREATE OR REPLACE FUNCTION user_cache_scopes(r users) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql STABLE AS $$
+    SELECT 'coach', cc.coach_id FROM coach_clients cc WHERE cc.client_id = r.id
+    UNION ALL SELECT 'org', r.primary_org_id WHERE r.role = 'client' AND r.primary_org_id IS NOT NULL
+    UNION ALL SELECT 'profile', r.id WHERE r.role = 'coach'
+    UNION ALL SELECT 'directory', '00000000-0000-0000-0000-000000000000'::uuid WHERE r.role = 'coach'
+$$;
+
+CREATE OR REPLACE FUNCTION link_cache_scopes(r coach_clients) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'coach', r.coach_id
+$$;
+
+CREATE OR REPLACE FUNCTION session_cache_scopes(r scheduled_sessions) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT v.k, v.id FROM (VALUES ('coach', r.coach_id), ('org', r.org_id)) v(k, id) WHERE v.id IS NOT NULL
+$$;
+
+CREATE OR REPLACE FUNCTION series_cache_scopes(r session_series) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT v.k, v.id FROM (VALUES ('coach', r.coach_id), ('org', r.org_id)) v(k, id) WHERE v.id IS NOT NULL
+$$;
+
+CREATE OR REPLACE FUNCTION template_cache_scopes(r session_templates) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT v.k, v.id FROM (VALUES ('coach', r.created_by), ('org', r.org_id)) v(k, id) WHERE v.id IS NOT NULL
+$$;
+
+CREATE OR REPLACE FUNCTION availability_cache_scopes(r coach_availability) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'coach', r.coach_id
+$$;
+
+CREATE OR REPLACE FUNCTION holiday_cache_scopes(r coach_holidays) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'coach', r.coach_id
+$$;
+
+CREATE OR REPLACE FUNCTION review_cache_scopes(r coach_reviews) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'profile', r.coach_id
+$$;
+
+-- Profile client/session counts are read from dashboard_counters
+CREATE OR REPLACE FUNCTION counter_cache_scopes(r dashboard_counters) RETURNS TABLE (scope_type TEXT, scope_id UUID) LANGUAGE sql IMMUTABLE AS $$
+    SELECT 'profile', r.scope_id WHERE r.scope_type = 'coach'
+$$;
+
+-- Statement trigger: TG_ARGV[0] names the *_cache_scopes function for the table.
+CREATE OR REPLACE FUNCTION bump_cache_versions() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    f TEXT := quote_ident(TG_ARGV[0]);
+    src TEXT;
+BEGIN
+    src := CASE TG_OP
+        WHEN 'INSERT' THEN format('SELECT c.* FROM new_rows r, %s(r) c', f)
+        WHEN 'DELETE' THEN format('SELECT c.* FROM old_rows r, %s(r) c', f)
+        ELSE format('SELECT c.* FROM new_rows r, %1$s(r) c UNION SELECT c.* FROM old_rows r, %1$s(r) c', f)
+    END;
+    EXECUTE format($q$
+        INSERT INTO cache_versions AS v (scope_type, scope_id, version)
+        SELECT DISTINCT scope_type, scope_id, 1 FROM (%s) x ORDER BY scope_type, scope_id
+        ON CONFLICT (scope_type, scope_id) DO UPDATE SET version = v.version + 1, updated_at = NOW()
+    $q$, src);
+    RETURN NULL;
+END $$;
+
+DO $$
+DECLARE
+    t RECORD;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES
+            ('users', 'user_cache_scopes'), ('coach_clients', 'link_cache_scopes'), ('scheduled_sessions', 'session_cache_scopes'),
+            ('session_series', 'series_cache_scopes'), ('session_templates', 'template_cache_scopes'),
+            ('coach_availability', 'availability_cache_scopes'), ('coach_holidays', 'holiday_cache_scopes'),
+            ('coach_reviews', 'review_cache_scopes'), ('dashboard_counters', 'counter_cache_scopes')
+        ) v(tbl, fn) LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %1$s_cache_ins ON %1$s; DROP TRIGGER IF EXISTS %1$s_cache_upd ON %1$s; DROP TRIGGER IF EXISTS %1$s_cache_del ON %1$s', t.tbl);
+        EXECUTE format('CREATE TRIGGER %1$s_cache_ins AFTER INSERT ON %1$s REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_versions(%2$L)', t.tbl, t.fn);
+        EXECUTE format('CREATE TRIGGER %1$s_cache_upd AFTER UPDATE ON %1$s REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_versions(%2$L)', t.tbl, t.fn);
+        EXECUTE format('CREATE TRIGGER %1$s_cache_del AFTER DELETE ON %1$s REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_versions(%2$L)', t.tbl, t.fn);
+    END LOOP;
+END $$;
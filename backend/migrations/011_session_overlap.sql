@@ -0,0 +1,62 @@
+-- ================================================================
+-- 011: no double booking
+-- period is [scheduled_at, scheduled_at + duration) as a range. A coach's
+-- live (not cancelled) sessions may not overlap: with btree_gist this is an
+-- exclusion constraint; where the extension cannot be installed, a row
+-- trigger does the same check under a per-coach advisory lock, backed by a
+-- GiST index on period, and raises the same error (exclusion_violation,
+-- constraint scheduled_sessions_no_overlap). Sessions that already overlap
+-- are kept and marked overlap_ok (all but the earliest of each clash).
+-- ================================================================
+
+-- Adding minutes to a timestamptz does not depend on the session time zone
+CREATE OR REPLACE FUNCTION session_period(at TIMESTAMPTZ, minutes INT) RETURNS tstzrange LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT tstzrange(at, at + make_interval(mins => COALESCE(minutes, 60)), '[)')
+$$;
+
+ALTER TABLE scheduled_sessions ADD COLUMN IF NOT EXISTS period tstzrange GENERATED ALWAYS AS (session_period(scheduled_at, duration_minutes)) STORED;
+ALTER TABLE scheduled_sessions ADD COLUMN IF NOT EXISTS overlap_ok BOOLEAN NOT NULL DEFAULT false;
+
+UPDATE scheduled_sessions s SET overlap_ok = true
+WHERE s.status <> 'cancelled' AND EXISTS (
+    SELECT 1 FROM scheduled_sessions o
+    WHERE o.coach_id = s.coach_id AND o.id <> s.id AND o.status <> 'cancelled' AND o.period && s.period
+      AND (COALESCE(o.created_at, '-infinity'), o.id) < (COALESCE(s.created_at, '-infinity'), s.id));
+
+CREATE OR REPLACE FUNCTION check_session_overlap() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    clash UUID;
+BEGIN
+    IF NEW.status = 'cancelled' OR NEW.overlap_ok OR NEW.coach_id IS NULL OR NEW.scheduled_at IS NULL THEN RETURN NEW; END IF;
+    PERFORM pg_advisory_xact_lock(7203116, hashtext(NEW.coach_id::text));  -- same key as booking.lock_coach()
+    SELECT id INTO clash FROM scheduled_sessions
+    WHERE coach_id = NEW.coach_id AND id <> NEW.id AND status <> 'cancelled' AND NOT overlap_ok
+      AND period && session_period(NEW.scheduled_at, NEW.duration_minutes)
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'conflicting key value violates exclusion constraint "scheduled_sessions_no_overlap"'
+            USING ERRCODE = 'exclusion_violation', CONSTRAINT = 'scheduled_sessions_no_overlap', TABLE = 'scheduled_sessions',
+                  DETAIL = format('Overlaps session %s', clash);
+    END IF;
+    RETURN NEW;
+END $$;
+
+DO $$
+BEGIN
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS btree_gist;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'btree_gist unavailable (%), enforcing session overlaps with a trigger', SQLERRM;
+    END;
+    ALTER TABLE scheduled_sessions DROP CONSTRAINT IF EXISTS scheduled_sessions_no_overlap;
+    DROP TRIGGER IF EXISTS scheduled_sessions_no_overlap ON scheduled_sessions;
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'btree_gist') THEN
+        ALTER TABLE scheduled_sessions ADD CONSTRAINT scheduled_sessions_no_overlap
+            EXCLUDE USING gist (coach_id WITH =, period WITH &&) WHERE (status <> 'cancelled' AND NOT overlap_ok);
+    ELSE
+        CREATE INDEX IF NOT EXISTS idx_scheduled_sessions_period ON scheduled_sessions USING gist (period) WHERE status <> 'cancelled' AND NOT overlap_ok;
+        CREATE TRIGGER scheduled_sessions_no_overlap
+            BEFORE INSERT OR UPDATE OF coach_id, scheduled_at, duration_minutes, status, overlap_ok ON scheduled_sessions
+            FOR EACH ROW EXECUTE FUNCTION check_session_overlap();
+    END IF;
+END $$;
@@ -0,0 +1,17 @@
+-- ================================================================
+-- 012: message_queue dispatch (messaging.py)
+-- Workers claim due rows with FOR UPDATE SKIP LOCKED and mark them 'sending'
+-- under a lease: claimed_by identifies the claiming batch, claimed_until is
+-- when an unfinished claim may be taken over. Retries are rescheduled by
+-- moving scheduled_for, so every queued row needs one.
+-- ================================================================
+
+ALTER TABLE message_queue ADD COLUMN IF NOT EXISTS claimed_by UUID;
+ALTER TABLE message_queue ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ;
+
+UPDATE message_queue SET scheduled_for = COALESCE(created_at, NOW()) WHERE scheduled_for IS NULL;
+ALTER TABLE message_queue ALTER COLUMN scheduled_for SET DEFAULT NOW();
+ALTER TABLE message_queue ALTER COLUMN scheduled_for SET NOT NULL;
+
+-- due rows are found through idx_messages_scheduled (scheduled_for WHERE status='queued'); expired claims through this
+CREATE INDEX IF NOT EXISTS idx_messages_claimed ON message_queue(claimed_until) WHERE status = 'sending';
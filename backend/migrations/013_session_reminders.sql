@@ -0,0 +1,95 @@
+-- ================================================================
+-- 013: automatic session reminders (reminders.py)
+-- reminder_policies: per coach, how long before a session (minutes) and on
+-- which channel clients are reminded. The scheduler scans only the sessions
+-- whose reminder falls due since its last run (reminder_scan.scanned_to) and
+-- queues them in message_queue; dedup_key makes queueing idempotent.
+-- session_ref is the session's id, or "<series>:<date>" for a series
+-- occurrence (materialised or not), so both map to the same reminder.
+-- Triggers withdraw queued reminders of sessions that are moved, cancelled or
+-- deleted, and mark them in reminder_dirty so the next run re-plans them.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS reminder_policies (
+    coach_id UUID PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    offsets_minutes INT[] NOT NULL DEFAULT '{1440,60}',
+    channel VARCHAR(50) NOT NULL DEFAULT 'whatsapp' CHECK (channel IN ('whatsapp', 'sms', 'email')),
+    message_template TEXT,
+    enabled BOOLEAN NOT NULL DEFAULT true,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS reminder_scan (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    scanned_to TIMESTAMPTZ NOT NULL
+);
+
+-- kind 's' = scheduled_sessions id, 'r' = session_series id, 'c' = coach whose policy changed
+CREATE TABLE IF NOT EXISTS reminder_dirty (
+    kind CHAR(1) NOT NULL,
+    id UUID NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+
+ALTER TABLE message_queue ADD COLUMN IF NOT EXISTS session_ref TEXT;
+ALTER TABLE message_queue ADD COLUMN IF NOT EXISTS dedup_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_dedup ON message_queue(dedup_key) WHERE dedup_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_session_ref ON message_queue(session_ref) WHERE status = 'queued';
+
+CREATE OR REPLACE FUNCTION session_ref(r scheduled_sessions) RETURNS TEXT LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE WHEN r.series_id IS NOT NULL THEN r.series_id::text || ':' || r.occurrence_date::text ELSE r.id::text END
+$$;
+
+-- An update only counts if it changes when, whose or whether a session takes place
+CREATE OR REPLACE FUNCTION replan_session_reminders() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM message_queue m USING old_rows o
+        WHERE m.status = 'queued' AND m.message_type = 'reminder' AND m.session_ref = session_ref(o);
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        WITH changed AS (
+            SELECT n.id, n.status, n.scheduled_at, session_ref(o) AS ref FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (n.scheduled_at, n.status, n.coach_id, n.client_id) IS DISTINCT FROM (o.scheduled_at, o.status, o.coach_id, o.client_id)
+        ), withdrawn AS (
+            DELETE FROM message_queue m USING changed c
+            WHERE m.status = 'queued' AND m.message_type = 'reminder' AND m.session_ref = c.ref
+        )
+        -- only sessions close enough for a reminder to be due already (policies allow at most 7 days ahead)
+        INSERT INTO reminder_dirty (kind, id)
+        SELECT 's', c.id FROM changed c WHERE c.status IN ('scheduled', 'confirmed') AND c.scheduled_at < NOW() + interval '8 days'
+        ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END IF;
+    INSERT INTO reminder_dirty (kind, id)
+    SELECT 's', n.id FROM new_rows n WHERE n.status IN ('scheduled', 'confirmed') AND n.scheduled_at < NOW() + interval '8 days'
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION replan_series_reminders() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM message_queue m USING old_rows o
+    WHERE m.status = 'queued' AND m.message_type = 'reminder' AND m.session_ref LIKE o.id::text || ':%';
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO reminder_dirty (kind, id) SELECT 'r', n.id FROM new_rows n WHERE n.status = 'active' ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS scheduled_sessions_reminders_ins ON scheduled_sessions;
+DROP TRIGGER IF EXISTS scheduled_sessions_reminders_upd ON scheduled_sessions;
+DROP TRIGGER IF EXISTS scheduled_sessions_reminders_del ON scheduled_sessions;
+DROP TRIGGER IF EXISTS session_series_reminders_upd ON session_series;
+DROP TRIGGER IF EXISTS session_series_reminders_del ON session_series;
+CREATE TRIGGER scheduled_sessions_reminders_ins AFTER INSERT ON scheduled_sessions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION replan_session_reminders();
+CREATE TRIGGER scheduled_sessions_reminders_upd AFTER UPDATE ON scheduled_sessions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION replan_session_reminders();
+CREATE TRIGGER scheduled_sessions_reminders_del AFTER DELETE ON scheduled_sessions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION replan_session_reminders();
+CREATE TRIGGER session_series_reminders_upd AFTER UPDATE ON session_series
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION replan_series_reminders();
+CREATE TRIGGER session_series_reminders_del AFTER DELETE ON session_series
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION replan_series_reminders();
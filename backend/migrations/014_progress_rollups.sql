@@ -0,0 +1,93 @@
+-- ================================================================
+-- 014: daily rollups of progress_records metrics (progress.py)
+-- Every numeric value in a record's metrics ("weight", and one level of
+-- nesting such as "measurements.waist") is folded into one row per client,
+-- metric and day: count, sum, min, max, first and last. Statement triggers
+-- recompute the days a write touches, so edits and deletes stay exact.
+-- Weekly/monthly series are aggregated from these rows, never from the raw
+-- records. Days are calendar days of the stored (floating) time.
+-- ================================================================
+
+CREATE TABLE IF NOT EXISTS progress_rollups (
+    client_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    day DATE NOT NULL,
+    n INT NOT NULL,
+    total DOUBLE PRECISION NOT NULL,
+    min_value DOUBLE PRECISION NOT NULL,
+    max_value DOUBLE PRECISION NOT NULL,
+    first_value DOUBLE PRECISION NOT NULL,
+    last_value DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (client_id, metric, day)
+);
+
+-- Numbers, and strings that hold one (form posts send "72.5")
+CREATE OR REPLACE FUNCTION progress_number(v JSONB) RETURNS DOUBLE PRECISION LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE jsonb_typeof(v)
+        WHEN 'number' THEN (v #>> '{}')::double precision
+        WHEN 'string' THEN CASE WHEN btrim(v #>> '{}') ~ '^-?[0-9]+(\.[0-9]+)?$' THEN btrim(v #>> '{}')::double precision END
+    END
+$$;
+
+CREATE OR REPLACE FUNCTION progress_metric_values(m JSONB) RETURNS TABLE (metric TEXT, value DOUBLE PRECISION) LANGUAGE sql IMMUTABLE AS $$
+    WITH top AS (SELECT k, v FROM jsonb_each(CASE WHEN jsonb_typeof(m) = 'object' THEN m ELSE '{}' END) t(k, v))
+    SELECT k, progress_number(v) FROM top WHERE progress_number(v) IS NOT NULL
+    UNION ALL
+    SELECT top.k || '.' || n.k, progress_number(n.v)
+    FROM top, jsonb_each(CASE WHEN jsonb_typeof(top.v) = 'object' THEN top.v ELSE '{}' END) n(k, v)
+    WHERE progress_number(n.v) IS NOT NULL
+$$;
+
+-- Rebuild the rollups of the given (client, day) pairs from progress_records
+CREATE OR REPLACE FUNCTION refresh_progress_rollups(clients UUID[], days DATE[]) RETURNS void LANGUAGE sql AS $$
+    DELETE FROM progress_rollups r USING unnest(clients, days) k(client_id, day) WHERE r.client_id = k.client_id AND r.day = k.day;
+    INSERT INTO progress_rollups (client_id, metric, day, n, total, min_value, max_value, first_value, last_value)
+    SELECT p.client_id, v.metric, k.day, COUNT(*), SUM(v.value), MIN(v.value), MAX(v.value),
+           (array_agg(v.value ORDER BY p.recorded_at, p.id))[1], (array_agg(v.value ORDER BY p.recorded_at DESC, p.id DESC))[1]
+    FROM unnest(clients, days) k(client_id, day)
+    JOIN progress_records p ON p.client_id = k.client_id
+         AND p.recorded_at >= k.day::timestamp AT TIME ZONE 'UTC' AND p.recorded_at < (k.day + 1)::timestamp AT TIME ZONE 'UTC'
+    CROSS JOIN LATERAL progress_metric_values(p.metrics) v
+    GROUP BY p.client_id, v.metric, k.day
+    ORDER BY 1, 2, 3;
+$$;
+
+CREATE OR REPLACE FUNCTION maintain_progress_rollups() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    clients UUID[];
+    days DATE[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(client_id), array_agg(day) INTO clients, days FROM (
+            SELECT DISTINCT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM new_rows WHERE recorded_at IS NOT NULL) k;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(client_id), array_agg(day) INTO clients, days FROM (
+            SELECT DISTINCT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM old_rows WHERE recorded_at IS NOT NULL) k;
+    ELSE
+        -- edits to notes or record_type leave the rollups alone
+        WITH changed AS (
+            SELECT o.client_id AS old_client, o.recorded_at AS old_at, n.client_id, n.recorded_at FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (n.client_id, n.metrics, n.recorded_at) IS DISTINCT FROM (o.client_id, o.metrics, o.recorded_at)
+        )
+        SELECT array_agg(client_id), array_agg(day) INTO clients, days FROM (
+            SELECT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM changed WHERE recorded_at IS NOT NULL
+            UNION SELECT old_client, (old_at AT TIME ZONE 'UTC')::date FROM changed WHERE old_at IS NOT NULL) k;
+    END IF;
+    IF clients IS NOT NULL THEN PERFORM refresh_progress_rollups(clients, days); END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS progress_records_rollups_ins ON progress_records;
+DROP TRIGGER IF EXISTS progress_records_rollups_upd ON progress_records;
+DROP TRIGGER IF EXISTS progress_records_rollups_del ON progress_records;
+CREATE TRIGGER progress_records_rollups_ins AFTER INSERT ON progress_records
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_progress_rollups();
+CREATE TRIGGER progress_records_rollups_upd AFTER UPDATE ON progress_records
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_progress_rollups();
+CREATE TRIGGER progress_records_rollups_del AFTER DELETE ON progress_records
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION maintain_progress_rollups();
+
+-- Existing history
+TRUNCATE progress_rollups;
+SELECT refresh_progress_rollups(array_agg(client_id), array_agg(day))
+FROM (SELECT DISTINCT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM progress_records WHERE recorded_at IS NOT NULL) k;
@@ -0,0 +1,75 @@
+-- ================================================================
+-- 015: merge inserted progress_records into progress_rollups (014)
+-- Recomputing every touched day made each insert cost the whole day's (and
+-- for imports, the whole range's) records. Inserts now fold their own rows
+-- into the existing rollups; updates and deletes still recompute, since a
+-- removed min/max/first/last cannot be subtracted. first_at/last_at record
+-- when the first/last value was taken; equal times order by value, so the
+-- merge and the recompute agree.
+-- ================================================================
+
+ALTER TABLE progress_rollups ADD COLUMN IF NOT EXISTS first_at TIMESTAMPTZ;
+ALTER TABLE progress_rollups ADD COLUMN IF NOT EXISTS last_at TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION refresh_progress_rollups(clients UUID[], days DATE[]) RETURNS void LANGUAGE sql AS $$
+    DELETE FROM progress_rollups r USING unnest(clients, days) k(client_id, day) WHERE r.client_id = k.client_id AND r.day = k.day;
+    INSERT INTO progress_rollups (client_id, metric, day, n, total, min_value, max_value, first_value, last_value, first_at, last_at)
+    SELECT p.client_id, v.metric, k.day, COUNT(*), SUM(v.value), MIN(v.value), MAX(v.value),
+           (array_agg(v.value ORDER BY p.recorded_at, v.value))[1], (array_agg(v.value ORDER BY p.recorded_at DESC, v.value DESC))[1],
+           MIN(p.recorded_at), MAX(p.recorded_at)
+    FROM unnest(clients, days) k(client_id, day)
+    JOIN progress_records p ON p.client_id = k.client_id
+         AND p.recorded_at >= k.day::timestamp AT TIME ZONE 'UTC' AND p.recorded_at < (k.day + 1)::timestamp AT TIME ZONE 'UTC'
+    CROSS JOIN LATERAL progress_metric_values(p.metrics) v
+    GROUP BY p.client_id, v.metric, k.day
+    ORDER BY 1, 2, 3;
+$$;
+
+CREATE OR REPLACE FUNCTION maintain_progress_rollups() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    clients UUID[];
+    days DATE[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO progress_rollups AS r (client_id, metric, day, n, total, min_value, max_value, first_value, last_value, first_at, last_at)
+        SELECT n.client_id, v.metric, (n.recorded_at AT TIME ZONE 'UTC')::date, COUNT(*), SUM(v.value), MIN(v.value), MAX(v.value),
+               (array_agg(v.value ORDER BY n.recorded_at, v.value))[1], (array_agg(v.value ORDER BY n.recorded_at DESC, v.value DESC))[1],
+               MIN(n.recorded_at), MAX(n.recorded_at)
+        FROM new_rows n CROSS JOIN LATERAL progress_metric_values(n.metrics) v
+        WHERE n.recorded_at IS NOT NULL
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (client_id, metric, day) DO UPDATE SET
+            n = r.n + EXCLUDED.n,
+            total = r.total + EXCLUDED.total,
+            min_value = LEAST(r.min_value, EXCLUDED.min_value),
+            max_value = GREATEST(r.max_value, EXCLUDED.max_value),
+            first_value = CASE WHEN EXCLUDED.first_at < r.first_at THEN EXCLUDED.first_value
+                               WHEN EXCLUDED.first_at = r.first_at THEN LEAST(r.first_value, EXCLUDED.first_value) ELSE r.first_value END,
+            last_value = CASE WHEN EXCLUDED.last_at > r.last_at THEN EXCLUDED.last_value
+                              WHEN EXCLUDED.last_at = r.last_at THEN GREATEST(r.last_value, EXCLUDED.last_value) ELSE r.last_value END,
+            first_at = LEAST(r.first_at, EXCLUDED.first_at),
+            last_at = GREATEST(r.last_at, EXCLUDED.last_at);
+        RETURN NULL;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(client_id), array_agg(day) INTO clients, days FROM (
+            SELECT DISTINCT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM old_rows WHERE recorded_at IS NOT NULL) k;
+    ELSE
+        -- edits to notes or record_type leave the rollups alone
+        WITH changed AS (
+            SELECT o.client_id AS old_client, o.recorded_at AS old_at, n.client_id, n.recorded_at FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (n.client_id, n.metrics, n.recorded_at) IS DISTINCT FROM (o.client_id, o.metrics, o.recorded_at)
+        )
+        SELECT array_agg(client_id), array_agg(day) INTO clients, days FROM (
+            SELECT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM changed WHERE recorded_at IS NOT NULL
+            UNION SELECT old_client, (old_at AT TIME ZONE 'UTC')::date FROM changed WHERE old_at IS NOT NULL) k;
+    END IF;
+    IF clients IS NOT NULL THEN PERFORM refresh_progress_rollups(clients, days); END IF;
+    RETURN NULL;
+END $$;
+
+TRUNCATE progress_rollups;
+SELECT refresh_progress_rollups(array_agg(client_id), array_agg(day))
+FROM (SELECT DISTINCT client_id, (recorded_at AT TIME ZONE 'UTC')::date AS day FROM progress_records WHERE recorded_at IS NOT NULL) k;
+ALTER TABLE progress_rollups ALTER COLUMN first_at SET NOT NULL;
+ALTER TABLE progress_rollups ALTER COLUMN last_at SET NOT NULL;
@@ -0,0 +1,47 @@
+-- ================================================================
+-- 016: indexed search over people (search.py)
+-- search_doc() is the lowercased name, email and phone digits of a user or
+-- lead. Word prefixes ("pri sha", "priya gmail", "98765") are found through a
+-- full-text GIN index, which needs no extension. Where pg_trgm can be
+-- installed, trigram GIN indexes on the same expression add substring
+-- ("8765" of a phone) and typo-tolerant ("pryia") matches; search.py checks
+-- for the extension once and uses whichever indexes exist.
+-- ================================================================
+
+CREATE OR REPLACE FUNCTION search_digits(phone TEXT) RETURNS TEXT LANGUAGE sql IMMUTABLE AS $$
+    SELECT regexp_replace(COALESCE(phone, ''), '\D', '', 'g')
+$$;
+
+-- the phone is there with and without its country code, so "98765" is a prefix of a word
+CREATE OR REPLACE FUNCTION search_doc(name TEXT, email TEXT, phone TEXT) RETURNS TEXT LANGUAGE sql IMMUTABLE AS $$
+    SELECT lower(array_to_string(ARRAY[name, email, NULLIF(search_digits(phone), ''),
+                                       CASE WHEN length(search_digits(phone)) > 10 THEN right(search_digits(phone), 10) END], ' '))
+$$;
+
+-- words of the document; email parts ("priya", "sharma", "gmail") are words too
+CREATE OR REPLACE FUNCTION search_words(doc TEXT) RETURNS tsvector LANGUAGE sql IMMUTABLE AS $$
+    SELECT to_tsvector('simple', regexp_replace(doc, '\W+', ' ', 'g'))
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_users_search_fts ON users
+    USING gin (search_words(search_doc(full_name, email, phone))) WHERE deleted_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_leads_search_fts ON leads
+    USING gin (search_words(search_doc(name, email, phone)));
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        RAISE NOTICE 'pg_trgm not available; search uses full-text prefix matching only';
+        RETURN;
+    END IF;
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN insufficient_privilege OR feature_not_supported THEN
+        RAISE NOTICE 'pg_trgm cannot be installed (%); search uses full-text prefix matching only', SQLERRM;
+        RETURN;
+    END;
+    CREATE INDEX IF NOT EXISTS idx_users_search_trgm ON users
+        USING gin (search_doc(full_name, email, phone) gin_trgm_ops) WHERE deleted_at IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_leads_search_trgm ON leads
+        USING gin (search_doc(name, email, phone) gin_trgm_ops);
+END $$;
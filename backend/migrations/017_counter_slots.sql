@@ -0,0 +1,38 @@
+-- ================================================================
+-- 017: spread the org dashboard counters over slot rows
+-- Every write in the org upserted the same ('org', org_id) counter row from
+-- inside the writer's transaction, so concurrent writers queued on its row
+-- lock until each other's commit. Org deltas now go to one of 16 slot rows,
+-- picked by backend pid, and readers sum the slots (counters.read_counters).
+-- Coach rows stay in slot 0: only that coach's own writes touch them.
+-- ================================================================
+
+ALTER TABLE dashboard_counters ADD COLUMN IF NOT EXISTS slot SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE dashboard_counters DROP CONSTRAINT IF EXISTS dashboard_counters_pkey;
+ALTER TABLE dashboard_counters ADD PRIMARY KEY (scope_type, scope_id, slot);
+
+CREATE OR REPLACE FUNCTION maintain_dashboard_counters() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    f TEXT := quote_ident(TG_ARGV[0]);
+    src TEXT;
+BEGIN
+    src := CASE TG_OP
+        WHEN 'INSERT' THEN format('SELECT c.*, 1 AS sign FROM new_rows r, %s(r) c', f)
+        WHEN 'DELETE' THEN format('SELECT c.*, -1 AS sign FROM old_rows r, %s(r) c', f)
+        ELSE format('SELECT c.*, 1 AS sign FROM new_rows r, %1$s(r) c UNION ALL SELECT c.*, -1 FROM old_rows r, %1$s(r) c', f)
+    END;
+    EXECUTE format($q$
+        INSERT INTO dashboard_counters AS d (scope_type, scope_id, slot, clients, sessions, completed_sessions, workouts)
+        SELECT scope_type, scope_id, CASE WHEN scope_type = 'org' THEN pg_backend_pid() %% 16 ELSE 0 END,
+               SUM(sign * clients), SUM(sign * sessions), SUM(sign * completed_sessions), SUM(sign * workouts)
+        FROM (%s) x
+        GROUP BY scope_type, scope_id
+        HAVING SUM(sign * clients) <> 0 OR SUM(sign * sessions) <> 0 OR SUM(sign * completed_sessions) <> 0 OR SUM(sign * workouts) <> 0
+        ORDER BY scope_type, scope_id
+        ON CONFLICT (scope_type, scope_id, slot) DO UPDATE SET
+            clients = d.clients + EXCLUDED.clients, sessions = d.sessions + EXCLUDED.sessions,
+            completed_sessions = d.completed_sessions + EXCLUDED.completed_sessions,
+            workouts = d.workouts + EXCLUDED.workouts, updated_at = NOW()
+    $q$, src);
+    RETURN NULL;
+END $$;
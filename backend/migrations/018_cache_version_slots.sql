@@ -0,0 +1,41 @@
+-- ================================================================
+-- 018: narrower, uncontended cache version bumps
+-- 010 bumped the single ('org', org_id) and directory rows from inside every
+-- writer's transaction, so writers across the org serialized on those row
+-- locks. Shared scopes (org, directory) now bump one of 16 slot rows picked
+-- by backend pid, and a scope's version is the sum of its slots
+-- (etags.scope_versions): it still grows by one per bump. An UPDATE only
+-- bumps the scopes of rows whose cached content changed, so bookkeeping
+-- writes (updated_at, a password rehash, last login) bump nothing.
+-- ================================================================
+
+ALTER TABLE cache_versions ADD COLUMN IF NOT EXISTS slot SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE cache_versions DROP CONSTRAINT IF EXISTS cache_versions_pkey;
+ALTER TABLE cache_versions ADD PRIMARY KEY (scope_type, scope_id, slot);
+
+-- A row as the cached responses see it
+CREATE OR REPLACE FUNCTION cache_row_key(r anyelement) RETURNS jsonb LANGUAGE sql STABLE AS $$
+    SELECT to_jsonb(r) - ARRAY['updated_at', 'password_hash', 'last_login_at']
+$$;
+
+CREATE OR REPLACE FUNCTION bump_cache_versions() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    f TEXT := quote_ident(TG_ARGV[0]);
+    src TEXT;
+BEGIN
+    src := CASE TG_OP
+        WHEN 'INSERT' THEN format('SELECT c.* FROM new_rows r, %s(r) c', f)
+        WHEN 'DELETE' THEN format('SELECT c.* FROM old_rows r, %s(r) c', f)
+        ELSE format('SELECT c.* FROM new_rows r, %1$s(r) c WHERE cache_row_key(r) IN
+                         (SELECT cache_row_key(n) FROM new_rows n EXCEPT SELECT cache_row_key(o) FROM old_rows o)
+                     UNION SELECT c.* FROM old_rows r, %1$s(r) c WHERE cache_row_key(r) IN
+                         (SELECT cache_row_key(o) FROM old_rows o EXCEPT SELECT cache_row_key(n) FROM new_rows n)', f)
+    END;
+    EXECUTE format($q$
+        INSERT INTO cache_versions AS v (scope_type, scope_id, slot, version)
+        SELECT DISTINCT scope_type, scope_id, CASE WHEN scope_type IN ('org', 'directory') THEN pg_backend_pid() %% 16 ELSE 0 END, 1
+        FROM (%s) x ORDER BY scope_type, scope_id
+        ON CONFLICT (scope_type, scope_id, slot) DO UPDATE SET version = v.version + 1, updated_at = NOW()
+    $q$, src);
+    RETURN NULL;
+END $$;
@@ -0,0 +1,72 @@
+-- ================================================================
+-- 019: count the occurrences of bounded series in the dashboard counters
+-- A series with an until date or a count has a known number of occurrences,
+-- occurrence_total (recurrence.store_lengths computes it: the rule lives in
+-- Python). Until an occurrence is materialised it is only counted through
+-- its series: a bounded active series counts occurrence_total minus its
+-- stored occurrences, and each stored row counts 1. Storing an occurrence
+-- moves it from the series to the row, so session rows that are occurrences
+-- of a bounded active series add nothing when written (session_delta_counts).
+-- Open-ended series have no total and stay out of the counters.
+-- ================================================================
+
+ALTER TABLE session_series ADD COLUMN IF NOT EXISTS occurrence_total INT;
+
+CREATE OR REPLACE FUNCTION series_counts(r session_series)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql STABLE AS $$
+    SELECT v.k, v.id, 0,
+           r.occurrence_total - (SELECT COUNT(*) FROM scheduled_sessions ss WHERE ss.series_id = r.id AND ss.occurrence_date IS NOT NULL)::int, 0, 0
+    FROM (VALUES ('coach', r.coach_id), ('org', r.org_id)) v(k, id)
+    WHERE v.id IS NOT NULL AND r.status = 'active' AND r.occurrence_total IS NOT NULL
+$$;
+
+-- What writing a session row changes: its own count, less the occurrence it takes from a bounded active series
+CREATE OR REPLACE FUNCTION session_delta_counts(r scheduled_sessions)
+RETURNS TABLE (scope_type TEXT, scope_id UUID, clients INT, sessions INT, completed_sessions INT, workouts INT)
+LANGUAGE sql STABLE AS $$
+    SELECT c.scope_type, c.scope_id, c.clients,
+           c.sessions - (r.occurrence_date IS NOT NULL AND EXISTS (SELECT 1 FROM session_series ser WHERE ser.id = r.series_id
+                                                                   AND ser.status = 'active' AND ser.occurrence_total IS NOT NULL))::int,
+           c.completed_sessions, c.workouts
+    FROM session_counts(r) c
+$$;
+
+-- The stored occurrences of a deleted series go first, while the series still says whether they were counted
+-- through it (the ON DELETE CASCADE would only remove them after the series row is gone)
+CREATE OR REPLACE FUNCTION delete_series_occurrences() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM scheduled_sessions WHERE series_id = OLD.id;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS session_series_delete_occurrences ON session_series;
+CREATE TRIGGER session_series_delete_occurrences BEFORE DELETE ON session_series
+    FOR EACH ROW EXECUTE FUNCTION delete_series_occurrences();
+
+DO $$
+DECLARE
+    t RECORD;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES ('scheduled_sessions', 'session_delta_counts'), ('session_series', 'series_counts')) v(tbl, fn) LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %1$s_counters_ins ON %1$s; DROP TRIGGER IF EXISTS %1$s_counters_upd ON %1$s; DROP TRIGGER IF EXISTS %1$s_counters_del ON %1$s', t.tbl);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_ins AFTER INSERT ON %1$s REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.fn);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_upd AFTER UPDATE ON %1$s REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.fn);
+        EXECUTE format('CREATE TRIGGER %1$s_counters_del AFTER DELETE ON %1$s REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION maintain_dashboard_counters(%2$L)', t.tbl, t.fn);
+    END LOOP;
+END $$;
+
+CREATE OR REPLACE VIEW dashboard_counts_actual AS
+SELECT scope_type, scope_id, SUM(clients)::bigint AS clients, SUM(sessions)::bigint AS sessions,
+       SUM(completed_sessions)::bigint AS completed_sessions, SUM(workouts)::bigint AS workouts
+FROM (
+    SELECT c.* FROM scheduled_sessions r, session_counts(r) c
+    UNION ALL SELECT c.* FROM session_series r, series_counts(r) c
+    UNION ALL SELECT c.* FROM session_templates r, template_counts(r) c
+    UNION ALL SELECT c.* FROM users r, client_counts(r) c
+) x
+GROUP BY scope_type, scope_id;
@@ -0,0 +1,43 @@
+-- ================================================================
+-- 020: session reminders (reminders.py)
+-- reminder_dirty_window(): how far ahead the reminder_dirty triggers track
+-- changed sessions, the largest policy offset (reminders.MAX_OFFSET_MINUTES)
+-- plus a day. Defined once here; reminders.check_window() verifies at startup
+-- that it still matches the Python limit.
+-- A partial index on the coach of queued reminders, for save_policy()
+-- withdrawing a coach's queued reminders when the policy changes.
+-- ================================================================
+
+CREATE OR REPLACE FUNCTION reminder_dirty_window() RETURNS interval LANGUAGE sql IMMUTABLE AS $$
+    SELECT interval '8 days'
+$$;
+
+CREATE OR REPLACE FUNCTION replan_session_reminders() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM message_queue m USING old_rows o
+        WHERE m.status = 'queued' AND m.message_type = 'reminder' AND m.session_ref = session_ref(o);
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        WITH changed AS (
+            SELECT n.id, n.status, n.scheduled_at, session_ref(o) AS ref FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (n.scheduled_at, n.status, n.coach_id, n.client_id) IS DISTINCT FROM (o.scheduled_at, o.status, o.coach_id, o.client_id)
+        ), withdrawn AS (
+            DELETE FROM message_queue m USING changed c
+            WHERE m.status = 'queued' AND m.message_type = 'reminder' AND m.session_ref = c.ref
+        )
+        -- only sessions close enough for a reminder to be due already
+        INSERT INTO reminder_dirty (kind, id)
+        SELECT 's', c.id FROM changed c WHERE c.status IN ('scheduled', 'confirmed') AND c.scheduled_at < NOW() + reminder_dirty_window()
+        ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END IF;
+    INSERT INTO reminder_dirty (kind, id)
+    SELECT 's', n.id FROM new_rows n WHERE n.status IN ('scheduled', 'confirmed') AND n.scheduled_at < NOW() + reminder_dirty_window()
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_messages_reminder_coach ON message_queue ((metadata->>'coach_id'))
+    WHERE status = 'queued' AND message_type = 'reminder';
@@ -0,0 +1,61 @@
+"""
+Keyset (cursor) pagination for list endpoints.
+
+Lists are ordered newest first by (sort timestamp, id). A page reads limit+1
+rows strictly after the cursor; the extra row only says whether another page
+exists. With an index on (scope, sort_ts DESC, id DESC) a page costs O(limit)
+however much history sits behind it. The cursor is the URL-safe base64 of the
+last row's (timestamp, id) and is opaque to clients.
+"""
+import base64, json, os
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+
+DEFAULT_LIMIT = int(os.getenv("PAGE_DEFAULT_LIMIT", 200))
+MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", 500))
+
+
+def page_limit(limit: Optional[int]) -> int:
+    return max(1, min(limit or DEFAULT_LIMIT, MAX_LIMIT))
+
+def encode_cursor(ts: str, row_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ts, row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, str]]:
+    """(timestamp, id) of the last row of the previous page; 400 if the cursor is malformed."""
+    if not cursor: return None
+    try:
+        ts, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(ts), str(row_id)
+    except Exception: raise HTTPException(400, "Invalid cursor")
+
+def keyset(q: str, p: list, ts_col: str, id_col: str, cursor: Optional[str], limit: int) -> str:
+    """Append the after-cursor predicate, ORDER BY and LIMIT limit+1 to `q` (params go to `p`).
+
+    The predicate keeps a plain range on ts_col so the index is scanned from the
+    cursor; ids compare as text in "C" order, which matches uuid order and also
+    covers virtual session ids ("<series_id>:<date>").
+    """
+    after = decode_cursor(cursor)
+    if after:
+        p += list(after); a, b = len(p) - 1, len(p)
+        q += f' AND {ts_col}<=${a} AND ({ts_col}<${a} OR {id_col}::text COLLATE "C"<${b})'
+    p.append(limit + 1)
+    return q + f" ORDER BY {ts_col} DESC,{id_col} DESC LIMIT ${len(p)}"
+
+def sort_key(ts_key: str, id_key: str = "id"):
+    """Python equivalent of the keyset order, for lists merged in memory."""
+    return lambda r: (datetime.fromisoformat(r[ts_key]), r[id_key])
+
+def after_cursor(items: List[dict], cursor: Optional[str], ts_key: str, id_key: str = "id") -> List[dict]:
+    after = decode_cursor(cursor)
+    if not after: return items
+    key = sort_key(ts_key, id_key)
+    return [r for r in items if key(r) < after]
+
+def next_page(rows: list, limit: int, ts_key: str, id_key: str = "id") -> Tuple[List[dict], Optional[str]]:
+    """Trim a limit+1 fetch to one page; returns (items, next_cursor or None)."""
+    items = [dict(r) for r in rows[:limit]]
+    if len(rows) <= limit: return items, None
+    return items, encode_cursor(items[-1][ts_key], items[-1][id_key])
@@ -0,0 +1,48 @@
+"""
+Password hashing off the event loop.
+
+Passwords are stored as bcrypt hashes with a cost of BCRYPT_ROUNDS. One hash
+costs tens to hundreds of milliseconds of CPU, so hashing and verification
+run on a small dedicated thread pool (the bcrypt C extension releases the
+GIL) and at most PASSWORD_HASH_WORKERS of them are in flight; the event loop
+keeps serving other requests meanwhile. Accounts created before bcrypt hold
+an unsalted SHA-256 hex digest; verify() still accepts those and returns a
+bcrypt replacement, as it does for hashes made with an older cost, so
+callers can upgrade the row on a successful login.
+"""
+import asyncio, hashlib, hmac, os, re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+_LEGACY = re.compile(r"^[0-9a-f]{64}$")
+# Verified against when the account does not exist, so a miss takes as long as a wrong password
+_DUMMY = pwd_context.hash("", rounds=BCRYPT_ROUNDS)
+
+
+def is_legacy(stored: Optional[str]) -> bool:
+    return bool(_LEGACY.match(stored or ""))
+
+async def _run(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+def _verify(password: str, stored: Optional[str]) -> Tuple[bool, bool]:
+    if is_legacy(stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored), True
+    try: ok = pwd_context.verify(password, stored or _DUMMY)
+    except ValueError: return False, False  # not a hash we know (empty, corrupt)
+    return ok and bool(stored), pwd_context.needs_update(stored) if stored else False
+
+async def verify(password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """(matches, new hash to store or None). A new hash is returned for legacy SHA-256 or outdated-cost hashes."""
+    ok, stale = await _run(_verify, password, stored)
+    if not ok: return False, None
+    return True, await hash_password(password) if stale else None
@@ -0,0 +1,225 @@
+"""
+Progress metric series.
+
+Every numeric value in progress_records.metrics is rolled up per client,
+metric and day by triggers (migration 014, progress_rollups), so a series
+reads at most one row per metric and day whatever the number of records.
+Days, weeks (from Monday) and months are aggregated from those rows in one
+query: count, min, max, mean, first and last value, and the change of the
+last value since the previous bucket (seeded from the last value before the
+range, so the first bucket has a delta too). Nested metrics are named
+"parent.child", e.g. "measurements.waist". Days are stored calendar days
+(see localtime.py).
+
+Imports (CSV or NDJSON, optionally gzipped) are parsed as the request body
+arrives and written IMPORT_BATCH rows at a time through a staging table
+(bulk.py), one transaction and one pooled connection per batch, so memory
+and connection use stay flat whatever the file size. Columns/keys other
+than the client, date, type and notes are metrics; `columns` renames them.
+"""
+import codecs, csv, json, math, os, uuid, zlib
+from datetime import date, datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+from bulk import stage_rows, flag_rows, staged_errors, row_error
+from db import get_db, release_db
+
+BUCKETS = ("day", "week", "month")
+MAX_METRICS = 20
+IMPORT_BATCH = int(os.getenv("PROGRESS_IMPORT_BATCH", 5000))
+MAX_ROW_CHARS = 64 * 1024
+MAX_ROW_ERRORS = 200  # reported in full; the rest are only counted
+FORMATS = ("csv", "ndjson")
+# field names (after `columns` renames) that are not metrics
+FIELDS = {"client_id": "client_id", "client_email": "client_email", "email": "client_email", "date": "recorded_at",
+          "recorded_at": "recorded_at", "type": "record_type", "record_type": "record_type", "notes": "notes"}
+IGNORE = ("", "-")
+
+
+class ImportFormatError(ValueError):
+    """The body cannot be read as the declared format; the import stops at this point."""
+
+
+def pick_bucket(start: date, end: date) -> str:
+    """Finest bucket that keeps a series to roughly 100 points."""
+    days = (end - start).days
+    return "day" if days <= 92 else "week" if days <= 730 else "month"
+
+def _num(v):
+    return None if v is None else round(v, 4)
+
+async def metric_series(conn, client_id: str, start: date, end: date, bucket: str,
+                        metrics: Optional[List[str]] = None) -> Dict[str, list]:
+    """{metric: [{bucket, n, min, max, avg, first, last, delta}]} over days [start, end), oldest bucket first.
+    A bucket is labelled by its first day; week/month buckets at the edges only count days in the range."""
+    p = [client_id, start, end, bucket]
+    only = ""
+    if metrics: only = " AND metric = ANY($5::text[])"; p.append(metrics)
+    rows = await conn.fetch(f"""
+        WITH b AS (
+            SELECT metric, date_trunc($4, day)::date AS bucket, SUM(n)::int AS n, MIN(min_value) AS min, MAX(max_value) AS max,
+                   SUM(total) / SUM(n) AS avg, (array_agg(first_value ORDER BY day))[1] AS first,
+                   (array_agg(last_value ORDER BY day DESC))[1] AS last
+            FROM progress_rollups WHERE client_id=$1::uuid AND day>=$2 AND day<$3{only}
+            GROUP BY 1, 2
+        ), m AS (
+            SELECT DISTINCT metric FROM b
+        ), seed AS (
+            SELECT m.metric, s.last_value FROM m CROSS JOIN LATERAL (
+                SELECT last_value FROM progress_rollups r WHERE r.client_id=$1::uuid AND r.metric=m.metric AND r.day<$2
+                ORDER BY r.day DESC LIMIT 1) s
+        )
+        SELECT b.*, b.last - COALESCE(lag(b.last) OVER w, seed.last_value) AS delta
+        FROM b LEFT JOIN seed USING (metric)
+        WINDOW w AS (PARTITION BY b.metric ORDER BY b.bucket)
+        ORDER BY b.metric, b.bucket""", *p)
+    out: Dict[str, list] = {}
+    for r in rows:
+        out.setdefault(r["metric"], []).append({
+            "bucket": r["bucket"].isoformat(), "n": r["n"], "min": _num(r["min"]), "max": _num(r["max"]), "avg": _num(r["avg"]),
+            "first": _num(r["first"]), "last": _num(r["last"]), "delta": _num(r["delta"])})
+    return out
+
+
+# ---- import ----
+
+async def _text(chunks: AsyncIterator[bytes], gzipped: bool) -> AsyncIterator[str]:
+    dec = codecs.getincrementaldecoder("utf-8-sig")()  # -sig: spreadsheet exports often start with a BOM
+    z = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    try:
+        async for chunk in chunks:
+            if z: chunk = z.decompress(chunk)
+            if chunk: yield dec.decode(chunk)
+        yield dec.decode(z.flush() if z else b"", final=True)
+    except UnicodeDecodeError: raise ImportFormatError("File is not UTF-8 text")
+    except zlib.error: raise ImportFormatError("Invalid gzip data")
+
+async def _lines(text: AsyncIterator[str]) -> AsyncIterator[str]:
+    buf = ""
+    async for t in text:
+        *lines, buf = (buf + t).split("\n")
+        if len(buf) > MAX_ROW_CHARS: raise ImportFormatError(f"Row longer than {MAX_ROW_CHARS} characters")
+        for line in lines: yield line.rstrip("\r")
+    if buf: yield buf.rstrip("\r")
+
+async def csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+    """Dicts keyed by the header row. A record spans lines while a quoted field is open (odd quote count)."""
+    header, pending = None, None
+    async for line in lines:
+        pending = line if pending is None else pending + "\n" + line
+        if pending.count('"') % 2:
+            if len(pending) > MAX_ROW_CHARS: raise ImportFormatError(f"Row longer than {MAX_ROW_CHARS} characters")
+            continue
+        record, pending = pending, None
+        if not record.strip(): continue
+        values = next(csv.reader([record]))
+        if header is None:
+            header = [h.strip() for h in values]
+            if len(set(header)) != len(header): raise ImportFormatError("Duplicate column names in header")
+            continue
+        if len(values) != len(header): yield ValueError(f"Expected {len(header)} columns, got {len(values)}")
+        else: yield dict(zip(header, values))
+    if pending is not None: raise ImportFormatError("Unterminated quoted field at end of file")
+
+async def ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+    async for line in lines:
+        if not line.strip(): continue
+        try: row = json.loads(line)
+        except ValueError: yield ValueError("Invalid JSON"); continue
+        yield row if isinstance(row, dict) else ValueError("Row is not a JSON object")
+
+def _number(name: str, v) -> float:
+    if isinstance(v, bool): raise ValueError(f"{name}: not a number")
+    try: n = float(v.strip() if isinstance(v, str) else v)
+    except (TypeError, ValueError): raise ValueError(f"{name}: not a number")
+    if not math.isfinite(n): raise ValueError(f"{name}: not a number")
+    return n
+
+def _timestamp(v) -> datetime:
+    """Stored (floating) time of a date or datetime string; an explicit offset is dropped, the wall clock kept."""
+    try: ts = datetime.fromisoformat(str(v).strip())
+    except ValueError: raise ValueError(f"Invalid date: {str(v)[:40]}")
+    return ts.replace(tzinfo=timezone.utc)
+
+def to_record(raw: dict, columns: Dict[str, str], client_id: Optional[str]) -> tuple:
+    """(client_id, client_email, record_type, notes, recorded_at, metrics json) of one input row; ValueError if invalid."""
+    fields, metrics = {}, {}
+    for key, v in raw.items():
+        name = columns.get(key, key).strip()
+        if name in IGNORE or v is None or v == "": continue
+        if name.lower() in FIELDS: fields[FIELDS[name.lower()]] = str(v).strip(); continue
+        parent, _, child = name.partition(".")
+        if isinstance(v, dict):  # NDJSON {"measurements": {"waist": 80}}
+            nested = {k: _number(f"{name}.{k}", x) for k, x in v.items() if x is not None and x != ""}
+            if nested: metrics.setdefault(name, {}).update(nested)
+        elif child: metrics.setdefault(parent, {})[child] = _number(name, v)
+        else: metrics[name] = _number(name, v)
+    if not metrics: raise ValueError("No metric values")
+    if not fields.get("recorded_at"): raise ValueError("Date is required")
+    cid = fields.get("client_id") or client_id
+    try: cid = uuid.UUID(cid) if cid else None
+    except ValueError: raise ValueError("Invalid client_id")
+    return (cid, fields.get("client_email"), fields.get("record_type") or "measurement", fields.get("notes"),
+            _timestamp(fields["recorded_at"]), json.dumps(metrics))
+
+def _label(raw, columns: Dict[str, str]):
+    """The row's client (email or id) for error reports."""
+    if not isinstance(raw, dict): return None
+    return next((str(v) for k, v in raw.items() if v and FIELDS.get(columns.get(k, k).strip().lower()) in ("client_email", "client_id")), None)
+
+async def _write_batch(coach_id: str, org_id, batch: List[tuple]) -> tuple:
+    """Validate and insert one staged batch; (imported, row errors)."""
+    conn = await get_db()
+    try:
+        async with conn.transaction():
+            await stage_rows(conn, "stage_progress", {"client_id": "UUID", "client_email": "TEXT", "record_type": "TEXT", "notes": "TEXT",
+                                                      "recorded_at": "TIMESTAMPTZ", "metrics": "JSONB"}, batch)
+            await conn.execute("""UPDATE stage_progress s SET client_id=u.id FROM coach_clients cc JOIN users u ON u.id=cc.client_id
+                                  WHERE cc.coach_id=$1::uuid AND s.client_id IS NULL AND lower(u.email)=lower(s.client_email)""", coach_id)
+            await flag_rows(conn, "stage_progress", [
+                ("length(s.record_type) > 50", "type is longer than 50 characters"),
+                ("s.client_id IS NULL AND s.client_email IS NOT NULL", "No client with this email"),
+                ("s.client_id IS NULL", "client_id or client_email is required"),
+                ("NOT EXISTS (SELECT 1 FROM coach_clients cc WHERE cc.coach_id=$2::uuid AND cc.client_id=s.client_id)", "Not one of your clients"),
+                ("EXISTS (SELECT 1 FROM stage_progress d WHERE d.client_id=s.client_id AND d.recorded_at=s.recorded_at AND d.metrics=s.metrics AND d.row_no<s.row_no)",
+                 "Duplicate row in import"),
+                ("EXISTS (SELECT 1 FROM progress_records p WHERE p.client_id=s.client_id AND p.recorded_at=s.recorded_at AND p.metrics=s.metrics)",
+                 "Already recorded"),
+            ], coach_id)
+            n = await conn.fetchval(
+                """WITH ins AS (INSERT INTO progress_records (id,org_id,client_id,recorded_by,record_type,metrics,notes,recorded_at,created_at)
+                                SELECT id,$1,client_id,$2::uuid,record_type,metrics,notes,recorded_at,NOW() FROM stage_progress WHERE error IS NULL ORDER BY row_no
+                                RETURNING 1)
+                   SELECT COUNT(*) FROM ins""", org_id, coach_id)
+            return n, await staged_errors(conn, "stage_progress", "COALESCE(client_email, client_id::text)")
+    finally: await release_db(conn)
+
+async def import_records(chunks: AsyncIterator[bytes], fmt: str, coach_id: str, org_id, client_id: Optional[str] = None,
+                         columns: Optional[Dict[str, str]] = None, gzipped: bool = False) -> dict:
+    """Import progress rows from a byte stream. `index` in row errors is the 1-based data row (CSV header excluded).
+    Batches written before an ImportFormatError stay imported; the error carries the summary so far as `.summary`."""
+    rows = (csv_rows if fmt == "csv" else ndjson_rows)(_lines(_text(chunks, gzipped)))
+    summary = {"rows": 0, "imported": 0, "errors": 0, "row_errors": []}
+
+    def fail(errors):
+        summary["errors"] += len(errors)
+        summary["row_errors"] += errors[:MAX_ROW_ERRORS - len(summary["row_errors"])]
+
+    async def flush():
+        n, errors = await _write_batch(coach_id, org_id, batch)
+        summary["imported"] += n; fail(errors); batch.clear()
+
+    batch: List[tuple] = []
+    try:
+        async for raw in rows:
+            summary["rows"] += 1; i = summary["rows"]
+            try:
+                if isinstance(raw, Exception): raise raw
+                batch.append((i, uuid.uuid4(), *to_record(raw, columns or {}, client_id)))
+            except ValueError as e: fail([row_error(i, _label(raw, columns or {}), str(e)[:200])])
+            if len(batch) >= IMPORT_BATCH: await flush()
+        if batch: await flush()
+    except ImportFormatError as e:
+        e.summary = summary
+        raise
+    finally: summary["row_errors"].sort(key=lambda e: e["index"])
+    return summary
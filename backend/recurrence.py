@@ -0,0 +1,208 @@
+"""
+Recurring session series.
+
+A series (session_series) stores an RRULE-style rule once: freq
+(daily/weekly/monthly), interval, ISO weekdays, until/count and excluded
+dates, plus the coach's holidays. Occurrences are computed on the fly for the
+queried range; a row is only written to scheduled_sessions when a single
+occurrence is touched (see materialize_occurrence). Virtual occurrences use
+the id "<series_id>:<YYYY-MM-DD>".
+"""
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
+
+FREQS = ("daily", "weekly", "monthly")
+# recurrence_type accepted by /sessions/create-recurring -> (freq, interval, by_weekday)
+LEGACY_TYPES = {"daily": ("daily", 1, [1,2,3,4,5]), "weekly": ("weekly", 1, None),
+                "biweekly": ("weekly", 2, None), "monthly": ("monthly", 1, None)}
+
+# Lists show a bounded series to its end, an open-ended one (which never runs out) up to LIST_AHEAD_DAYS past the
+# coach's today; GET /sessions reads older occurrences back from its cursor LIST_STEP_DAYS at a time, doubling, until the page is full
+LIST_AHEAD_DAYS = 60
+LIST_STEP_DAYS = 30
+
+SERIES_COLS = """ser.id::text,ser.coach_id::text,ser.client_id::text,ser.session_template_id::text,ser.freq,ser.freq_interval,ser.by_weekday,
+                 ser.start_date,ser.start_time,ser.until_date,ser.occurrence_count,ser.exdates,ser.skip_holidays,ser.duration_minutes,ser.location,ser.status"""
+
+
+def is_virtual(sid: str) -> bool:
+    return ":" in (sid or "")
+
+def virtual_id(series_id: str, d: date) -> str:
+    return f"{series_id}:{d.isoformat()}"
+
+def parse_virtual_id(sid: str):
+    series_id, d = sid.split(":", 1)
+    return series_id, date.fromisoformat(d)
+
+def _weekdays(series) -> List[int]:
+    if series["by_weekday"]: return sorted(set(series["by_weekday"]))
+    return list(range(1, 8)) if series["freq"] == "daily" else [series["start_date"].isoweekday()]
+
+def _period_index(series, d: date) -> int:
+    """Index of the recurrence period containing `d` (floor; 0 before the start)."""
+    s, k = series["start_date"], series["freq_interval"]
+    if d <= s: return 0
+    if series["freq"] == "daily": return (d - s).days // k
+    if series["freq"] == "weekly": return ((d - timedelta(days=d.weekday())) - (s - timedelta(days=s.weekday()))).days // 7 // k
+    return ((d.year - s.year) * 12 + d.month - s.month) // k
+
+def _periods(series, p: int):
+    """Yield (period_start, candidate dates) from period index p onwards."""
+    s, k, days = series["start_date"], series["freq_interval"], _weekdays(series)
+    week0 = s - timedelta(days=s.weekday())
+    while True:
+        if series["freq"] == "daily":
+            d = s + timedelta(days=p * k)
+            yield d, ([d] if d.isoweekday() in days else [])
+        elif series["freq"] == "weekly":
+            monday = week0 + timedelta(weeks=p * k)
+            yield monday, [monday + timedelta(days=wd - 1) for wd in days if monday + timedelta(days=wd - 1) >= s]
+        else:  # monthly: same day of month, clamped to the month's last day
+            m = s.month - 1 + p * k; y, m = s.year + m // 12, m % 12 + 1
+            yield date(y, m, 1), [date(y, m, min(s.day, monthrange(y, m)[1]))]
+        p += 1
+
+def occurrence_dates(series, start: date, end: date, holidays: Iterable[date] = ()) -> List[date]:
+    """Occurrence dates of `series` in the half-open range [start, end).
+
+    COUNT counts rule occurrences before exclusions (as in RFC 5545); exdates
+    and, when skip_holidays is set, the coach's holidays are then removed.
+    Open-ended series jump straight to the period containing `start`; counted
+    series walk from the first period (bounded by the count).
+    """
+    until, count = series["until_date"], series["occurrence_count"]
+    if until: end = min(end, until + timedelta(days=1))
+    start = max(start, series["start_date"])
+    if start >= end: return []
+    skip = set(series["exdates"] or [])
+    if series["skip_holidays"]: skip |= set(holidays)
+    out, n = [], 0
+    for period_start, dates in _periods(series, 0 if count else _period_index(series, start)):
+        if period_start >= end: break
+        for d in dates:
+            n += 1
+            if count and n > count: return out
+            if start <= d < end and d not in skip: out.append(d)
+    return out
+
+def series_length(series, holidays: Iterable[date] = ()) -> Optional[int]:
+    """Number of occurrences of a bounded series (count or until); None if open-ended."""
+    if not series["occurrence_count"] and not series["until_date"]: return None
+    end = series["until_date"] + timedelta(days=1) if series["until_date"] else date.max
+    return len(occurrence_dates(series, series["start_date"], end, holidays))
+
+def last_date(series) -> Optional[date]:
+    """Last rule date of a bounded series, before exclusions (no occurrence is later); None if open-ended."""
+    if series["until_date"]: return series["until_date"]
+    if not series["occurrence_count"]: return None
+    dates = occurrence_dates({**dict(series), "exdates": None, "skip_holidays": False}, series["start_date"], date.max)
+    return dates[-1] if dates else None
+
+def occurrence_start(series, d: date) -> datetime:
+    return datetime.combine(d, series["start_time"])
+
+def virtual_session(series, d: date, client_name=None, workout_name=None) -> dict:
+    """Occurrence shaped like a scheduled_sessions row from the list endpoints."""
+    return {"id": virtual_id(series["id"], d), "scheduled_at": occurrence_start(series, d).strftime("%Y-%m-%d %H:%M:%S+00"),
+            "duration_minutes": series["duration_minutes"], "status": "scheduled", "notes": None,
+            "coach_id": series["coach_id"], "client_id": series["client_id"], "location": series["location"],
+            "cancelled_reason": None, "client_name": client_name, "workout_name": workout_name,
+            "series_id": series["id"], "virtual": True}
+
+
+async def virtual_sessions(conn, start: date, end: date, coach_id: Optional[str] = None, client_id: Optional[str] = None,
+                           series_id: Optional[str] = None, coach_ids: Optional[List[str]] = None, horizon: Optional[date] = None) -> List[dict]:
+    """Unmaterialised occurrences of active series in [start, end) for a coach (or several), client and/or series.
+    With a horizon, open-ended series stop before it."""
+    if not coach_id and not client_id and not series_id and not coach_ids: return []
+    q = f"""SELECT {SERIES_COLS},u.full_name as client_name,st.name as workout_name FROM session_series ser
+            LEFT JOIN users u ON ser.client_id=u.id LEFT JOIN session_templates st ON ser.session_template_id=st.id
+            WHERE ser.status='active' AND ser.start_date<$1 AND (ser.until_date IS NULL OR ser.until_date>=$2)"""
+    p = [end, start]
+    if coach_id: q += f" AND ser.coach_id=${len(p)+1}::uuid"; p.append(coach_id)
+    if coach_ids: q += f" AND ser.coach_id=ANY(${len(p)+1}::uuid[])"; p.append(coach_ids)
+    if client_id: q += f" AND ser.client_id=${len(p)+1}::uuid"; p.append(client_id)
+    if series_id: q += f" AND ser.id=${len(p)+1}::uuid"; p.append(series_id)
+    series = await conn.fetch(q, *p)
+    if not series: return []
+    ids = [s["id"] for s in series]
+    hol = await conn.fetch("""SELECT coach_id::text,holiday_date FROM coach_holidays
+                              WHERE coach_id=ANY($1::uuid[]) AND holiday_date>=$2 AND holiday_date<$3""",
+                           list({s["coach_id"] for s in series}), start, end)
+    done = await conn.fetch("""SELECT series_id::text,occurrence_date FROM scheduled_sessions
+                               WHERE series_id=ANY($1::uuid[]) AND occurrence_date>=$2 AND occurrence_date<$3""", ids, start, end)
+    holidays, materialized = {}, {(r["series_id"], r["occurrence_date"]) for r in done}
+    for h in hol: holidays.setdefault(h["coach_id"], set()).add(h["holiday_date"])
+    out = []
+    for s in series:
+        stop = min(end, horizon) if horizon and not s["until_date"] and not s["occurrence_count"] else end
+        for d in occurrence_dates(s, start, stop, holidays.get(s["coach_id"], ())):
+            if (s["id"], d) not in materialized: out.append(virtual_session(s, d, s["client_name"], s["workout_name"]))
+    return out
+
+async def series_span(conn, coach_id: Optional[str] = None, client_id: Optional[str] = None) -> Tuple[Optional[date], Optional[date]]:
+    """(earliest start, latest last_date of a bounded series) over the active series of a coach and/or client."""
+    q, p = f"SELECT {SERIES_COLS} FROM session_series ser WHERE ser.status='active'", []
+    if coach_id: p.append(coach_id); q += f" AND ser.coach_id=${len(p)}::uuid"
+    if client_id: p.append(client_id); q += f" AND ser.client_id=${len(p)}::uuid"
+    series = await conn.fetch(q, *p)
+    ends = [d for d in map(last_date, series) if d]
+    return min((s["start_date"] for s in series), default=None), max(ends, default=None)
+
+async def occurrences_before(conn, end: date, floor: Optional[date], want: int, keep: Callable[[List[dict]], List[dict]] = lambda v: v,
+                             horizon: Optional[date] = None, coach_id: Optional[str] = None, client_id: Optional[str] = None) -> List[dict]:
+    """Unmaterialised occurrences on days [floor, end), read backwards from `end` until `want` of them pass
+    `keep` (e.g. a page cursor). Open-ended series stop before `horizon`."""
+    out, hi, step = [], end, LIST_STEP_DAYS
+    while floor is not None and hi > floor and len(out) < want:
+        lo = max(floor, hi - timedelta(days=step))
+        out += keep(await virtual_sessions(conn, lo, hi, coach_id=coach_id, client_id=client_id, horizon=horizon))
+        hi, step = lo, step * 2
+    return out
+
+async def load_series(conn, series_id: str):
+    return await conn.fetchrow(f"SELECT {SERIES_COLS} FROM session_series ser WHERE ser.id=$1::uuid", series_id)
+
+async def materialize_occurrence(conn, sid: str) -> Optional[str]:
+    """Write the occurrence `sid` to scheduled_sessions (idempotent); returns the real id, None if not an occurrence.
+    An occurrence that overlaps a session booked since the series was created is kept, marked overlap_ok."""
+    series_id, d = parse_virtual_id(sid)
+    series = await load_series(conn, series_id)
+    if not series or series["status"] != "active": return None
+    holidays = [r["holiday_date"] for r in await conn.fetch(
+        "SELECT holiday_date FROM coach_holidays WHERE coach_id=$1::uuid AND holiday_date=$2", series["coach_id"], d)]
+    if d not in occurrence_dates(series, d, d + timedelta(days=1), holidays): return None
+    row = await conn.fetchrow(
+        """INSERT INTO scheduled_sessions (org_id,coach_id,client_id,session_template_id,scheduled_at,duration_minutes,status,location,series_id,occurrence_date,overlap_ok,created_at)
+           SELECT org_id,coach_id,client_id,session_template_id,$2,duration_minutes,'scheduled',location,id,$3,
+                  EXISTS (SELECT 1 FROM scheduled_sessions o WHERE o.coach_id=ser.coach_id AND o.status<>'cancelled' AND NOT o.overlap_ok
+                          AND o.period && session_period($2,ser.duration_minutes)),NOW()
+           FROM session_series ser WHERE id=$1::uuid
+           ON CONFLICT (series_id,occurrence_date) WHERE series_id IS NOT NULL DO NOTHING RETURNING id::text""",
+        series_id, occurrence_start(series, d), d)
+    if row: return row["id"]
+    return await conn.fetchval("SELECT id::text FROM scheduled_sessions WHERE series_id=$1::uuid AND occurrence_date=$2", series_id, d)
+
+async def exclude_occurrence(conn, series_id: str, d: date):
+    await conn.execute("UPDATE session_series SET exdates=array_append(exdates,$2) WHERE id=$1::uuid AND NOT ($2=ANY(exdates))", series_id, d)
+    await store_lengths(conn, series_ids=[series_id])
+
+async def store_lengths(conn, series_ids: Optional[List[str]] = None, coach_id: Optional[str] = None, missing: bool = False) -> int:
+    """Store occurrence_total (series_length, holidays applied; NULL if open-ended) of the given series, of a coach's
+    series, or of bounded series that have none yet. The dashboard counters read it (migration 019); call after
+    every change to a series' rule or to its coach's holidays. Returns the number of series changed."""
+    q, p = f"SELECT {SERIES_COLS},ser.occurrence_total FROM session_series ser WHERE true", []
+    if series_ids: p.append(series_ids); q += f" AND ser.id=ANY(${len(p)}::uuid[])"
+    if coach_id: p.append(coach_id); q += f" AND ser.coach_id=${len(p)}::uuid"
+    if missing: q += " AND ser.occurrence_total IS NULL AND (ser.until_date IS NOT NULL OR ser.occurrence_count IS NOT NULL)"
+    series = await conn.fetch(q, *p)
+    hol = await conn.fetch("SELECT coach_id::text,holiday_date FROM coach_holidays WHERE coach_id=ANY($1::uuid[])", list({s["coach_id"] for s in series}))
+    holidays = {}
+    for h in hol: holidays.setdefault(h["coach_id"], []).append(h["holiday_date"])
+    changed = [(s["id"], n) for s in series if (n := series_length(s, holidays.get(s["coach_id"], ()))) != s["occurrence_total"]]
+    if changed:
+        await conn.execute("UPDATE session_series ser SET occurrence_total=x.n FROM unnest($1::uuid[],$2::int[]) x(id,n) WHERE ser.id=x.id",
+                           [i for i, _ in changed], [n for _, n in changed])
+    return len(changed)
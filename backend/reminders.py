@@ -0,0 +1,230 @@
+"""
+Automatic session reminders.
+
+A coach's reminder policy (reminder_policies, migration 013) says how many
+minutes before a session the client is reminded, and on which channel.
+plan() runs every REMINDER_SCAN_SECONDS and queues, in one INSERT, the
+reminders that fall due in (scanned_to, now + lookahead], then moves
+scanned_to up. Each run therefore reads only the sessions whose reminders
+became due since the last one, through the (coach_id, scheduled_at) index,
+whatever the size of the table. Series occurrences are expanded for the same
+window.
+
+Reminders are queued with scheduled_for set to their due time, and the
+message_queue dispatcher (messaging.py) sends them. Sessions that are
+created, moved or cancelled after their window was scanned are listed in
+reminder_dirty by triggers, which also withdraw their queued reminders, and
+the next run re-plans them. So do series and policies that change. If
+several reminders are overdue, only the latest is sent, and none once the
+session has started. dedup_key (session, offset, start time) makes queueing
+idempotent. Times are floating coach-local wall-clock times (localtime.py).
+"""
+import asyncio, json, logging, os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from db import get_db, release_db
+from freebusy import _floating
+from localtime import zone
+from recurrence import parse_virtual_id, virtual_sessions
+
+SCAN_SECONDS = float(os.getenv("REMINDER_SCAN_SECONDS", 300))  # 0 disables the background scheduler
+LOOKAHEAD = timedelta(seconds=float(os.getenv("REMINDER_LOOKAHEAD_SECONDS", 900)))
+MAX_OFFSET_MINUTES = 7 * 24 * 60
+DIRTY_WINDOW = timedelta(minutes=MAX_OFFSET_MINUTES, days=1)  # reminder_dirty_window() in SQL (migration 020)
+MAX_OFFSETS = 5
+LOCK_KEY = 7203117  # one planner at a time across workers
+CHANNELS = ("whatsapp", "sms", "email")
+DEFAULT_TEMPLATE = "Hi {client}, a reminder of your session with {coach} on {date} at {time}."
+
+log = logging.getLogger(__name__)
+_task: Optional[asyncio.Task] = None
+
+
+class _Fields(dict):
+    def __missing__(self, key): return "{" + key + "}"
+
+def message(template: Optional[str], client: Optional[str], coach: Optional[str], start: datetime) -> str:
+    fields = _Fields(client=client or "there", coach=coach or "your coach", date=start.strftime("%a %d %b"), time=start.strftime("%H:%M"))
+    return (template or DEFAULT_TEMPLATE).format_map(fields)
+
+def _local(instant: datetime, tz: str) -> datetime:
+    return instant.astimezone(zone(tz)).replace(tzinfo=None)
+
+def _stored(floating: datetime) -> datetime:
+    return floating.replace(tzinfo=timezone.utc)
+
+def offsets_due(offsets: List[int], start: datetime, lo: datetime, hi: datetime, now: datetime) -> List[int]:
+    """Offsets whose reminder for a session at `start` falls due in (lo, hi]; of the overdue ones only the latest."""
+    if start <= now: return []
+    due = [o for o in offsets if lo < start - timedelta(minutes=o) <= hi]
+    late = [o for o in due if start - timedelta(minutes=o) <= now]
+    return [o for o in due if o not in late] + ([min(late)] if late else [])
+
+async def load_policies(conn) -> Dict[str, dict]:
+    rows = await conn.fetch("""SELECT rp.coach_id::text,rp.offsets_minutes,rp.channel,rp.message_template,u.full_name,u.timezone,u.primary_org_id::text AS org_id
+                               FROM reminder_policies rp JOIN users u ON u.id=rp.coach_id WHERE rp.enabled AND cardinality(rp.offsets_minutes)>0""")
+    return {r["coach_id"]: dict(r) for r in rows}
+
+
+class Plan:
+    """Reminders to queue in one run, keyed by dedup_key."""
+
+    def __init__(self, policies: Dict[str, dict], now: datetime, hi: datetime):
+        self.policies, self.rows = policies, {}
+        self.now = {c: _local(now, p["timezone"]) for c, p in policies.items()}
+        self.hi = {c: _local(hi, p["timezone"]) for c, p in policies.items()}
+
+    def add(self, coach_id: str, ref: str, client_id: str, client_name: Optional[str], start: datetime, lo: Optional[datetime] = None):
+        """Queue the reminders of one session due after `lo` (coach-local; default: any already due)."""
+        p = self.policies.get(coach_id)
+        if not p: return
+        for o in offsets_due(p["offsets_minutes"], start, lo or datetime.min, self.hi[coach_id], self.now[coach_id]):
+            key = f"reminder:{ref}:{o}:{start.isoformat()}"
+            due = zone(p["timezone"]).localize(start - timedelta(minutes=o))
+            meta = {"session_ref": ref, "coach_id": coach_id, "offset_minutes": o, "scheduled_at": start.isoformat(), "subject": "Session Reminder"}
+            self.rows[key] = (p["org_id"], client_id, p["channel"], message(p["message_template"], client_name, p["full_name"], start),
+                              json.dumps(meta), due, ref, key)
+
+    async def insert(self, conn) -> int:
+        if not self.rows: return 0
+        cols = list(map(list, zip(*self.rows.values())))
+        r = await conn.execute(
+            """INSERT INTO message_queue (org_id,recipient_id,channel,message_type,message_content,metadata,scheduled_for,session_ref,dedup_key)
+               SELECT org_id,recipient_id,channel,'reminder',content,meta::jsonb,due,ref,key
+               FROM unnest($1::uuid[],$2::uuid[],$3::text[],$4::text[],$5::text[],$6::timestamptz[],$7::text[],$8::text[])
+                    x(org_id,recipient_id,channel,content,meta,due,ref,key)
+               ON CONFLICT (dedup_key) WHERE dedup_key IS NOT NULL DO NOTHING""", *cols)
+        return int(r.split()[-1])
+
+
+SESSION_COLS = """ss.coach_id::text,ss.client_id::text,u.full_name AS client_name,ss.scheduled_at,session_ref(ss) AS ref
+                  FROM scheduled_sessions ss LEFT JOIN users u ON u.id=ss.client_id"""
+
+async def _window(conn, plan: Plan, lo: datetime):
+    """Sessions of every policy coach with a reminder due in (lo, hi]: one index range scan per coach and offset."""
+    lo_local = {c: _local(lo, p["timezone"]) for c, p in plan.policies.items()}
+    w = [(c, _stored(lo_local[c] + timedelta(minutes=o)), _stored(plan.hi[c] + timedelta(minutes=o)))
+         for c, p in plan.policies.items() for o in set(p["offsets_minutes"])]
+    rows = await conn.fetch(
+        """SELECT ss.coach_id::text,ss.client_id::text,u.full_name AS client_name,ss.scheduled_at,session_ref(ss) AS ref
+           FROM unnest($1::uuid[],$2::timestamptz[],$3::timestamptz[]) w(coach_id,lo,hi)
+           JOIN scheduled_sessions ss ON ss.coach_id=w.coach_id AND ss.scheduled_at>w.lo AND ss.scheduled_at<=w.hi
+           LEFT JOIN users u ON u.id=ss.client_id
+           WHERE ss.status IN ('scheduled','confirmed')""", *map(list, zip(*w)))
+    for r in rows: plan.add(r["coach_id"], r["ref"], r["client_id"], r["client_name"], _floating(r["scheduled_at"]), lo_local[r["coach_id"]])
+    # series occurrences: one expansion per offset, over the days its windows cover
+    for o in {o for p in plan.policies.values() for o in p["offsets_minutes"]}:
+        start = min(lo_local.values()) + timedelta(minutes=o)
+        end = max(plan.hi.values()) + timedelta(minutes=o)
+        for v in await virtual_sessions(conn, start.date(), end.date() + timedelta(days=1), coach_ids=list(plan.policies)):
+            plan.add(v["coach_id"], v["id"], v["client_id"], v["client_name"], _floating(v["scheduled_at"]), lo_local[v["coach_id"]])
+
+async def _dirty(conn, plan: Plan):
+    """Re-plan sessions, series and coaches changed since their window was scanned."""
+    dirty: Dict[str, List[str]] = {"s": [], "r": [], "c": []}
+    for r in await conn.fetch("DELETE FROM reminder_dirty RETURNING kind,id::text"): dirty[r["kind"]].append(r["id"])
+    if dirty["s"]:
+        for r in await conn.fetch(f"SELECT {SESSION_COLS} WHERE ss.id=ANY($1::uuid[]) AND ss.status IN ('scheduled','confirmed')", dirty["s"]):
+            plan.add(r["coach_id"], r["ref"], r["client_id"], r["client_name"], _floating(r["scheduled_at"]))
+    coaches = [c for c in dirty["c"] if c in plan.policies]
+    if coaches:
+        lo = min(plan.now[c] for c in coaches)
+        for r in await conn.fetch(f"""SELECT {SESSION_COLS} WHERE ss.coach_id=ANY($1::uuid[]) AND ss.scheduled_at>$2 AND ss.scheduled_at<=$3
+                                      AND ss.status IN ('scheduled','confirmed')""",
+                                  coaches, _stored(lo), _stored(max(plan.hi[c] for c in coaches) + timedelta(minutes=MAX_OFFSET_MINUTES))):
+            plan.add(r["coach_id"], r["ref"], r["client_id"], r["client_name"], _floating(r["scheduled_at"]))
+    if dirty["r"] or coaches:
+        start, end = min(plan.now.values()).date(), max(plan.hi.values()).date() + timedelta(days=MAX_OFFSET_MINUTES // 1440 + 2)
+        occ = (await virtual_sessions(conn, start, end, coach_ids=coaches) if coaches else [])
+        for sid in dirty["r"]: occ += await virtual_sessions(conn, start, end, series_id=sid)
+        for v in occ: plan.add(v["coach_id"], v["id"], v["client_id"], v["client_name"], _floating(v["scheduled_at"]))
+
+async def plan(conn) -> Optional[int]:
+    """Queue the reminders due up to now + LOOKAHEAD; number queued, None if another worker is planning."""
+    async with conn.transaction():
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", LOCK_KEY): return None
+        now = await conn.fetchval("SELECT NOW()")
+        lo = await conn.fetchval("SELECT scanned_to FROM reminder_scan FOR UPDATE") or now
+        hi = max(now + LOOKAHEAD, lo)
+        p = Plan(await load_policies(conn), now, hi)
+        if p.policies:
+            await _window(conn, p, lo)
+            await _dirty(conn, p)
+        else: await conn.execute("DELETE FROM reminder_dirty")
+        await conn.execute("INSERT INTO reminder_scan (id,scanned_to) VALUES (true,$1) ON CONFLICT (id) DO UPDATE SET scanned_to=EXCLUDED.scanned_to", hi)
+        return await p.insert(conn)
+
+async def save_policy(conn, coach_id: str, policy: dict) -> dict:
+    """Upsert a coach's policy; its queued reminders are withdrawn and re-planned on the next run."""
+    async with conn.transaction():
+        row = await conn.fetchrow(
+            """INSERT INTO reminder_policies (coach_id,offsets_minutes,channel,message_template,enabled) VALUES ($1::uuid,$2,$3,$4,$5)
+               ON CONFLICT (coach_id) DO UPDATE SET offsets_minutes=EXCLUDED.offsets_minutes,channel=EXCLUDED.channel,
+                   message_template=EXCLUDED.message_template,enabled=EXCLUDED.enabled,updated_at=NOW()
+               RETURNING offsets_minutes,channel,message_template,enabled""",
+            coach_id, policy["offsets_minutes"], policy["channel"], policy["message_template"], policy["enabled"])
+        await conn.execute("DELETE FROM message_queue WHERE status='queued' AND message_type='reminder' AND metadata->>'coach_id'=$1", coach_id)
+        await conn.execute("INSERT INTO reminder_dirty (kind,id) VALUES ('c',$1::uuid) ON CONFLICT DO NOTHING", coach_id)
+    return dict(row)
+
+async def check_window(conn):
+    """Raise if reminder_dirty_window(), how far ahead changed sessions are re-planned, no longer matches MAX_OFFSET_MINUTES."""
+    window = await conn.fetchval("SELECT reminder_dirty_window()")
+    if window != DIRTY_WINDOW:
+        raise RuntimeError(f"reminder_dirty_window() is {window}; MAX_OFFSET_MINUTES needs {DIRTY_WINDOW}")
+
+async def send_now(conn, coach_id: str, session_ids: List[str], channel: str, template: Optional[str] = None) -> int:
+    """Queue an immediate reminder for each of the coach's upcoming `session_ids` (ids or series occurrence ids)."""
+    coach = await conn.fetchrow("SELECT full_name,primary_org_id::text FROM users WHERE id=$1::uuid", coach_id)
+    real = [s for s in session_ids if ":" not in s]
+    found = [dict(r) for r in await conn.fetch(f"SELECT {SESSION_COLS} WHERE ss.id=ANY($1::uuid[]) AND ss.coach_id=$2::uuid AND ss.status IN ('scheduled','confirmed')",
+                                               real, coach_id)]
+    for sid in session_ids:
+        if ":" not in sid: continue
+        series_id, d = parse_virtual_id(sid)
+        found += [v for v in await virtual_sessions(conn, d, d + timedelta(days=1), series_id=series_id) if v["coach_id"] == coach_id]
+    rows = [(coach["primary_org_id"], s["client_id"], channel, message(template, s["client_name"], coach["full_name"], _floating(s["scheduled_at"])),
+             json.dumps({"session_ref": s.get("ref") or s["id"], "coach_id": coach_id, "subject": "Session Reminder"}), s.get("ref") or s["id"]) for s in found]
+    if not rows: return 0
+    await conn.execute(
+        """INSERT INTO message_queue (org_id,recipient_id,channel,message_type,message_content,metadata,session_ref)
+           SELECT org_id,recipient_id,channel,'reminder',content,meta::jsonb,ref
+           FROM unnest($1::uuid[],$2::uuid[],$3::text[],$4::text[],$5::text[],$6::text[]) x(org_id,recipient_id,channel,content,meta,ref)""",
+        *map(list, zip(*rows)))
+    return len(rows)
+
+async def _plan_loop():
+    while True:
+        try:
+            conn = await get_db()
+            try: n = await plan(conn)
+            finally: await release_db(conn)
+            if n: log.info("session reminders: queued %d", n)
+        except Exception: log.exception("reminder planning failed")
+        await asyncio.sleep(SCAN_SECONDS)
+
+def start_scheduler():
+    global _task
+    if SCAN_SECONDS > 0 and _task is None: _task = asyncio.create_task(_plan_loop())
+
+async def stop_scheduler():
+    global _task
+    if _task is None: return
+    task, _task = _task, None
+    task.cancel()
+    try: await task
+    except asyncio.CancelledError: pass
+
+
+if __name__ == "__main__":
+    import asyncpg
+    from db import DB_CONFIG
+
+    async def main():
+        conn = await asyncpg.connect(**DB_CONFIG)
+        try:
+            n = await plan(conn)
+            print("Another planner is running" if n is None else f"Queued {n} reminders")
+        finally: await conn.close()
+
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""
+Ranked search over clients, leads and coaches.
+
+Each person is matched on search_doc(name, email, phone) (migration 016):
+word prefixes through the full-text GIN index (search_words), and, where
+the pg_trgm extension is installed, substrings and near-misses through the
+trigram GIN index on the same expression. Clients and leads are limited to
+the coach's own; coaches are the public directory. Results are ordered by
+an exact/prefix name match first, then similarity (trigram word similarity,
+else ts_rank). Highlights wrap the matched parts of each field in <mark>,
+HTML-escaped, for the frontend to render as is.
+"""
+import html, json, re
+from typing import Dict, List, Optional, Tuple
+
+TYPES = ("clients", "leads", "coaches")
+MAX_LIMIT = 50
+MIN_QUERY = 2
+MAX_TERMS = 8
+_WORD = re.compile(r"\w+")
+_trgm: Optional[bool] = None
+
+# type: (FROM/WHERE with {match}, name, email, phone columns, coach scope, extra select)
+SOURCES = {
+    "clients": ("""users u WHERE u.deleted_at IS NULL AND u.role='client' AND u.is_active=true AND {match}""",
+                "u.full_name", "u.email", "u.phone", "EXISTS (SELECT 1 FROM coach_clients cc WHERE cc.coach_id=${n}::uuid AND cc.client_id=u.id)", ""),
+    "leads": ("""leads u WHERE {match}""", "u.name", "u.email", "u.phone", "u.coach_id=${n}::uuid", ",u.status,u.lead_type"),
+    "coaches": ("""users u WHERE u.deleted_at IS NULL AND u.role='coach' AND u.is_active=true AND {match}""",
+                "u.full_name", "u.email", "u.phone", None, ",u.metadata"),
+}
+
+
+async def has_trgm(conn) -> bool:
+    """Whether pg_trgm is installed (checked once per process; migration 016 creates its indexes)."""
+    global _trgm
+    if _trgm is None: _trgm = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname='pg_trgm')")
+    return _trgm
+
+def terms(q: str) -> List[str]:
+    return _WORD.findall(q.lower())[:MAX_TERMS]
+
+def _like(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def build_query(kind: str, q: str, words: List[str], trgm: bool, coach_id: Optional[str], limit: int) -> Tuple[str, list]:
+    """(sql, params) of one result type; ranked best first."""
+    source, name, email, phone, scope, extra = SOURCES[kind]
+    doc = f"search_doc({name},{email},{phone})"
+    p = [" & ".join(f"{w}:*" for w in words), q.lower().strip()]
+    match = f"search_words({doc}) @@ to_tsquery('simple',$1)"
+    similarity = f"ts_rank(search_words({doc}), to_tsquery('simple',$1))"
+    if trgm:
+        p.append([_like(w) for w in words])
+        match = f"({match} OR {doc} LIKE ALL(${len(p)}::text[]) OR $2 <% {doc})"
+        similarity = f"word_similarity($2, {doc})"
+    sql = f"""SELECT u.id::text,{name} AS name,{email} AS email,{phone} AS phone{extra},
+                     (CASE WHEN lower({name})=$2 THEN 2 WHEN lower({name}) LIKE $2||'%' THEN 1 ELSE 0 END + {similarity})::float AS score
+              FROM {source.format(match=match)}"""
+    if scope:
+        p.append(coach_id); sql += " AND " + scope.replace("${n}", f"${len(p)}")
+    p.append(limit)
+    return sql + f" ORDER BY score DESC,{name},u.id LIMIT ${len(p)}", p
+
+def highlight(value: Optional[str], words: List[str], digits_only: bool = False) -> Optional[str]:
+    """`value` HTML-escaped with each match of `words` in <mark>; None if nothing matched.
+    For phones, digit runs match across spaces and punctuation ("98765" in "+91 98765 43210")."""
+    if not value: return None
+    spans = []
+    if digits_only:
+        pos = [i for i, ch in enumerate(value) if ch.isdigit()]
+        digits = "".join(value[i] for i in pos)
+        for w in words:
+            if not w.isdigit(): continue
+            for m in re.finditer(re.escape(w), digits): spans.append((pos[m.start()], pos[m.end() - 1] + 1))
+    else:
+        low = value.lower()
+        for w in words:  # short terms only at word starts, longer ones anywhere (trigram matches)
+            for m in re.finditer(("" if len(w) >= 3 else r"(?<!\w)") + re.escape(w), low): spans.append((m.start(), m.end()))
+    if not spans: return None
+    out, at = [], 0
+    for s, e in sorted(spans):
+        if s < at: s = at
+        if e <= s: continue
+        out.append(html.escape(value[at:s])); out.append("<mark>" + html.escape(value[s:e]) + "</mark>"); at = e
+    out.append(html.escape(value[at:]))
+    return "".join(out)
+
+def _result(kind: str, r, words: List[str]) -> dict:
+    item = {"id": r["id"], "name": r["name"], "score": round(r["score"], 4)}
+    fields = {"name": r["name"], "email": r["email"]}
+    if kind == "coaches":
+        m = json.loads(r["metadata"]) if isinstance(r["metadata"], str) else (r["metadata"] or {})
+        item.update(email=r["email"], specialization=m.get("specialization", "general"))
+    else:
+        item.update(email=r["email"], phone=r["phone"])
+        if kind == "leads": item.update(status=r["status"], lead_type=r["lead_type"])
+    marks = {f: highlight(v, words) for f, v in fields.items()}
+    if kind != "coaches": marks["phone"] = highlight(r["phone"], words, digits_only=True)
+    item["highlight"] = {f: v for f, v in marks.items() if v}
+    return item
+
+async def search(conn, q: str, kinds: List[str], coach_id: Optional[str], limit: int) -> Dict[str, list]:
+    """{type: [result]} for each of `kinds`. Clients and leads need `coach_id` (none: no clients or leads)."""
+    words = terms(q)
+    out: Dict[str, list] = {k: [] for k in kinds}
+    if not words: return out
+    trgm = await has_trgm(conn)
+    for kind in kinds:
+        if SOURCES[kind][4] and not coach_id: continue
+        sql, p = build_query(kind, q, words, trgm, coach_id, limit)
+        out[kind] = [_result(kind, r, words) for r in await conn.fetch(sql, *p)]
+    return out
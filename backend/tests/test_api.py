@@ -94,6 +94,19 @@ class TestAuth:
         }, timeout=30)
         assert r.status_code == 401
 
+    def test_client_password_reset_and_login(self, base_url):
+        import random, string
+        s = ''.join(random.choices(string.ascii_lowercase, k=6))
+        email, phone = f"pwclient_{s}@test.com", f"+91{''.join(random.choices(string.digits, k=10))}"
+        r = httpx.post(f"{base_url}/auth/client-register", json={"email": email, "name": "PW", "password": "first123", "phone": phone}, timeout=30)
+        assert r.status_code == 200
+        r = httpx.post(f"{base_url}/auth/reset-password", json={"email": email, "new_password": "second123", "role": "client", "phone_last4": phone[-4:]}, timeout=30)
+        assert r.status_code == 200
+        assert httpx.post(f"{base_url}/auth/client-login", json={"email": email, "password": "first123"}, timeout=30).status_code == 401
+        r = httpx.post(f"{base_url}/auth/client-login", json={"email": email, "password": "second123"}, timeout=30)
+        assert r.status_code == 200
+        assert "password_hash" not in r.json()["client"]
+
 
 # ============================================================================
 # CLIENT TESTS
@@ -123,6 +136,31 @@ class TestClients:
         assert isinstance(d["clients"], list)
         assert len(d["clients"]) >= 1
 
+    def test_get_clients_paginated(self, base_url, coach_headers):
+        everything = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 1, **({"cursor": cursor} if cursor else {})}
+            d = httpx.get(f"{base_url}/clients", params=params, headers=coach_headers, timeout=30).json()
+            assert len(d["clients"]) <= 1
+            seen += [c["id"] for c in d["clients"]]
+            cursor = d["next_cursor"]
+            if not cursor: break
+        assert seen == [c["id"] for c in everything]
+
+    def test_get_clients_conditional(self, base_url, coach_headers):
+        r = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30)
+        etag = r.headers["etag"]
+        assert httpx.get(f"{base_url}/clients", headers={**coach_headers, "If-None-Match": etag}, timeout=30).status_code == 304
+        httpx.post(f"{base_url}/clients", json={"name": "ETag Client"}, headers=coach_headers, timeout=30)
+        r = httpx.get(f"{base_url}/clients", headers={**coach_headers, "If-None-Match": etag}, timeout=30)
+        assert r.status_code == 200
+        assert r.headers["etag"] != etag
+
+    def test_get_clients_bad_cursor(self, base_url, coach_headers):
+        r = httpx.get(f"{base_url}/clients", params={"cursor": "not-a-cursor"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 400
+
     def test_client_isolation(self, base_url):
         """Clients from one coach should not appear for another coach."""
         import random, string
@@ -139,6 +177,16 @@ class TestClients:
                        headers={"X-Coach-Id": new_coach_id, "Content-Type": "application/json"}, timeout=30)
         assert len(r.json()["clients"]) == 0
 
+    def test_converted_lead_listed_for_coach(self, base_url, coach_headers, coach):
+        import random, string
+        lead = httpx.post(f"{base_url}/coaches/{coach['id']}/interest", json={
+            "lead_type": "interest", "name": "Listed Lead", "phone": f"+91{''.join(random.choices(string.digits, k=10))}"
+        }, timeout=30).json()["lead"]
+        client = httpx.post(f"{base_url}/leads/{lead['id']}/convert",
+                            headers=coach_headers, timeout=30).json()["client"]
+        r = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30)
+        assert client["id"] in [c["id"] for c in r.json()["clients"]]
+
     def test_bulk_import(self, base_url, coach_headers):
         r = httpx.post(f"{base_url}/clients/bulk-import", json={
             "clients": [
@@ -150,6 +198,65 @@ class TestClients:
         assert r.status_code == 200
         assert "Imported" in r.json().get("message", "")
 
+    def test_bulk_import_reports_row_errors(self, base_url, coach_headers):
+        r = httpx.post(f"{base_url}/clients/bulk-import", json={
+            "clients": [
+                {"name": "Bulk D", "email": "bulkd@test.com"},
+                {"name": "Bulk D again", "email": "bulkd@test.com"},
+            ]
+        }, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        d = r.json()
+        assert d["errors"] >= 1
+        assert 1 in [e["index"] for e in d["row_errors"]]
+
+    def test_progress_metric_series(self, base_url, coach_headers):
+        cid = httpx.post(f"{base_url}/clients", json={"name": "Progress Client"}, headers=coach_headers, timeout=30).json()["client"]["id"]
+        for day, weight in (("2026-01-05", 80), ("2026-01-06", 79), ("2026-01-13", 78)):
+            httpx.post(f"{base_url}/progress/upload", json={"client_id": cid, "weight": weight, "date": day}, timeout=30)
+        r = httpx.get(f"{base_url}/progress/{cid}/metrics", params={"from": "2026-01-01", "to": "2026-02-01", "bucket": "week"},
+                      headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        weeks = r.json()["metrics"]["weight"]
+        assert [(w["bucket"], w["n"], w["min"], w["last"]) for w in weeks] == [("2026-01-05", 2, 79, 79), ("2026-01-12", 1, 78, 78)]
+        assert weeks[1]["delta"] == -1
+
+    def test_progress_metrics_need_coachs_client(self, base_url, coach_headers):
+        import random, string
+        s = ''.join(random.choices(string.ascii_lowercase, k=6))
+        cid = httpx.post(f"{base_url}/clients", json={"name": "Private Progress"}, headers=coach_headers, timeout=30).json()["client"]["id"]
+        other = httpx.post(f"{base_url}/coaches/register", json={"full_name": f"Other Coach {s}", "email": f"other_{s}@test.com",
+                           "phone": f"+91{''.join(random.choices(string.digits, k=10))}", "password": "pass123"}, timeout=30).json()["coach"]["id"]
+        assert httpx.get(f"{base_url}/progress/{cid}/metrics", headers={"X-Coach-Id": other}, timeout=30).status_code == 404
+        assert httpx.get(f"{base_url}/progress/{cid}/metrics", timeout=30).status_code == 400
+        assert httpx.get(f"{base_url}/progress/not-a-uuid/metrics", headers=coach_headers, timeout=30).status_code == 400
+
+    def test_progress_csv_import(self, base_url, coach_headers):
+        cid = httpx.post(f"{base_url}/clients", json={"name": "Import Client"}, headers=coach_headers, timeout=30).json()["client"]["id"]
+        body = "Date,Weight (kg),measurements.waist,notes\n2026-02-01,81,92,\"first, weigh-in\"\n2026-02-02,heavy,,\n2026-02-03,80.5,91,\n"
+        r = httpx.post(f"{base_url}/progress/import", params={"client_id": cid, "columns": '{"Weight (kg)": "weight"}'}, content=body,
+                       headers={**coach_headers, "Content-Type": "text/csv"}, timeout=60)
+        assert r.status_code == 200
+        d = r.json()
+        assert (d["rows"], d["imported"], d["errors"]) == (3, 2, 1)
+        assert d["row_errors"][0]["index"] == 2
+        again = httpx.post(f"{base_url}/progress/import", params={"client_id": cid, "columns": '{"Weight (kg)": "weight"}'}, content=body,
+                           headers={**coach_headers, "Content-Type": "text/csv"}, timeout=60).json()
+        assert again["imported"] == 0
+
+    def test_search_clients(self, base_url, coach_headers):
+        import random, string
+        s = ''.join(random.choices(string.ascii_lowercase, k=8))
+        cid = httpx.post(f"{base_url}/clients", json={"name": f"Searchable {s.title()}", "email": f"{s}@test.com"},
+                         headers=coach_headers, timeout=30).json()["client"]["id"]
+        r = httpx.get(f"{base_url}/search", params={"q": s[:5], "types": "clients"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        hits = r.json()["results"]["clients"]
+        assert hits[0]["id"] == cid
+        assert f"<mark>{s[:5].title()}</mark>" in hits[0]["highlight"]["name"]
+        other = httpx.get(f"{base_url}/search", params={"q": s[:5], "types": "clients"}, timeout=30).json()
+        assert other["results"]["clients"] == []
+
     def test_delete_client(self, base_url, coach_headers):
         # Create then delete
         cr = httpx.post(f"{base_url}/clients", json={"name": "ToDelete"},
@@ -232,11 +339,63 @@ class TestSessions:
         assert r.status_code == 200
         assert "Created" in r.json().get("message", "")
 
+    def test_recurring_series_occurrences(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        r = httpx.post(f"{base_url}/sessions/create-recurring", json={
+            "client_id": clients[0]["id"], "freq": "weekly", "by_weekday": [1, 3],
+            "start_date": "2026-04-06", "time": "07:00", "count": 6
+        }, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        d = r.json()
+        assert d["occurrences"] == 6
+        occ = httpx.get(f"{base_url}/sessions/series/{d['series']['id']}/occurrences?from=2026-04-01&to=2026-06-01",
+                        headers=coach_headers, timeout=30).json()["occurrences"]
+        assert [o["scheduled_at"][:10] for o in occ] == [
+            "2026-04-06", "2026-04-08", "2026-04-13", "2026-04-15", "2026-04-20", "2026-04-22"]
+
+    def test_update_series_checks_conflicts(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions/create-recurring", json={
+            "client_id": clients[0]["id"], "freq": "weekly", "by_weekday": [2],
+            "start_date": "2028-02-01", "time": "06:00", "count": 3
+        }, headers=coach_headers, timeout=30).json()["series"]["id"]
+        assert httpx.post(f"{base_url}/sessions", json={"client_id": clients[0]["id"], "scheduled_at": "2028-02-08T08:00"},
+                          headers=coach_headers, timeout=30).status_code == 200
+        r = httpx.patch(f"{base_url}/sessions/series/{sid}", json={"time": "08:30"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 409
+        assert r.json()["detail"]["dates"] == ["2028-02-08"]
+        r = httpx.patch(f"{base_url}/sessions/series/{sid}", json={"time": "08:30", "skip_conflicts": True}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        assert r.json()["skipped"] == ["2028-02-08"]
+
     def test_get_sessions(self, base_url, coach_headers):
         r = httpx.get(f"{base_url}/sessions", headers=coach_headers, timeout=30)
         assert r.status_code == 200
         assert isinstance(r.json()["sessions"], list)
 
+    def test_get_sessions_pages_reach_old_occurrences(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions/create-recurring", json={
+            "client_id": clients[0]["id"], "freq": "weekly", "by_weekday": [1],
+            "start_date": "2024-01-01", "time": "05:00", "count": 3
+        }, headers=coach_headers, timeout=30).json()["series"]["id"]
+        seen, cursor = [], None
+        while True:
+            d = httpx.get(f"{base_url}/sessions", params={"limit": 50, **({"cursor": cursor} if cursor else {})},
+                          headers=coach_headers, timeout=30).json()
+            seen += [s["scheduled_at"][:10] for s in d["sessions"] if s.get("series_id") == sid]
+            cursor = d["next_cursor"]
+            if not cursor: break
+        assert seen == ["2024-01-15", "2024-01-08", "2024-01-01"]
+
+    def test_get_sessions_lists_bounded_series_to_the_end(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions/create-recurring", json={
+            "client_id": clients[0]["id"], "freq": "monthly", "start_date": "2029-01-03", "time": "05:00", "count": 3
+        }, headers=coach_headers, timeout=30).json()["series"]["id"]
+        sessions = httpx.get(f"{base_url}/sessions", params={"limit": 500}, headers=coach_headers, timeout=30).json()["sessions"]
+        assert [s["scheduled_at"][:10] for s in sessions if s.get("series_id") == sid] == ["2029-03-03", "2029-02-03", "2029-01-03"]
+
     def test_mark_attendance(self, base_url, coach_headers):
         sessions = httpx.get(f"{base_url}/sessions", headers=coach_headers, timeout=30).json()["sessions"]
         if sessions:
@@ -245,6 +404,65 @@ class TestSessions:
                            json={"status": "attended"}, headers=coach_headers, timeout=30)
             assert r.status_code == 200
 
+    def test_ai_actions_applied_server_side(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        r = httpx.post(f"{base_url}/ai/actions", json={"actions": [
+            {"type": "schedule_session", "params": {"client_id": clients[0]["id"], "date": "2026-05-04", "time": "06:30"}},
+            {"type": "schedule_session", "params": {"client_id": clients[0]["id"], "date": "2026-05-05", "duration": 45}},
+            {"type": "mark_attendance", "params": {"session_id": "00000000-0000-0000-0000-000000000000", "status": "present"}},
+            {"type": "none", "params": {}},
+        ]}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        d = r.json()
+        assert d["applied"] == 3 and d["errors"] == 1
+        assert [x["success"] for x in d["results"]] == [True, True, False, True]
+        assert d["results"][2]["error"] == "Session not found"
+
+    def test_ai_actions_invalid_status_rejected_alone(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions", json={"client_id": clients[0]["id"], "scheduled_at": "2027-04-06T06:00"},
+                         headers=coach_headers, timeout=30).json()["session"]["id"]
+        r = httpx.post(f"{base_url}/ai/actions", json={"actions": [
+            {"type": "mark_attendance", "params": {"session_id": sid, "status": "late"}},
+            {"type": "mark_attendance", "params": {"session_id": sid, "status": "present"}},
+        ]}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        results = r.json()["results"]
+        assert results[0]["error"].startswith("Invalid params") and results[1]["success"] is True
+
+    def test_ai_actions_resolve_series_occurrences(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions/create-recurring", json={"client_id": clients[0]["id"], "recurrence_type": "weekly",
+                         "start_date": "2032-03-01", "time": "06:00", "num_sessions": 3}, headers=coach_headers, timeout=30).json()["series"]["id"]
+        r = httpx.post(f"{base_url}/ai/actions", json={"actions": [
+            {"type": "mark_attendance", "params": {"session_id": f"{sid}:2032-03-01", "status": "present"}},
+            {"type": "mark_attendance", "params": {"session_id": f"{sid}:2032-03-02", "status": "present"}},
+            {"type": "mark_attendance", "params": {"session_id": f"{sid}:2032-03-22", "status": "present"}},
+            {"type": "cancel_session", "params": {"session_id": f"{sid}:2032-03-08"}},
+        ]}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        results = r.json()["results"]
+        assert [x["success"] for x in results] == [True, False, False, True]
+        assert results[1]["error"] == results[2]["error"] == "Session not found"
+        again = httpx.post(f"{base_url}/sessions/{sid}:2032-03-01/mark-attendance", json={"status": "absent"}, headers=coach_headers, timeout=30)
+        assert again.json()["session_id"] == results[0]["id"]
+
+    def test_ai_add_client_existing_name_rejected(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        r = httpx.post(f"{base_url}/ai/actions", json={"actions": [
+            {"type": "add_client", "params": {"name": clients[0]["name"].upper()}},
+        ]}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        assert r.json()["results"][0]["error"] == "A client with this name already exists"
+
+    def test_overlapping_session_rejected(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        body = {"client_id": clients[0]["id"], "scheduled_at": "2027-03-02T07:00", "duration_minutes": 60}
+        assert httpx.post(f"{base_url}/sessions", json=body, headers=coach_headers, timeout=30).status_code == 200
+        r = httpx.post(f"{base_url}/sessions", json={**body, "scheduled_at": "2027-03-02T07:30"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 409
+        assert r.json()["detail"]["conflicts"][0]["scheduled_at"].startswith("2027-03-02 07:00")
+
     def test_delete_session(self, base_url, coach_headers):
         sessions = httpx.get(f"{base_url}/sessions", headers=coach_headers, timeout=30).json()["sessions"]
         if sessions:
@@ -263,11 +481,75 @@ class TestDashboard:
         assert "total_clients" in s
         assert "total_sessions" in s
 
+    def test_stats_track_client_changes(self, base_url, coach_headers):
+        before = httpx.get(f"{base_url}/dashboard/stats", headers=coach_headers, timeout=30).json()["stats"]
+        cid = httpx.post(f"{base_url}/clients", json={"name": "Counter Client"}, headers=coach_headers, timeout=30).json()["client"]["id"]
+        after = httpx.get(f"{base_url}/dashboard/stats", headers=coach_headers, timeout=30).json()["stats"]
+        assert after["total_clients"] == before["total_clients"] + 1
+        httpx.delete(f"{base_url}/clients/{cid}", headers=coach_headers, timeout=30)
+        final = httpx.get(f"{base_url}/dashboard/stats", headers=coach_headers, timeout=30).json()["stats"]
+        assert final["total_clients"] == before["total_clients"]
+
+    def test_stats_count_bounded_series(self, base_url, coach_headers):
+        total = lambda: httpx.get(f"{base_url}/dashboard/stats", headers=coach_headers, timeout=30).json()["stats"]["total_sessions"]
+        before = total()
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        sid = httpx.post(f"{base_url}/sessions/create-recurring", json={"client_id": clients[0]["id"], "recurrence_type": "weekly",
+                         "start_date": "2031-02-03", "time": "06:00", "num_sessions": 5}, headers=coach_headers, timeout=30).json()["series"]["id"]
+        httpx.post(f"{base_url}/sessions/create-recurring", json={"client_id": clients[0]["id"], "freq": "weekly",
+                   "start_date": "2031-02-04", "time": "06:00"}, headers=coach_headers, timeout=30)
+        assert total() == before + 5
+        httpx.post(f"{base_url}/sessions/{sid}:2031-02-03/mark-attendance", json={"status": "attended"}, headers=coach_headers, timeout=30)
+        assert total() == before + 5
+        httpx.delete(f"{base_url}/sessions/series/{sid}", headers=coach_headers, timeout=30)
+        assert total() == before + 1
+
+    def test_client_dashboard_split_and_attendance(self, base_url, coach_headers):
+        cid = httpx.post(f"{base_url}/clients", json={"name": "Dashboard Client"}, headers=coach_headers, timeout=30).json()["client"]["id"]
+        ids = {}
+        for key, when, status in (("p1", "2025-01-06T05:00", "attended"), ("p2", "2025-01-07T05:00", "absent"), ("p3", "2025-01-08T05:00", None),
+                                  ("f1", "2033-01-03T05:00", None), ("f2", "2033-01-04T05:00", None), ("f3", "2033-01-05T05:00", "attended")):
+            ids[key] = httpx.post(f"{base_url}/sessions", json={"client_id": cid, "scheduled_at": when}, headers=coach_headers, timeout=30).json()["session"]["id"]
+            if status:
+                httpx.post(f"{base_url}/sessions/{ids[key]}/mark-attendance", json={"status": status}, headers=coach_headers, timeout=30)
+        httpx.post(f"{base_url}/sessions/{ids['f2']}/cancel", json={"reason": "away"}, headers=coach_headers, timeout=30)
+        r = httpx.get(f"{base_url}/client/{cid}/dashboard", timeout=30)
+        assert r.status_code == 200
+        d = r.json()
+        assert [s["id"] for s in d["upcoming"]] == [ids["f1"], ids["f3"]]
+        assert [s["id"] for s in d["past"]] == [ids["f3"], ids["p3"], ids["p2"], ids["p1"]]
+        assert d["stats"] == {"attended": 2, "absent": 1, "rate": 67, "upcoming_count": 2}
+
     def test_today_schedule(self, base_url, coach_headers):
         r = httpx.get(f"{base_url}/schedule/today", headers=coach_headers, timeout=30)
         assert r.status_code == 200
         assert isinstance(r.json()["sessions"], list)
 
+    def test_schedule_range(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        for when in ("2026-05-10T00:00", "2026-05-10T23:30", "2026-05-11T00:00"):
+            httpx.post(f"{base_url}/sessions", json={"client_id": clients[0]["id"], "scheduled_at": when}, headers=coach_headers, timeout=30)
+        r = httpx.get(f"{base_url}/schedule", params={"from": "2026-05-10", "to": "2026-05-11"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        days = {s["scheduled_at"][:10] for s in r.json()["sessions"]}
+        assert days == {"2026-05-10"}
+
+    def test_schedule_range_invalid(self, base_url, coach_headers):
+        r = httpx.get(f"{base_url}/schedule", params={"from": "2026-05-11", "to": "2026-05-10"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 400
+
+    def test_free_slots_exclude_booked_time(self, base_url, coach_headers):
+        httpx.put(f"{base_url}/availability", json={"working_days": [1, 2, 3, 4, 5],
+                  "slots": [{"label": "Morning", "start": "07:00", "end": "10:00"}]}, headers=coach_headers, timeout=30)
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        httpx.post(f"{base_url}/sessions", json={"client_id": clients[0]["id"], "scheduled_at": "2030-06-03T08:00",
+                   "duration_minutes": 60}, headers=coach_headers, timeout=30)
+        r = httpx.get(f"{base_url}/availability/free", params={"from": "2030-06-03", "to": "2030-06-04"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        day = r.json()["coaches"][0]["days"][0]
+        assert day["free"] == [{"start": "07:00", "end": "08:00"}, {"start": "09:00", "end": "10:00"}]
+        assert day["slots"] == ["07:00", "09:00"]
+
 
 # ============================================================================
 # COACH PROFILE & REVIEWS TESTS
@@ -301,6 +583,25 @@ class TestCoachProfile:
         assert r.status_code == 200
         assert len(r.json()["reviews"]) >= 1
 
+    def test_profile_review_aggregates(self, base_url, coach):
+        before = httpx.get(f"{base_url}/coaches/{coach['id']}/profile", timeout=30).json()["profile"]
+        httpx.post(f"{base_url}/coaches/{coach['id']}/reviews", json={"rating": 3, "review_text": "OK"}, timeout=30)
+        after = httpx.get(f"{base_url}/coaches/{coach['id']}/profile", timeout=30).json()["profile"]
+        assert after["review_count"] == before["review_count"] + 1
+        assert after["rating_histogram"]["3"] == before["rating_histogram"]["3"] + 1
+        assert sum(after["rating_histogram"].values()) == after["review_count"]
+
+    def test_logo_served_by_hash(self, base_url, coach):
+        png = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+        r = httpx.post(f"{base_url}/coaches/{coach['id']}/logo", json={"logo_base64": png}, timeout=30)
+        assert r.status_code == 200
+        url = r.json()["logo_url"]
+        img = httpx.get(url, timeout=30)
+        assert img.status_code == 200
+        assert img.headers["content-type"] == "image/png"
+        assert "immutable" in img.headers["cache-control"]
+        assert httpx.get(url, headers={"If-None-Match": img.headers["etag"]}, timeout=30).status_code == 304
+
     def test_profile_nonexistent(self, base_url):
         r = httpx.get(f"{base_url}/coaches/00000000-0000-0000-0000-000000000099/profile", timeout=30)
         assert r.status_code == 404
@@ -319,6 +620,25 @@ class TestRemindersPayments:
             }, headers=coach_headers, timeout=30)
             assert r.status_code == 200
 
+    def test_send_personal_queued(self, base_url, coach_headers):
+        clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
+        phone_clients = [c for c in clients if c.get("phone")]
+        if phone_clients:
+            r = httpx.post(f"{base_url}/reminders/send-personal", json={
+                "client_id": phone_clients[0]["id"], "method": "sms", "queue": True
+            }, headers=coach_headers, timeout=30)
+            assert r.status_code == 200
+            d = r.json()
+            assert d["queued"] is True and d["message_id"]
+
+    def test_reminder_policy(self, base_url, coach_headers):
+        r = httpx.put(f"{base_url}/reminders/policy", json={"offsets_minutes": [60, 1440], "channel": "whatsapp"}, headers=coach_headers, timeout=30)
+        assert r.status_code == 200
+        assert r.json()["policy"]["offsets_minutes"] == [1440, 60]
+        assert httpx.get(f"{base_url}/reminders/policy", headers=coach_headers, timeout=30).json()["policy"]["enabled"] is True
+        r = httpx.put(f"{base_url}/reminders/policy", json={"offsets_minutes": [0]}, headers=coach_headers, timeout=30)
+        assert r.status_code == 400
+
     def test_create_payment_link(self, base_url, coach_headers):
         clients = httpx.get(f"{base_url}/clients", headers=coach_headers, timeout=30).json()["clients"]
         if clients:
@@ -420,6 +740,17 @@ class TestLeads:
         for lead in r.json()["leads"]:
             assert lead["status"] == "new"
 
+    def test_export_leads(self, base_url, coach_headers):
+        import csv, io
+        listed = httpx.get(f"{base_url}/leads", params={"limit": 100}, headers=coach_headers, timeout=30).json()["leads"]
+        r = httpx.get(f"{base_url}/export/leads", headers=coach_headers, timeout=60)
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(r.text)))
+        assert {l["id"] for l in listed} <= {row["id"] for row in rows}
+        r = httpx.get(f"{base_url}/export/leads", params={"format": "ndjson", "gzip": "true"}, headers=coach_headers, timeout=60)
+        assert len([json.loads(line) for line in r.text.splitlines()]) == len(rows)
+
     def test_update_lead_status(self, base_url, coach_headers):
         leads = httpx.get(f"{base_url}/leads", headers=coach_headers, timeout=30).json()["leads"]
         new_leads = [l for l in leads if l["status"] == "new"]
@@ -463,3 +794,113 @@ class TestLeads:
         r = httpx.get(f"{base_url}/leads",
                        headers={"X-Coach-Id": new_id, "Content-Type": "application/json"}, timeout=30)
         assert len(r.json()["leads"]) == 0
+
+
+# ============================================================================
+# AI UPSTREAM CLIENT (no network: httpx.MockTransport)
+# ============================================================================
+class TestAIClient:
+    @pytest.fixture
+    def upstream(self, monkeypatch):
+        """Route ai_client through a MockTransport; `replies` are served in order (callables raise or build responses)."""
+        import ai_client
+        calls = []
+        def handle(request):
+            reply = upstream.replies[len(calls)]; calls.append(request)
+            return reply(request) if callable(reply) else reply
+        upstream = type("Upstream", (), {"replies": [], "calls": calls})
+        monkeypatch.setattr(ai_client, "BACKOFF_SECONDS", 0)
+        monkeypatch.setattr(ai_client, "_client", httpx.AsyncClient(base_url="http://ai.test", transport=httpx.MockTransport(handle)))
+        return upstream
+
+    @staticmethod
+    def _drop(request):
+        raise httpx.RemoteProtocolError("peer closed connection", request=request)
+
+    def test_overloaded_then_ok(self, upstream):
+        import ai_client
+        upstream.replies = [httpx.Response(529), httpx.Response(200, json={"content": [{"type": "text", "text": "hi"}]})]
+        r = asyncio.run(ai_client.create_message("sys", [{"role": "user", "content": "x"}], "key"))
+        assert r["content"][0]["text"] == "hi" and len(upstream.calls) == 2
+
+    def test_stream_retried_after_transport_error(self, upstream):
+        import ai_client
+        sse = 'data: {"type":"content_block_delta","delta":{"type":"text_delta","text":"he"}}\n\n' \
+              'data: {"type":"content_block_delta","delta":{"type":"text_delta","text":"llo"}}\n\n'
+        upstream.replies = [self._drop, httpx.Response(200, text=sse, headers={"content-type": "text/event-stream"})]
+        async def collect(): return [t async for t in ai_client.stream_message("sys", [{"role": "user", "content": "x"}], "key")]
+        assert asyncio.run(collect()) == ["he", "llo"] and len(upstream.calls) == 2
+
+    def test_stream_not_retried_after_first_chunk(self, upstream):
+        import ai_client
+        class Body(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                yield b'data: {"type":"content_block_delta","delta":{"type":"text_delta","text":"he"}}\n\n'
+                raise httpx.ReadError("connection reset")
+        upstream.replies = [httpx.Response(200, stream=Body()), httpx.Response(200, text="")]
+        seen = []
+        async def collect():
+            async for t in ai_client.stream_message("sys", [{"role": "user", "content": "x"}], "key"): seen.append(t)
+        with pytest.raises(ai_client.UpstreamError):
+            asyncio.run(collect())
+        assert seen == ["he"] and len(upstream.calls) == 1
+
+    REPLY = '{"message": "Marked \\"Asha\\" {present}", "actions": [{"type": "mark_attendance", ' \
+            '"params": {"session_id": "s1", "note": "late }]"}}, {"type": "none", "params": {"tags": [{"a": 1}]}}]}'
+
+    @staticmethod
+    def _deltas(chunks):
+        return "".join(f'data: {json.dumps({"type": "content_block_delta", "delta": {"type": "text_delta", "text": c}})}\n\n' for c in chunks)
+
+    def test_action_scanner_chunk_boundaries(self):
+        from ai_stream import ActionScanner
+        expected = json.loads(self.REPLY)["actions"]
+        for size in (1, 2, 3, 5, 7, 11, len(self.REPLY)):
+            scanner = ActionScanner()
+            found = [a for i in range(0, len(self.REPLY), size) for a in scanner.feed(self.REPLY[i:i + size])]
+            assert found == expected, size
+
+    def test_action_scanner_needs_actions_key(self):
+        from ai_stream import ActionScanner
+        for reply in ('{"message": "actions" [{"type": "none"}]}', '{"message": "actions", "list": [{"type": "none"}]}'):
+            assert ActionScanner().feed(reply) == []
+        assert ActionScanner().feed('{"actions" \n : [{"type": "none"}]}') == [{"type": "none"}]
+
+    def test_command_stream_event_order(self, upstream, monkeypatch):
+        import complete_api
+        async def prompt(data, x_coach_id): return "sys", [{"role": "user", "content": "x"}]
+        monkeypatch.setattr(complete_api, "ai_prompt", prompt)
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+        chunks = [self.REPLY[i:i + 6] for i in range(0, len(self.REPLY), 6)]
+        upstream.replies = [httpx.Response(200, text=self._deltas(chunks), headers={"content-type": "text/event-stream"})]
+        async def collect():
+            response = await complete_api.ai_command_stream({"prompt": "x"}, None)
+            return "".join([e async for e in response.body_iterator])
+        events = [(e.split("\n")[0][7:], json.loads(e.split("\n")[1][6:])) for e in asyncio.run(collect()).strip().split("\n\n")]
+        from ai_stream import ActionScanner
+        scanner = ActionScanner()
+        ends = [i + 1 for i in range(len(self.REPLY)) if scanner.feed(self.REPLY[i])]  # where each action's text ends
+        streamed, actions = "", []
+        for name, data in events[:-1]:
+            if name == "delta": streamed += data["text"]; last = data["text"]
+            else:  # sent right after the delta that completed it
+                assert name == "action" and len(streamed) - len(last) < ends[len(actions)] <= len(streamed)
+                actions.append(data)
+        assert streamed == self.REPLY and actions == json.loads(self.REPLY)["actions"]
+        assert events[-1][0] == "done" and events[-1][1]["response"]["actions"] == actions
+
+    def test_command_stream_error_after_deltas(self, upstream, monkeypatch):
+        import complete_api
+        class Body(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                yield TestAIClient._deltas(['{"message": "hi", "actions": [{"type": "none"}']).encode()
+                raise httpx.ReadError("connection reset")
+        async def prompt(data, x_coach_id): return "sys", [{"role": "user", "content": "x"}]
+        monkeypatch.setattr(complete_api, "ai_prompt", prompt)
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+        upstream.replies = [httpx.Response(200, stream=Body())]
+        async def collect():
+            response = await complete_api.ai_command_stream({"prompt": "x"}, None)
+            return "".join([e async for e in response.body_iterator])
+        names = [e.split("\n")[0][7:] for e in asyncio.run(collect()).strip().split("\n\n")]
+        assert names == ["delta", "action", "error"]